@@ -1,16 +1,98 @@
-import customtkinter as ctk
 import os
 import threading
-from tkinter import filedialog, messagebox, BooleanVar
+from collections import deque
+from tkinter import BooleanVar, StringVar, filedialog, messagebox
+
+import customtkinter as ctk
 
-from .backend import ProfileBackend
+from .backend import DEFAULT_FOLDERS, MAIL_FOLDERS, ProfileBackend
+from .estimator import (
+    SizeEstimator,
+    load_history,
+    preflight,
+    record_history,
+    total,
+)
+from .events import (
+    ERROR,
+    SKIP,
+    EventBus,
+    ProgressTracker,
+    describe,
+    format_bytes,
+    format_duration,
+)
+from .settings import current_user
+
+# Progress is redrawn at this interval, however fast events arrive.
+FRAME_MS = 100
+# User list: height of a row in pixels, rows per mouse wheel step, and the
+# pause in typing after which the search is applied.
+ROW_HEIGHT = 30
+WHEEL_ROWS = 3
+SEARCH_DELAY_MS = 150
+# User list sort orders.
+SORT_NAME = "Name"
+SORT_MODIFIED = "Last modified"
+SORT_SIZE = "Size"
+
+
+class JobMonitor:
+    """
+    Runs a backend call on a worker thread and reports its progress on the
+    Tk thread at a fixed frame rate. The worker only feeds the EventBus;
+    widgets are touched exclusively from `after()` callbacks.
+    """
+
+    def __init__(self, widget):
+        self.widget = widget
+        self.events = EventBus()
+        self.tracker = self.events.subscribe(ProgressTracker())
+        self.events.subscribe(self._collect)
+        self.notices = deque()
+        self.result = None
+        self.thread = None
+
+    def _collect(self, event):
+        if event.kind in (SKIP, ERROR):
+            reason = event.detail.get("reason", "")
+            self.notices.append(f"Skipped {event.name}: {reason}")
+
+    def start(self, job, on_frame, on_done):
+        """
+        Calls `job(events)` in the background, `on_frame(progress, notices)`
+        every frame and `on_done(result)` once with what `job` returned, or
+        (False, message) if it raised.
+        """
 
-ctk.set_appearance_mode("Dark")
-ctk.set_default_color_theme("blue")
+        def run():
+            try:
+                self.result = job(self.events)
+            except Exception as e:  # noqa: BLE001
+                # on_done() still gets a result, so the page can recover.
+                self.result = False, str(e)
+
+        self.thread = threading.Thread(target=run, daemon=True)
+        self.thread.start()
+        self._poll(on_frame, on_done)
+
+    def _poll(self, on_frame, on_done):
+        notices = []
+        while self.notices:
+            notices.append(self.notices.popleft())
+        on_frame(self.tracker.snapshot(), notices)
+        if self.thread.is_alive():
+            self.widget.after(FRAME_MS, self._poll, on_frame, on_done)
+        else:
+            on_done(self.result)
 
 
 class PyMigrateApp(ctk.CTk):
     def __init__(self):
+        # Theme setup lives here rather than at import time, so importing
+        # this module has no side effects.
+        ctk.set_appearance_mode("Dark")
+        ctk.set_default_color_theme("blue")
         super().__init__()
 
         self.title("PyMigrate Pro - Enterprise Migration Tool")
@@ -22,6 +104,7 @@ class PyMigrateApp(ctk.CTk):
 
         # State
         self.selected_users = {}  # { "Username": [Folders] }
+        self.size_estimates = {}  # { "Username/Folder": SizeEstimate }
         self.backup_options = {
             "export_registry": False,
             "backup_mail": True,
@@ -133,6 +216,205 @@ class ModeSelectionPage(ctk.CTkFrame):
         pass
 
 
+class UserList(ctk.CTkFrame):
+    """
+    A checkable list of users that stays fast with thousands of them: only
+    the rows that fit on screen exist as widgets, and scrolling just shows
+    other users in them. Names, labels and the selection are plain Python
+    data, so searching, sorting and selecting everything shown never touch
+    more than the visible rows.
+
+    `on_change()` is called whenever the selection changes.
+    """
+
+    def __init__(self, parent, on_change=None):
+        super().__init__(parent)
+        self.on_change = on_change
+        self.users = []
+        self.modified = {}  # user -> mtime_ns of the profile folder
+        self.sizes = {}  # user -> estimated bytes
+        self.labels = {}  # user -> text shown after the name
+        self.selected = set()
+        self.shown = []  # users matching the search, in sort order
+        self.first = 0  # index in `shown` of the top row
+        self.sort = SORT_NAME
+        self.rows = []  # (CTkCheckBox, BooleanVar)
+        self._search_job = None
+
+        bar = ctk.CTkFrame(self, fg_color="transparent")
+        bar.pack(fill="x", padx=5, pady=(5, 0))
+        ctk.CTkLabel(bar, text="Search:").pack(side="left", padx=(0, 5))
+        self.search = StringVar()
+        self.search.trace_add("write", lambda *_: self._search_changed())
+        ctk.CTkEntry(bar, textvariable=self.search).pack(
+            side="left", fill="x", expand=True
+        )
+        ctk.CTkOptionMenu(
+            bar,
+            values=[SORT_NAME, SORT_MODIFIED, SORT_SIZE],
+            command=self.set_sort,
+            width=130,
+        ).pack(side="left", padx=(5, 0))
+
+        buttons = ctk.CTkFrame(self, fg_color="transparent")
+        buttons.pack(fill="x", padx=5, pady=5)
+        ctk.CTkButton(
+            buttons, text="Select shown", width=110, command=lambda: self.select(True)
+        ).pack(side="left")
+        ctk.CTkButton(
+            buttons, text="Clear shown", width=110, command=lambda: self.select(False)
+        ).pack(side="left", padx=5)
+        self.count_lbl = ctk.CTkLabel(buttons, text="", text_color="gray")
+        self.count_lbl.pack(side="right")
+
+        body = ctk.CTkFrame(self, fg_color="transparent")
+        body.pack(fill="both", expand=True, padx=5, pady=(0, 5))
+        self.scrollbar = ctk.CTkScrollbar(body, command=self._scroll)
+        self.scrollbar.pack(side="right", fill="y")
+        self.body = ctk.CTkFrame(body, fg_color="transparent")
+        self.body.pack(side="left", fill="both", expand=True)
+        self.body.grid_propagate(False)
+        self.body.bind("<Configure>", self._resize, add="+")
+        self._bind_wheel(self.body)
+
+    def set_users(self, modified, selected=()):
+        """Shows the users of {user: mtime_ns}, with `selected` checked."""
+        self.users = list(modified)
+        self.modified = modified
+        self.selected = set(selected) & set(modified)
+        self.sizes = {}
+        self.labels = {}
+        self.first = 0
+        self.refresh()
+
+    def set_sizes(self, sizes, labels):
+        """Updates the estimated sizes and row labels of some users."""
+        self.sizes.update(sizes)
+        self.labels.update(labels)
+        if self.sort == SORT_SIZE:
+            self.refresh()
+        else:
+            self.redraw()
+
+    def set_sort(self, sort):
+        self.sort = sort
+        self.first = 0
+        self.refresh()
+
+    def select(self, checked):
+        """Checks or unchecks every user the search matches."""
+        if checked:
+            self.selected.update(self.shown)
+        else:
+            self.selected.difference_update(self.shown)
+        self.redraw()
+        self._changed()
+
+    def refresh(self):
+        """Re-applies the search and sort order."""
+        needle = self.search.get().strip().lower()
+        shown = [u for u in self.users if needle in u.lower()]
+        if self.sort == SORT_MODIFIED:
+            shown.sort(key=lambda u: self.modified.get(u, 0), reverse=True)
+        elif self.sort == SORT_SIZE:
+            shown.sort(key=lambda u: self.sizes.get(u, 0), reverse=True)
+        else:
+            shown.sort(key=str.lower)
+        self.shown = shown
+        self.scroll_to(self.first)
+
+    def scroll_to(self, first):
+        self.first = max(0, min(first, len(self.shown) - len(self.rows)))
+        self.redraw()
+
+    def redraw(self):
+        """Puts the users from `first` on into the visible rows."""
+        for i, (box, var) in enumerate(self.rows):
+            index = self.first + i
+            if index < len(self.shown):
+                user = self.shown[index]
+                box.configure(text=user + self.labels.get(user, ""))
+                var.set(user in self.selected)
+                box.grid()
+            else:
+                box.grid_remove()
+        total = len(self.shown)
+        if total > len(self.rows):
+            self.scrollbar.set(
+                self.first / total, (self.first + len(self.rows)) / total
+            )
+        else:
+            self.scrollbar.set(0.0, 1.0)
+        text = f"{len(self.selected)} of {len(self.users)} selected"
+        if total != len(self.users):
+            text += f", {total} shown"
+        self.count_lbl.configure(text=text)
+
+    def _resize(self, event):
+        count = max(1, event.height // ROW_HEIGHT)
+        while len(self.rows) < count:
+            i = len(self.rows)
+            var = BooleanVar(value=False)
+            box = ctk.CTkCheckBox(
+                self.body,
+                text="",
+                variable=var,
+                height=ROW_HEIGHT - 6,
+                command=lambda i=i: self._toggle(i),
+            )
+            box.grid(row=i, column=0, sticky="w", padx=5, pady=3)
+            self._bind_wheel(box)
+            self.rows.append((box, var))
+        while len(self.rows) > count:
+            self.rows.pop()[0].destroy()
+        self.scroll_to(self.first)
+
+    def _toggle(self, i):
+        index = self.first + i
+        if index >= len(self.shown):
+            return
+        user = self.shown[index]
+        if self.rows[i][1].get():
+            self.selected.add(user)
+        else:
+            self.selected.discard(user)
+        self.redraw()
+        self._changed()
+
+    def _changed(self):
+        if self.on_change is not None:
+            self.on_change()
+
+    def _search_changed(self):
+        # Wait for a pause in typing before filtering thousands of names.
+        if self._search_job is not None:
+            self.after_cancel(self._search_job)
+        self._search_job = self.after(SEARCH_DELAY_MS, self._search)
+
+    def _search(self):
+        self._search_job = None
+        self.first = 0
+        self.refresh()
+
+    def _scroll(self, *args):
+        if args[0] == "moveto":
+            self.scroll_to(int(float(args[1]) * len(self.shown)))
+        else:
+            step = int(args[1])
+            if args[2] == "pages":
+                step *= len(self.rows)
+            self.scroll_to(self.first + step)
+
+    def _wheel(self, event):
+        up = event.num == 4 or getattr(event, "delta", 0) > 0
+        self.scroll_to(self.first + (-WHEEL_ROWS if up else WHEEL_ROWS))
+        return "break"
+
+    def _bind_wheel(self, widget):
+        for sequence in ("<MouseWheel>", "<Button-4>", "<Button-5>"):
+            widget.bind(sequence, self._wheel, add="+")
+
+
 class BatchUserPage(ctk.CTkFrame):
     def __init__(self, parent, controller):
         super().__init__(parent)
@@ -155,10 +437,17 @@ class BatchUserPage(ctk.CTkFrame):
         ctk.CTkLabel(
             left_panel, text="Profiles Found:", font=ctk.CTkFont(weight="bold")
         ).pack(pady=5)
-        self.user_scroll = ctk.CTkScrollableFrame(left_panel)
-        self.user_scroll.pack(fill="both", expand=True, padx=5, pady=5)
+        self.user_list = UserList(left_panel, on_change=self.show_sizes)
+        self.user_list.pack(fill="both", expand=True, padx=5, pady=5)
+
+        self.size_lbl = ctk.CTkLabel(left_panel, text="", text_color="gray")
+        self.size_lbl.pack(pady=(0, 5))
 
-        self.user_checks = {}  # "User": CheckBox
+        self.sizing = None  # stop Event of the running size estimate
+        self.counting = False
+        self.size_updates = deque()
+        self.roots = {}  # (user, folders) -> ScanRoots, to avoid re-stat'ing
+        self.totals = {}  # user -> SizeEstimate for the current folders
 
         # Right: Options
         right_panel = ctk.CTkFrame(content)
@@ -177,7 +466,10 @@ class BatchUserPage(ctk.CTkFrame):
 
         self.mail_var = BooleanVar(value=True)
         ctk.CTkCheckBox(
-            right_panel, text="Include Mail Profiles (OST/PST)", variable=self.mail_var
+            right_panel,
+            text="Include Mail Profiles (OST/PST)",
+            variable=self.mail_var,
+            command=lambda: self.update_totals(self.user_list.users),
         ).pack(anchor="w", pady=10, padx=10)
 
         ctk.CTkLabel(
@@ -201,30 +493,112 @@ class BatchUserPage(ctk.CTkFrame):
         next_btn.pack(pady=20)
 
     def on_show(self):
-        # Refresh User List
-        for c in self.user_checks.values():
-            c.destroy()
-        self.user_checks = {}
+        # Keep the selection across visits; pre-select the current user on
+        # the first one.
+        profiles = self.controller.backend.list_profiles()
+        selected = self.user_list.selected
+        if not self.user_list.users:
+            me = current_user().lower()
+            selected = {u for u in profiles if u.lower() == me}
+        self.roots = {}
+        self.totals = {}
+        self.user_list.set_users(profiles, selected)
+        self.start_sizing(list(profiles))
+
+    def folders(self):
+        folders = list(DEFAULT_FOLDERS)
+        if self.mail_var.get():
+            folders.extend(MAIL_FOLDERS)
+        return folders
+
+    def user_roots(self, user, folders):
+        key = (user, tuple(folders))
+        if key not in self.roots:
+            self.roots[key] = self.controller.backend.scan_roots(user, folders)
+        return self.roots[key]
+
+    def start_sizing(self, users):
+        """
+        Estimates every user's data in the background (quick after the
+        first visit thanks to the size cache) and shows totals as they grow.
+        Finding each user's folders is part of the background work, so the
+        page opens at once however many profiles there are.
+        """
+        if self.sizing is not None:
+            self.sizing.set()
+        stop = self.sizing = threading.Event()
+        self.size_updates.clear()
+
+        def report(prefix, estimate, done):
+            self.size_updates.append((prefix, estimate))
 
-        users = self.controller.backend.get_users()
+        def run():
+            roots = []
+            for user in users:
+                if stop.is_set():
+                    return
+                self.user_roots(user, DEFAULT_FOLDERS)
+                roots.extend(self.user_roots(user, DEFAULT_FOLDERS + MAIL_FOLDERS))
+            # Sizes already known from the last visit show up right away.
+            self.size_updates.append((None, None))
+            SizeEstimator().estimate(roots, report, stop)
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        self.poll_sizes(thread, stop)
+
+    def poll_sizes(self, thread, stop):
+        if stop is not self.sizing:
+            return  # superseded by a newer estimate
+        users = set()
+        estimates = self.controller.size_estimates
+        while self.size_updates:
+            prefix, estimate = self.size_updates.popleft()
+            if prefix is None:
+                users.update(self.user_list.users)
+                continue
+            estimates[prefix] = estimate
+            users.add(prefix.partition("/")[0])
+        counting = thread.is_alive()
+        if counting != self.counting:
+            users.update(self.user_list.users)  # add or drop the "+"
+        self.counting = counting
+        self.update_totals(users)
+        if self.counting:
+            self.after(FRAME_MS * 3, self.poll_sizes, thread, stop)
+
+    def update_totals(self, users):
+        """Recomputes the size labels of `users` for the current folders."""
+        estimates = self.controller.size_estimates
+        key = tuple(self.folders())
+        more = "+" if self.counting else ""
+        sizes = {}
+        labels = {}
         for user in users:
-            var = BooleanVar(value=False)
-            # Pre-select current user
-            try:
-                if user.lower() == os.getlogin().lower():
-                    var.set(True)
-            except OSError:
-                # os.getlogin() may fail in some environments; ignore
-                pass
-
-            cb = ctk.CTkCheckBox(self.user_scroll, text=user, variable=var)
-            cb.pack(anchor="w", pady=5, padx=5)
-            self.user_checks[user] = var
+            roots = self.roots.get((user, key))
+            if roots is None:
+                continue  # folders not found yet
+            est = self.totals[user] = total(estimates, roots)
+            sizes[user] = est.bytes
+            labels[user] = f"  ({format_bytes(est.bytes)}{more}, {est.files} files)"
+        if labels:
+            self.user_list.set_sizes(sizes, labels)
+        self.show_sizes()
+
+    def show_sizes(self):
+        running = self.counting
+        selected = self.user_list.selected
+        selected_bytes = sum(self.totals[u].bytes for u in selected if u in self.totals)
+        text = f"Selected: {len(selected)} user(s), {format_bytes(selected_bytes)}"
+        rate = load_history().get("bytes_per_s")
+        if rate and not running:
+            text += f", about {format_duration(selected_bytes / rate)}"
+        self.size_lbl.configure(text=text + (" (still counting...)" if running else ""))
 
     def prepare_backup(self):
         # Build Selection Map
         selection_map = {}
-        target_users = [u for u, v in self.user_checks.items() if v.get()]
+        target_users = sorted(self.user_list.selected)
 
         if not target_users:
             messagebox.showwarning("No Selection", "Please select at least one user.")
@@ -232,20 +606,10 @@ class BatchUserPage(ctk.CTkFrame):
 
         for user in target_users:
             # Default to ALL valid folders + Mail
-            folders_to_backup = [
-                "Desktop",
-                "Documents",
-                "Downloads",
-                "Pictures",
-                "Music",
-                "Videos",
-                "Favorites",
-            ]
-            if self.mail_var.get():
-                folders_to_backup.extend(["Outlook Files", "Thunderbird"])
-
-            selection_map[user] = folders_to_backup
+            selection_map[user] = self.folders()
 
+        if self.sizing is not None:
+            self.sizing.set()
         self.controller.selected_users = selection_map  # Map of User -> Folders
         self.controller.backup_options["export_registry"] = self.reg_var.get()
         self.controller.show_frame("BackupProgressPage")
@@ -263,6 +627,9 @@ class BackupProgressPage(ctk.CTkFrame):
         self.progress.pack(pady=20)
         self.progress.set(0)
 
+        self.detail = ctk.CTkLabel(self, text="", text_color="gray")
+        self.detail.pack()
+
         self.log = ctk.CTkTextbox(self, width=600, height=300)
         self.log.pack(pady=10)
 
@@ -273,6 +640,7 @@ class BackupProgressPage(ctk.CTkFrame):
         count = len(self.controller.selected_users)
         self.status.configure(text=f"Ready to backup {count} user profile(s)")
         self.log.delete("1.0", "end")
+        self.detail.configure(text="")
         self.btn.configure(state="normal", text="Start Batch Backup")
 
     def start(self):
@@ -280,32 +648,74 @@ class BackupProgressPage(ctk.CTkFrame):
         if not dest:
             return
 
+        if not self.check_space(dest):
+            return
+
         self.btn.configure(state="disabled")
         self.log.insert("end", f"Starting Batch Backup to: {dest}\n\n")
 
-        def run():
-            def cb(fname, pct):
-                self.progress.set(pct)
-                if pct > 0 and (int(pct * 100) % 5 == 0):
-                    # Log throttle
-                    self.log.see("end")
-
-            success, msg = self.controller.backend.create_batch_backup(
-                self.controller.selected_users,
-                dest,
-                self.controller.backup_options,
-                cb,
+        def job(events):
+            options = dict(self.controller.backup_options, events=events)
+            return self.controller.backend.create_batch_backup(
+                self.controller.selected_users, dest, options
             )
 
-            self.log.insert("end", f"\n{msg}\n")
-            self.progress.set(1)
-            self.btn.configure(
-                state="normal",
-                text="Done (Main Menu)",
-                command=lambda: self.controller.show_frame("WelcomePage"),
+        self.monitor = JobMonitor(self)
+        self.monitor.start(job, self.show_progress, self.finish)
+
+    def check_space(self, dest):
+        """Pre-flight: warns if the estimated backup will not fit in `dest`."""
+        backend = self.controller.backend
+        estimated = 0
+        for user, folders in self.controller.selected_users.items():
+            roots = backend.scan_roots(user, folders)
+            estimated += total(self.controller.size_estimates, roots).bytes
+        if not estimated:
+            return True
+        try:
+            check = preflight(estimated, dest)
+        except OSError:
+            return True
+        self.log.insert(
+            "end",
+            f"Estimated data: {format_bytes(estimated)}, "
+            f"free at destination: {format_bytes(check.free)}\n",
+        )
+        if check.seconds is not None:
+            self.log.insert(
+                "end", f"Expected duration: about {format_duration(check.seconds)}\n"
             )
+        if check.enough:
+            return True
+        return messagebox.askyesno(
+            "Low Disk Space",
+            f"The backup may need about {format_bytes(check.required)} but only "
+            f"{format_bytes(check.free)} is free at {dest}.\n\nStart anyway?",
+        )
 
-        threading.Thread(target=run, daemon=True).start()
+    def show_progress(self, progress, notices):
+        if progress.bytes_total:
+            self.progress.set(min(1, progress.bytes_done / progress.bytes_total))
+        self.detail.configure(text=describe(progress))
+        if notices:
+            self.log.insert("end", "\n".join(notices) + "\n")
+            self.log.see("end")
+
+    def finish(self, result):
+        success, msg = result
+        if success:
+            progress = self.monitor.tracker.snapshot()
+            record_history(
+                progress.bytes_done, progress.elapsed, progress.bytes_written
+            )
+        self.log.insert("end", f"\n{msg}\n")
+        self.log.see("end")
+        self.progress.set(1)
+        self.btn.configure(
+            state="normal",
+            text="Done (Main Menu)",
+            command=lambda: self.controller.show_frame("WelcomePage"),
+        )
 
 
 class RestorePage(ctk.CTkFrame):
@@ -325,9 +735,12 @@ class RestorePage(ctk.CTkFrame):
         )
 
         self.progress = ctk.CTkProgressBar(self, width=500)
-        self.progress.pack(pady=30)
+        self.progress.pack(pady=(30, 5))
         self.progress.set(0)
 
+        self.detail = ctk.CTkLabel(self, text="", text_color="gray")
+        self.detail.pack()
+
         self.run_btn = ctk.CTkButton(
             self, text="Start Restore", state="disabled", command=self.run
         )
@@ -349,13 +762,26 @@ class RestorePage(ctk.CTkFrame):
             return
         self.run_btn.configure(state="disabled")
 
-        def work():
-            s, m = self.controller.backend.restore_batch_backup(
-                self.selected, {}, lambda n, p: self.progress.set(p)
+        def job(events):
+            return self.controller.backend.restore_batch_backup(
+                self.selected, {}, options={"events": events}
             )
-            self.run_btn.configure(text="Restored!", state="normal")
 
-        threading.Thread(target=work, daemon=True).start()
+        monitor = JobMonitor(self)
+        monitor.start(job, self.show_progress, self.finish)
+
+    def show_progress(self, progress, notices):
+        if progress.bytes_total:
+            self.progress.set(min(1, progress.bytes_done / progress.bytes_total))
+        self.detail.configure(text=describe(progress))
+
+    def finish(self, result):
+        success, msg = result
+        self.progress.set(1)
+        self.detail.configure(text=msg.splitlines()[-1])
+        self.run_btn.configure(
+            text="Restored!" if success else "Restore Failed", state="normal"
+        )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,643 @@
+import hashlib
+import os
+import queue
+import struct
+import sys
+import threading
+import time
+import zipfile
+import zlib
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from .codec import DICT_SIZE, DeflateCodec, get_codec, version_needed
+from .events import BYTES, MEMBER
+
+# Large members are split into chunks that are compressed independently on
+# the worker pool (pigz style) and stitched back into one stream.
+CHUNK_SIZE = 1 << 20
+# Chunks below this size are cheaper to deflate inline than to hand off.
+INLINE_LIMIT = 16 << 10
+# Sources at least this big are streamed past the page cache (PSTs, videos).
+STREAM_SIZE = 64 << 20
+# Members spanning several chunks that are read at the same time.
+LARGE_MEMBERS = 4
+# How often finished members are fsynced and logged to the journal.
+CHECKPOINT_BYTES = 64 << 20
+CHECKPOINT_SECONDS = 2.0
+
+ZIP64_LIMIT = (1 << 31) - 1
+ZIP_MAX = 0xFFFFFFFF
+
+_LOCAL_HEADER = struct.Struct("<4s2B4HL2L2H")
+_CENTRAL_DIR = struct.Struct("<4s4B4HL2L5H2L")
+_END_ARCHIVE = struct.Struct("<4s4H2LH")
+_END_ARCHIVE64 = struct.Struct("<4sQ2H2L4Q")
+_END_ARCHIVE64_LOCATOR = struct.Struct("<4sLQL")
+
+_CREATE_SYSTEM = 0 if sys.platform == "win32" else 3
+_FILE_ATTR = (0o100644 & 0xFFFF) << 16
+
+# Everything the central directory needs to know about a written member.
+MemberRecord = namedtuple(
+    "MemberRecord",
+    "arcname header_offset crc compress_size file_size compress_type dos_time flags "
+    "digest mtime_ns",
+)
+
+
+def content_hash():
+    """Hash used for the content digests recorded in backup manifests."""
+    return hashlib.blake2b(digest_size=16)
+
+
+def dos_time(mtime_ns=None):
+    """Converts a timestamp to the packed (time, date) pair zip headers use."""
+    t = time.localtime(mtime_ns / 1e9 if mtime_ns is not None else None)
+    year = min(max(t.tm_year, 1980), 2107)
+    return (
+        (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2),
+        ((year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday,
+    )
+
+
+def compress_next(previous, compressor, data, final):
+    """
+    Runs one chunk through a stateful compressor. Waiting for the previous
+    chunk keeps the order; the pool takes tasks first in, first out, so the
+    one waited for is always running already.
+    """
+    if previous is not None:
+        previous.result()
+    out = compressor.compress(data)
+    return out + compressor.flush() if final else out
+
+
+class _PendingMember:
+    def __init__(self, arcname, codec, mtime_ns, zip64, hasher=None):
+        self.arcname = arcname
+        self.mtime_ns = mtime_ns
+        self.codec = codec
+        self.dos_time = dos_time(mtime_ns)
+        self.zip64 = zip64
+        self.chunks = queue.SimpleQueue()
+        self.crc = 0
+        self.file_size = 0
+        self.hasher = hasher
+        self.error = None
+        self.compressor = None
+        self.last = None
+        self.slots = None
+        self.started = None
+
+    @property
+    def compress_type(self):
+        return self.codec.method
+
+
+class MemberWriter:
+    """
+    Turns files into ordered streams of compressed chunks.
+
+    add_file() reads the source on the calling thread (any number of threads
+    may call it) and hands chunks to a thread pool; a dedicated writer
+    thread takes members in submission order and passes their finished
+    chunks to _write_member(), which subclasses implement to decide where
+    the data goes. The number of chunks in flight is bounded, so memory use
+    does not depend on file size: up to LARGE_MEMBERS members spanning
+    several chunks are read at once, each with a window of `workers` + 2
+    chunks of its own, so one waiting for the writer never holds back the
+    member being written.
+
+    Members use `codec` (deflate at `level` by default) unless the policy
+    picks one per file; see codec.py. A member is one compressed stream
+    however many chunks it was compressed in.
+
+    With an EventBus, bytes read from files and every finished file member
+    are reported as BYTES and MEMBER events. Set `throttle` to a
+    throttle.Throttle to cap and measure source reads, and `report` to a
+    report.RunReport to time compression and writing.
+    """
+
+    def __init__(
+        self,
+        workers=None,
+        level=6,
+        chunk_size=CHUNK_SIZE,
+        policy=None,
+        hash_members=False,
+        events=None,
+        codec=None,
+    ):
+        self.level = level
+        self.codec = get_codec(codec) if codec else DeflateCodec(level)
+        self.policy = policy
+        self.hash_members = hash_members
+        self.chunk_size = chunk_size
+        self.workers = max(1, workers or os.cpu_count() or 1)
+        self.events = events
+        self.throttle = None
+        self.report = None
+        self._pool = ThreadPoolExecutor(self.workers)
+        self._small_slots = threading.BoundedSemaphore(self.workers * 4 + 4)
+        self._large_members = threading.BoundedSemaphore(LARGE_MEMBERS)
+        self._large_window = self.workers + 2
+        self._members = queue.Queue(maxsize=4096)
+        self._error = None
+        self._closed = False
+        self._writer = threading.Thread(target=self._write_loop, daemon=True)
+        self._writer.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    # -- producer side -------------------------------------------------
+
+    def add_file(self, path, arcname, size=None, mtime_ns=None, codec=None):
+        """
+        Adds a file from disk. Raises OSError if the file cannot be read; a
+        member that fails half way is dropped from the archive. Safe to call
+        from several threads at once.
+
+        Without an explicit codec the writer's policy picks one from the
+        first chunk read; without a policy the writer's codec is used.
+        """
+        self._check()
+        if codec is not None:
+            codec = get_codec(codec)
+        elif self.policy is None:
+            codec = self.codec
+
+        with open(path, "rb") as f:
+            if size is None or mtime_ns is None:
+                st = os.fstat(f.fileno())
+                size, mtime_ns = st.st_size, st.st_mtime_ns
+            member = _PendingMember(
+                arcname,
+                codec,
+                mtime_ns,
+                size * 1.05 > ZIP64_LIMIT,
+                content_hash() if self.hash_members else None,
+            )
+            read = f.read
+            if size >= STREAM_SIZE and hasattr(os, "posix_fadvise"):
+                read = _streaming_reader(f)
+            if self.throttle is not None:
+                read = self.throttle.timed(read)
+            auto = getattr(self.policy, "auto", None)
+            if auto is not None:
+                read = auto.timed(read)
+            if self.events is not None:
+                member.started = time.monotonic()
+                read = self._counting_reader(read, arcname)
+            self._add(member, read, size)
+
+    def _counting_reader(self, read, arcname):
+        emit = self.events.emit
+
+        def counted(n):
+            data = read(n)
+            if data:
+                emit(BYTES, arcname, len(data))
+            return data
+
+        return counted
+
+    def writestr(self, arcname, data, codec=None, mtime_ns=None):
+        """Adds an in-memory member (deflated unless `codec` says otherwise)."""
+        self._check()
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        member = _PendingMember(
+            arcname,
+            get_codec(codec) if codec else DeflateCodec(self.level),
+            mtime_ns,
+            len(data) * 1.05 > ZIP64_LIMIT,
+            content_hash() if self.hash_members else None,
+        )
+        view = memoryview(data)
+        pos = [0]
+
+        def read(n):
+            chunk = view[pos[0] : pos[0] + n]
+            pos[0] += len(chunk)
+            return bytes(chunk)
+
+        self._add(member, read, len(data))
+
+    def _add(self, member, read, size):
+        """
+        Small members are read completely before they are queued, so the
+        writer never waits on a producer for them. Members spanning several
+        chunks are queued as they start and fed through chunk slots of
+        their own. Together this keeps concurrent producers from
+        deadlocking on chunk slots while the writer waits for an earlier
+        member.
+        """
+        head = None
+        if size < self.chunk_size:
+            self._small_slots.acquire()
+            try:
+                head = read(self.chunk_size)
+                if len(head) < self.chunk_size:
+                    member.slots = self._small_slots
+                    self._push(member, head, size, None, True)
+                    member.chunks.put(None)
+                    self._members.put(member)
+                    return
+            except BaseException:
+                self._small_slots.release()
+                raise
+            # The file grew past one chunk since it was scanned.
+            self._small_slots.release()
+
+        with self._large_members:
+            member.slots = threading.BoundedSemaphore(self._large_window)
+            self._members.put(member)
+            try:
+                self._feed(member, read, size, head)
+            except BaseException as e:
+                member.error = e
+                raise
+            finally:
+                member.chunks.put(None)
+
+    def _feed(self, member, read, size, data=None):
+        zdict = None
+        while True:
+            member.slots.acquire()
+            if data is None:
+                try:
+                    data = read(self.chunk_size)
+                except BaseException:
+                    member.slots.release()
+                    raise
+            final = len(data) < self.chunk_size
+            self._push(member, data, size, zdict, final)
+            if final:
+                return
+            if member.codec.uses_dict:
+                zdict = data[-DICT_SIZE:]
+            data = None
+
+    def _push(self, member, data, size, zdict, final):
+        """Accounts for one chunk and hands it to the pool (or not)."""
+        if member.codec is None:
+            # The writer thread reads the codec only after it has received
+            # the first chunk, so it is safe to settle it here.
+            member.codec = self.policy.choose(member.arcname, size, data)
+        codec = member.codec
+        member.crc = zlib.crc32(data, member.crc)
+        if member.hasher is not None:
+            member.hasher.update(data)
+        member.file_size += len(data)
+        compress = codec.compress_chunk if codec.parallel else compress_next
+        if self.report is not None:
+            compress = self.report.timed("compress", compress)
+        if codec.method == zipfile.ZIP_STORED:
+            fut = _Done(data)
+        elif codec.parallel and len(data) < INLINE_LIMIT:
+            fut = _Done(compress(data, zdict, final))
+        elif codec.parallel:
+            fut = self._pool.submit(compress, data, zdict, final)
+        else:
+            if member.compressor is None:
+                member.compressor = codec.compressor()
+            fut = self._pool.submit(
+                compress, member.last, member.compressor, data, final
+            )
+            member.last = fut
+        member.chunks.put(fut)
+
+    def _check(self):
+        if self._closed:
+            raise ValueError("Archive is closed")
+        if self._error is not None:
+            raise self._error
+
+    # -- writer side ---------------------------------------------------
+
+    def _write_loop(self):
+        while True:
+            member = self._members.get()
+            try:
+                if member is None:
+                    return
+                self._write_member(member)
+            except BaseException as e:  # noqa: BLE001
+                if self._error is None:
+                    self._error = e
+            finally:
+                self._members.task_done()
+
+    def drain(self):
+        """Blocks until every member added so far has been written."""
+        self._members.join()
+        self._check()
+
+    def _write_member(self, member):
+        raise NotImplementedError
+
+    def _write_chunks(self, member, fut, write):
+        """
+        Passes every chunk of `member`, starting with `fut`, to `write`.
+        Returns (compressed bytes, ok); after a failure the remaining chunks
+        are only drained.
+        """
+        compress_size = 0
+        failed = self._error is not None
+        if self.report is not None:
+            write = self.report.timed("write", write)
+        while fut is not None:
+            try:
+                if not failed:
+                    data = fut.result()
+                    write(data)
+                    compress_size += len(data)
+            except BaseException as e:  # noqa: BLE001
+                failed = True
+                self._error = self._error or e
+            finally:
+                member.slots.release()
+            fut = member.chunks.get()
+        return compress_size, not failed and member.error is None
+
+    def _finished(self, member, compress_size):
+        if member.started is not None:
+            self.events.emit(
+                MEMBER,
+                member.arcname,
+                member.file_size,
+                compressed=compress_size,
+                seconds=time.monotonic() - member.started,
+            )
+
+    def close(self):
+        """Waits for pending members, then lets the subclass finish up."""
+        if self._closed:
+            return
+        self._closed = True
+        self._members.put(None)
+        self._writer.join()
+        self._pool.shutdown()
+        try:
+            if self._error is None:
+                self._finish()
+        finally:
+            self._release()
+        if self._error is not None:
+            raise self._error
+
+    def _finish(self):
+        pass
+
+    def _release(self):
+        pass
+
+
+class ArchiveWriter(MemberWriter):
+    """
+    Writes a standard zip archive while compressing members on a thread pool
+    (see MemberWriter). The writer thread appends each member's chunks to
+    the archive and fills in CRCs and sizes afterwards.
+
+    With a BackupJournal, finished members are periodically fsynced and
+    logged so an interrupted run can be resumed. Passing `resume_records`
+    reopens a partial archive: it is truncated to the journal's last
+    consistent offset and the given records are kept in the central
+    directory.
+    """
+
+    def __init__(
+        self,
+        path,
+        workers=None,
+        level=6,
+        chunk_size=CHUNK_SIZE,
+        policy=None,
+        hash_members=False,
+        journal=None,
+        resume_records=None,
+        events=None,
+        codec=None,
+    ):
+        self.path = path
+        self.journal = journal
+        self.records = []
+        self.comment = b""  # written into the end record
+
+        if resume_records is not None:
+            self._fp = open(path, "r+b")  # noqa: SIM115
+            self._fp.truncate(journal.end)
+            self._fp.seek(journal.end)
+            self.records = list(resume_records)
+        else:
+            self._fp = open(path, "wb")  # noqa: SIM115
+        self._unsynced = []
+        self._unsynced_bytes = 0
+        self._last_sync = time.monotonic()
+        super().__init__(
+            workers, level, chunk_size, policy, hash_members, events, codec
+        )
+
+    def _write_member(self, member):
+        fp = self._fp
+        fut = member.chunks.get()
+        if fut is None:
+            # Failed before the first chunk was read; nothing to drop.
+            return
+        name = member.arcname.encode("utf-8")
+        flags = member.codec.flags | (0x800 if not member.arcname.isascii() else 0)
+        header_offset = fp.tell()
+        extra = struct.pack("<HHQQ", 1, 16, 0, 0) if member.zip64 else b""
+        fp.write(
+            _LOCAL_HEADER.pack(
+                b"PK\003\004",
+                max(45 if member.zip64 else 20, member.codec.version),
+                0,
+                flags,
+                member.compress_type,
+                member.dos_time[0],
+                member.dos_time[1],
+                0,
+                ZIP_MAX if member.zip64 else 0,
+                ZIP_MAX if member.zip64 else 0,
+                len(name),
+                len(extra),
+            )
+        )
+        fp.write(name)
+        fp.write(extra)
+
+        compress_size, ok = self._write_chunks(member, fut, fp.write)
+        if not ok:
+            # Drop the partial member.
+            fp.seek(header_offset)
+            fp.truncate()
+            return
+
+        if not member.zip64 and max(compress_size, member.file_size) > ZIP64_LIMIT:
+            raise zipfile.LargeZipFile(f"{member.arcname} grew while being archived")
+
+        end = fp.tell()
+        fp.seek(header_offset + 14)
+        if member.zip64:
+            fp.write(struct.pack("<L", member.crc))
+            fp.seek(header_offset + 30 + len(name) + 4)
+            fp.write(struct.pack("<QQ", member.file_size, compress_size))
+        else:
+            fp.write(struct.pack("<LLL", member.crc, compress_size, member.file_size))
+        fp.seek(end)
+
+        self.records.append(
+            MemberRecord(
+                member.arcname,
+                header_offset,
+                member.crc,
+                compress_size,
+                member.file_size,
+                member.compress_type,
+                member.dos_time,
+                flags,
+                member.hasher.hexdigest() if member.hasher is not None else None,
+                member.mtime_ns,
+            )
+        )
+        if self.journal is not None:
+            self._unsynced.append((self.records[-1], end))
+            self._unsynced_bytes += end - header_offset
+            if (
+                self._unsynced_bytes >= CHECKPOINT_BYTES
+                or time.monotonic() - self._last_sync >= CHECKPOINT_SECONDS
+            ):
+                self._checkpoint()
+        self._finished(member, compress_size)
+
+    def _checkpoint(self):
+        """Makes finished members durable, then records them in the journal."""
+        self._fp.flush()
+        os.fsync(self._fp.fileno())
+        self.journal.append(self._unsynced)
+        self._unsynced = []
+        self._unsynced_bytes = 0
+        self._last_sync = time.monotonic()
+
+    def _finish(self):
+        if self.journal is not None:
+            self._checkpoint()
+        write_central_directory(self._fp, self.records, self.comment)
+
+    def _release(self):
+        self._fp.close()
+
+
+def _streaming_reader(f, drop_every=CHECKPOINT_BYTES):
+    """
+    Reads a big file with read-ahead for sequential access and tells the
+    kernel to drop what has been read, so backing up a 50 GB PST does not
+    push every other file (and the scanner's directory data) out of the
+    page cache.
+    """
+    fd = f.fileno()
+    os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+    pos = dropped = 0
+
+    def read(n):
+        nonlocal pos, dropped
+        data = f.read(n)
+        pos += len(data)
+        if pos - dropped >= drop_every or len(data) < n:
+            os.posix_fadvise(fd, dropped, pos - dropped, os.POSIX_FADV_DONTNEED)
+            dropped = pos
+        return data
+
+    return read
+
+
+class _Done:
+    """Stands in for a future when a chunk needs no compression."""
+
+    def __init__(self, value):
+        self._value = value
+
+    def result(self):
+        return self._value
+
+
+def write_central_directory(fp, records, comment=b""):
+    """Writes the central directory and end records for `records`."""
+    start_dir = fp.tell()
+    for rec in records:
+        name = rec.arcname.encode("utf-8")
+        extra = []
+        file_size, compress_size, header_offset = (
+            rec.file_size,
+            rec.compress_size,
+            rec.header_offset,
+        )
+        if file_size > ZIP64_LIMIT:
+            extra.append(file_size)
+            file_size = ZIP_MAX
+        if compress_size > ZIP64_LIMIT:
+            extra.append(compress_size)
+            compress_size = ZIP_MAX
+        if header_offset > ZIP64_LIMIT:
+            extra.append(header_offset)
+            header_offset = ZIP_MAX
+        extra_data = b""
+        version = max(20, version_needed(rec.compress_type))
+        if extra:
+            extra_data = struct.pack(
+                "<HH" + "Q" * len(extra), 1, 8 * len(extra), *extra
+            )
+            version = max(45, version)
+        fp.write(
+            _CENTRAL_DIR.pack(
+                b"PK\001\002",
+                version,
+                _CREATE_SYSTEM,
+                version,
+                0,
+                rec.flags,
+                rec.compress_type,
+                rec.dos_time[0],
+                rec.dos_time[1],
+                rec.crc,
+                compress_size,
+                file_size,
+                len(name),
+                len(extra_data),
+                0,
+                0,
+                0,
+                _FILE_ATTR,
+                header_offset,
+            )
+        )
+        fp.write(name)
+        fp.write(extra_data)
+
+    end_dir = fp.tell()
+    count = len(records)
+    size_dir = end_dir - start_dir
+    offset_dir = start_dir
+    if count > 0xFFFF or size_dir > ZIP64_LIMIT or offset_dir > ZIP64_LIMIT:
+        fp.write(
+            _END_ARCHIVE64.pack(
+                b"PK\006\006", 44, 45, 45, 0, 0, count, count, size_dir, offset_dir
+            )
+        )
+        fp.write(_END_ARCHIVE64_LOCATOR.pack(b"PK\006\007", 0, end_dir, 1))
+        count = min(count, 0xFFFF)
+        size_dir = min(size_dir, ZIP_MAX)
+        offset_dir = min(offset_dir, ZIP_MAX)
+    fp.write(
+        _END_ARCHIVE.pack(
+            b"PK\005\006", 0, 0, count, count, size_dir, offset_dir, len(comment)
+        )
+    )
+    fp.write(comment)
+    fp.flush()
@@ -1,10 +1,90 @@
 import os
+import platform
 import shutil
 import zipfile
-
 from datetime import datetime
-import platform
-import subprocess
+
+from .archive import ArchiveWriter
+from .codec import AUTO, AutoCodec, DeflateCodec, get_codec, probe_write_speed
+from .dedup import Deduplicator
+from .estimator import cached_write_speed
+from .events import (
+    DONE,
+    ERROR,
+    FINALIZE,
+    FOUND,
+    PHASE,
+    SCAN,
+    SKIP,
+    TRANSFER,
+    EventBus,
+    EventLog,
+    ProgressTracker,
+    format_bytes,
+    legacy_callback,
+    summarize,
+)
+from .index import INDEX_NAME, ArchiveIndex, Selection, build_index, index_comment
+from .journal import JOURNAL_SUFFIX, BackupJournal, RestoreJournal
+from .manifest import (
+    INCREMENTAL,
+    MANIFEST_NAME,
+    BackupManifest,
+    BaseDiff,
+    is_batch,
+    resolve_batch,
+    resolve_chain,
+)
+from .pipeline import BackupPipeline
+from .policy import CompressionPolicy
+from .report import (
+    REPORT_NAME,
+    REPORT_SUFFIX,
+    RESTORE_SUFFIX,
+    RunReport,
+    section,
+    wants_report,
+)
+from .restore import (
+    IDENTICAL,
+    NEW,
+    UPDATED,
+    RestoreEngine,
+    TargetMap,
+    compare,
+    make_directory,
+    open_member,
+)
+from .rules import DEFAULT_PROFILES, RuleMatcher, build_rules
+from .scanner import ProfileScanner, default_workers
+from .settings import DEFAULT_TIMEOUT, RegistryExporter, SettingsStage
+from .throttle import Throttle, run_in_background
+from .transfer import (
+    DEFAULT_PORT,
+    StreamReceiver,
+    StreamSender,
+    TransferError,
+    connect,
+    listen,
+    parse_address,
+)
+
+# Folders backed up when a caller does not pick its own.
+DEFAULT_FOLDERS = [
+    "Desktop",
+    "Documents",
+    "Downloads",
+    "Pictures",
+    "Music",
+    "Videos",
+    "Favorites",
+]
+MAIL_FOLDERS = ["Outlook Files", "Thunderbird"]
+# Kinds of run a RunReport describes.
+BACKUP = "backup"
+RESTORE = "restore"
+# Message of a backup that found no files at all.
+NOTHING_FOUND = "No items found to backup."
 
 
 class ProfileBackend:
@@ -18,6 +98,7 @@ class ProfileBackend:
             "Default User",
             "desktop.ini",
         ]
+        self._profiles = None  # ((users_dir, its mtime_ns), list_profiles())
 
         # Registry keys to export (HKCU based)
         self.registry_targets = {
@@ -30,20 +111,39 @@ class ProfileBackend:
 
     def get_users(self):
         """Scans the Users directory and returns a list of valid user profiles."""
-        if not os.path.exists(self.users_dir):
-            return []
+        return list(self.list_profiles())
 
-        users = []
+    def list_profiles(self):
+        """
+        Returns {user: mtime_ns of the profile folder} for users_dir. One
+        scandir finds them, using the file types it already knows, and the
+        result is reused until users_dir's own mtime changes, which is when
+        profiles are added, removed or renamed.
+        """
         try:
-            for item in os.listdir(self.users_dir):
-                if item not in self.excluded_users and os.path.isdir(
-                    os.path.join(self.users_dir, item)
-                ):
-                    users.append(item)
+            key = (self.users_dir, os.stat(self.users_dir).st_mtime_ns)
+        except OSError:
+            return {}
+        if self._profiles is not None and self._profiles[0] == key:
+            return dict(self._profiles[1])
+
+        excluded = set(self.excluded_users)
+        profiles = {}
+        try:
+            with os.scandir(self.users_dir) as it:
+                for entry in it:
+                    if entry.name in excluded:
+                        continue
+                    try:
+                        if entry.is_dir():
+                            profiles[entry.name] = entry.stat().st_mtime_ns
+                    except OSError:
+                        pass
         except PermissionError:
             print("Error: Permission denied accessing Users directory.")
-
-        return users
+            return {}
+        self._profiles = (key, profiles)
+        return dict(profiles)
 
     def get_user_folders(self, username):
         """Returns a dict of common folders for a user and their estimated sizes."""
@@ -69,23 +169,23 @@ class ProfileBackend:
 
         return valid_folders
 
+    def scan_roots(self, username, folders):
+        """ScanRoots for the named folders of one user that exist on disk."""
+        folders_map = self.get_user_folders(username)
+        return ProfileScanner.make_roots(
+            username,
+            os.path.join(self.users_dir, username),
+            [folders_map[f] for f in folders if f in folders_map],
+        )
+
     def export_registry(self, key_path, output_file):
         """Exports a specific HKCU registry key to a file."""
-        # reg export "HKCU\Software\..." "output.reg" /y
-        full_key = f"HKEY_CURRENT_USER\\{key_path}"
-        cmd = f'reg export "{full_key}" "{output_file}" /y'
-        try:
-            # We use shell=True to access the reg command
-            subprocess.run(
-                cmd,
-                shell=True,
-                check=True,
-                stdout=subprocess.DEVNULL,
-                stderr=subprocess.DEVNULL,
-            )
-            return True
-        except subprocess.CalledProcessError:
+        data = RegistryExporter().export({"key": key_path}).get("key")
+        if data is None:
             return False
+        with open(output_file, "wb") as f:
+            f.write(data)
+        return True
 
     def create_batch_backup(
         self, user_selection_map, destination_path, options, progress_callback=None
@@ -94,127 +194,763 @@ class ProfileBackend:
         Creates a zip backup for multiple users.
         user_selection_map: dict { "Username": ["Desktop", "Documents"] }
         destination_path: full path to save the .zip file
-        options: dict { "export_registry": Bool }
-        progress_callback: function(current_file, percentage)
+        options: dict { "export_registry": Bool, "base_archive": path,
+                        "resume": path, "codec": str, "events": EventBus,
+                        "event_log": path, "archive_name": str }
+        progress_callback: function(current_file, percentage), where the
+        percentage is by bytes, not by file count.
+
+        Pass an EventBus as "events" to follow phases, bytes, finished files
+        and skips as they happen (see events.py); "event_log" appends the
+        same stream to a file as JSON lines.
+
+        With "base_archive" set, only files that are new or changed since that
+        archive are written, plus a list of deleted files. Basing each run on
+        the previous one gives incremental backups; always basing on the same
+        full backup gives differential ones. Keep the chain in one folder so
+        restore can find the bases.
+
+        A journal is kept next to the archive while it is written. If a run
+        dies, pass the partial archive as "resume" to continue where it
+        stopped instead of starting over.
+
+        "archive_name" replaces the MultiBackup_<timestamp>.pmig file name.
+
+        "export_registry" exports the registry_targets of the user running
+        the backup, in one background process while files are scanned, and
+        writes them into the archive under <user>/Registry/. Each key may
+        take "settings_timeout" seconds; "settings_exporter" swaps in
+        another settings.RegistryExporter (e.g. with a stub command).
+
+        "codec" picks the compression for compressible files, e.g.
+        "deflate:9", "bzip2", "lzma" or "zstd:3" (see codec.py); "auto"
+        measures the source and destination during the first seconds and
+        picks whatever moves data fastest end to end, among the methods
+        zipfile can read; the destination disk's write speed is probed at
+        most once a month (see estimator.cached_write_speed). zstd archives
+        can only be restored by this tool.
+
+        Caches, temporary and lock files and dependency folders are left out
+        (see rules.PROFILES). "exclude_profiles" picks other built-in rule
+        sets ([] for none), "exclude" adds glob patterns, "max_file_size"
+        (bytes) and "max_age_days" skip big or old files, and "rules" takes
+        a list of rules.Rule instead of all of these. Excluded folders are
+        not even walked; what each rule left out is reported.
+
+        To leave the machine usable while it runs: "max_bytes_per_sec" and
+        "max_iops" cap source reads, "adaptive_workers" lets the number of
+        readers follow the disk's latency (see throttle.Throttle), and
+        "low_priority" runs the backup at low CPU and I/O priority. The
+        limits and achieved rates are sent to "events" as THROTTLE events.
+
+        "report" records a run report (see report.RunReport): phase and
+        section timings, the slowest files and every skipped one. It is
+        stored in the archive as .pmig/report.json and written next to it
+        as <archive>.report.json, or to "report" if that is a path.
+        "profile" adds a cProfile summary and "trace_memory" a tracemalloc
+        one.
         """
+        if options.get("low_priority"):
+            return run_in_background(
+                lambda: self.create_batch_backup(
+                    user_selection_map,
+                    destination_path,
+                    dict(options, low_priority=False),
+                    progress_callback,
+                )
+            )
+        if wants_report(options):
+            return self._reported(
+                BACKUP,
+                options,
+                lambda opts: self.create_batch_backup(
+                    user_selection_map, destination_path, opts, progress_callback
+                ),
+            )
+        report = options.get("run_report")
+        codec_spec = options.get("codec")
+        try:
+            codec = get_codec(codec_spec) if codec_spec not in (None, AUTO) else None
+            rules = self._rules(options)
+        except ValueError as e:
+            return False, str(e)
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        backup_filename = f"MultiBackup_{timestamp}.pmig"
-        full_backup_path = os.path.join(destination_path, backup_filename)
-
-        # Temp dir for registry exports
-        temp_dir = os.path.join(destination_path, "_pymigrate_temp")
-        os.makedirs(temp_dir, exist_ok=True)
+        journal = None
+        resume_path = options.get("resume")
+        if resume_path:
+            try:
+                journal = BackupJournal.load(resume_path + JOURNAL_SUFFIX)
+            except (OSError, ValueError) as e:
+                return False, f"Cannot resume {resume_path}: {e}"
+            base_path = journal.header.get("base_archive")
+        else:
+            base_path = options.get("base_archive")
+        if base_path:
+            base = BackupManifest.load(base_path)
+            if base is None:
+                return False, f"{base_path} has no manifest, run a full backup first."
+            manifest = BackupManifest(
+                INCREMENTAL, {"name": os.path.basename(base_path), "id": base.id}
+            )
+            backup_filename = options.get("archive_name") or (
+                f"MultiBackup_{timestamp}_incr.pmig"
+            )
+        else:
+            base = None
+            manifest = BackupManifest()
+            backup_filename = options.get("archive_name") or (
+                f"MultiBackup_{timestamp}.pmig"
+            )
+        if journal is not None:
+            full_backup_path = resume_path
+            manifest.id = journal.header["manifest_id"]
+        else:
+            full_backup_path = os.path.join(destination_path, backup_filename)
+        if report is not None:
+            report.archive = full_backup_path
 
+        events, tracker, subscribers = self._watch(options, progress_callback)
+        throttle = self._throttle(options, events)
         try:
-            total_items = 0
-            files_to_zip = []  # (full_path, archive_name)
+            events.emit(PHASE, SCAN)
+            scanner = ProfileScanner(
+                options.get("scan_workers"), rules=rules, throttle=throttle
+            )
+            # Settings are exported in the background while files are found.
+            settings = None
+            if options.get("export_registry", False):
+                settings = SettingsStage(
+                    self.registry_targets, self._settings_exporter(options)
+                )
+                settings.report = report
+                settings.start(user_selection_map)
+            roots = []
+            with section(report, "user discovery"):
+                for username, folders in user_selection_map.items():
+                    # The scanner walks the roots of all users concurrently
+                    roots.extend(self.scan_roots(username, folders))
 
-            for username, folders in user_selection_map.items():
-                user_root = os.path.join(self.users_dir, username)
-                folders_map = self.get_user_folders(username)
-
-                # 1. Collect Files
-                for folder_name in folders:
-                    if folder_name in folders_map:
-                        source_folder = folders_map[folder_name]
-                        for dirpath, dirnames, filenames in os.walk(source_folder):
-                            for f in filenames:
-                                full_path = os.path.join(dirpath, f)
-                                # Archive: "User1/Desktop/File.txt"
-                                rel_path = os.path.relpath(full_path, user_root)
-                                archive_name = f"{username}/{rel_path}"
-                                files_to_zip.append((full_path, archive_name))
-                                total_items += 1
-                                if progress_callback and total_items % 50 == 0:
-                                    progress_callback(f"Scanning: {f}...", 0)
-
-                # 2. Export Registry (If requested)
-                if options.get("export_registry", False):
-                    for name, key in self.registry_targets.items():
-                        reg_file = os.path.join(temp_dir, f"{username}_{name}.reg")
-                        # Note: This is tricky. REG EXPORT HKCU exports the *current* user.
-                        # For other users, we'd need to load their Hive (NTUSER.DAT).
-                        # Limitation: Registry export only works for the CURRENTLY RUNNING user.
-                        # Workaround: We will log a warning or only do it if username == current_user.
-                        if username.lower() == os.getlogin().lower():
-                            if self.export_registry(key, reg_file):
-                                files_to_zip.append(
-                                    (reg_file, f"{username}/Registry/{name}.reg")
-                                )
-                                total_items += 1
-
-            if total_items == 0:
-                return False, "No items found to backup."
-
-            processed_items = 0
-            with zipfile.ZipFile(full_backup_path, "w", zipfile.ZIP_DEFLATED) as zipf:
-                for full_path, arc_name in files_to_zip:
+            resumed = None  # arcname -> record journaled by the partial run
+            kept = set()
+            if journal is None:
+                journal = BackupJournal.create(
+                    full_backup_path + JOURNAL_SUFFIX,
+                    {
+                        "archive": os.path.basename(full_backup_path),
+                        "base_archive": base_path,
+                        "manifest_id": manifest.id,
+                    },
+                )
+            else:
+                resumed = {rec.arcname: rec for rec in journal.records}
+
+            diff = BaseDiff(base, manifest) if base is not None else None
+
+            def accept(entry):
+                if diff is not None and not diff.accept(entry):
+                    return False
+                # A journaled member can be kept if its source still has the
+                # size and mtime it had when it was archived.
+                rec = resumed.get(entry.arcname) if resumed else None
+                if (
+                    rec is not None
+                    and rec.file_size == entry.size
+                    and rec.mtime_ns == entry.mtime_ns
+                ):
+                    kept.add(entry.arcname)
+                    return False
+                return True
+
+            auto = None
+            if codec_spec == AUTO:
+                auto = AutoCodec(
+                    cached_write_speed(destination_path, probe_write_speed),
+                    options.get("compress_workers"),
+                    options.get("read_workers") or default_workers(),
+                )
+            policy = None
+            if options.get("smart_compression", True) or auto is not None:
+                policy = CompressionPolicy(fast=codec, strong=codec, auto=auto)
+            dedup = Deduplicator() if options.get("dedup", True) else None
+
+            with ArchiveWriter(
+                full_backup_path,
+                workers=options.get("compress_workers"),
+                policy=policy,
+                hash_members=True,
+                journal=journal,
+                resume_records=list(resumed.values()) if resumed is not None else None,
+                events=events,
+                codec=codec,
+            ) as archive:
+                archive.throttle = throttle
+                archive.report = report
+                # Scanning, reading, compressing and writing all overlap.
+                pipeline = BackupPipeline(
+                    archive,
+                    readers=options.get("read_workers"),
+                    dedup=dedup,
+                    events=events,
+                    throttle=throttle,
+                )
+                pipeline.run(scanner.iter_scan(roots), accept)
+                exported = settings.results() if settings is not None else []
+                for arcname, data, mtime_ns in exported:
+                    archive.writestr(arcname, data, mtime_ns=mtime_ns)
+                archive.drain()
+                events.emit(PHASE, FINALIZE)
+                if diff is not None:
+                    diff.finish(roots, rules)
+                if resumed is not None:
+                    # Drop journaled members whose source changed since.
+                    n = len(resumed)
+                    archive.records[:n] = [
+                        r for r in archive.records[:n] if r.arcname in kept
+                    ]
+                written = {rec.arcname: rec for rec in archive.records}
+
+                # A reference is only valid if its target made it into the
+                # archive; otherwise store the file itself.
+                for entry, canonical in pipeline.refs:
+                    if canonical in written:
+                        manifest.refs[entry.arcname] = canonical
+                        continue
                     try:
-                        zipf.write(full_path, arc_name)
+                        archive.add_file(
+                            entry.path, entry.arcname, entry.size, entry.mtime_ns
+                        )
                     except (PermissionError, OSError) as e:
-                        print(f"Skipping {full_path}: {e}")
+                        print(f"Skipping {entry.path}: {e}")
+                        events.emit(SKIP, entry.arcname, files=0, reason=str(e))
+                archive.drain()
+
+                for rec in archive.records:
+                    manifest.add(rec.arcname, rec.file_size, rec.mtime_ns, rec.digest)
+                for entry, canonical in pipeline.refs:
+                    if entry.arcname in manifest.refs:
+                        rec = written[canonical]
+                        manifest.add(
+                            entry.arcname, rec.file_size, entry.mtime_ns, rec.digest
+                        )
+                if pipeline.discovered or exported or base is not None:
+                    if report is not None:
+                        archive.writestr(
+                            REPORT_NAME,
+                            report.to_json(progress=tracker.snapshot()),
+                        )
+                    archive.writestr(MANIFEST_NAME, manifest.to_json())
+                    # The index goes last so it can point at every member;
+                    # the end record's comment says where it starts.
+                    archive.drain()
+                    index = build_index(
+                        archive.records, manifest.refs, manifest.deleted, manifest
+                    )
+                    archive.writestr(INDEX_NAME, index, codec="stored")
+                    archive.drain()
+                    archive.comment = index_comment(archive.records[-1].header_offset)
 
-                    processed_items += 1
-                    if progress_callback:
-                        progress_callback(arc_name, processed_items / total_items)
+            if pipeline.discovered == 0 and not exported and base is None:
+                journal.discard()
+                os.remove(full_backup_path)
+                return False, NOTHING_FOUND
 
-            return True, f"Batch Backup created: {full_backup_path}"
+            journal.discard()
+            events.emit(PHASE, DONE, archive=full_backup_path)
+            msg = f"Batch Backup created: {full_backup_path}"
+            msg += "\n" + summarize(tracker.snapshot())
+            if resumed is not None:
+                msg += f"\nResumed: {len(kept)} files kept from the partial run"
+            if diff is not None:
+                msg += (
+                    f"\nIncremental: {diff.changed} new or changed, "
+                    f"{len(manifest.deleted)} deleted"
+                )
+            if policy is not None:
+                msg += "\n" + policy.summary()
+            if auto is not None:
+                msg += "\n" + auto.summary()
+            if dedup is not None:
+                msg += "\n" + dedup.summary()
+            if rules.stats:
+                msg += "\n" + rules.summary()
+            if throttle is not None:
+                msg += "\n" + throttle.summary()
+            if settings is not None:
+                msg += f"\nSettings: {len(exported)} exported"
+            return True, msg
 
         finally:
-            if os.path.exists(temp_dir):
-                shutil.rmtree(temp_dir)
+            if throttle is not None:
+                throttle.stop()
+            self._unwatch(events, subscribers)
+            if journal is not None:
+                journal.close()
 
     def restore_batch_backup(
-        self, archive_path, target_root_map, progress_callback=None
+        self, archive_path, target_root_map, progress_callback=None, options=None
     ):
         r"""
         Restores a multi-user backup.
-        target_root_map: NOT USED YET (Automapped).
-        Logic: Inside Zip -> "User1/Desktop". We extract "User1" content to "C:\Users\User1".
-        Advanced: We could allow mapping "User1" -> "User2" (Future).
+        archive_path: a .pmig file, a .pmigbatch manifest of per-user shards
+        (see scheduler.py), or a list of archives to apply in order. An
+        incremental archive is restored on top of its bases, which are
+        looked up next to it.
+        options: dict { "restore_workers": Int, "resume": Bool,
+                        "sync": Bool, "select": [pattern],
+                        "events": EventBus, "event_log": path }
+        With "resume", files a previous interrupted restore already wrote
+        (and that still verify on disk) are skipped. Progress is by bytes
+        across the whole chain; "events" works as for create_batch_backup.
+
+        "sync" restores onto a profile that already holds (most of) the
+        data: files whose size and mtime (or, failing that, CRC) match the
+        archive are left alone and only new or changed ones are written.
+        The message then counts new, updated and identical files.
+
+        "select" restores only matching names, e.g.
+        ["UserA/Documents/Projects/**"] (see index.Selection). Archives carry
+        an index by user and folder, so only the folders a selection can
+        touch are read.
+
+        target_root_map: { "UserA": "UserB" } restores UserA's files into
+        UserB's profile; an absolute path as the value restores them into
+        that folder instead. Unmapped users go to users_dir/<user>.
+
+        "report", "profile" and "trace_memory" work as for
+        create_batch_backup; the report goes next to the (newest) archive
+        as <archive>.restore.report.json.
         """
+        options = options or {}
+        if wants_report(options):
+            return self._reported(
+                RESTORE,
+                options,
+                lambda opts: self.restore_batch_backup(
+                    archive_path, target_root_map, progress_callback, opts
+                ),
+            )
+        events, tracker, subscribers = self._watch(options, progress_callback)
         try:
-            with zipfile.ZipFile(archive_path, "r") as zipf:
-                file_list = zipf.namelist()
-                total = len(file_list)
-
-                for i, file in enumerate(file_list):
-                    # File format: "Username/Folder/File.ext" or "Username/Registry/file.reg"
-                    parts = file.split("/")
-                    if len(parts) < 2:
-                        continue
+            targets = TargetMap(self.users_dir, target_root_map)
+            selection = Selection(options.get("select"))
+            if isinstance(archive_path, (list, tuple)):
+                chain = list(archive_path)
+            elif is_batch(archive_path):
+                # Shards hold one user each; skip those the selection rules out.
+                chain = [
+                    path
+                    for user, shard_chain in resolve_batch(archive_path)
+                    if selection.may_match(user, "")
+                    for path in shard_chain
+                ]
+            else:
+                chain = resolve_chain(archive_path)
 
-                    # username = parts[0]
-
-                    # 1. Check if it's a Registry File
-                    if "Registry" in parts and file.endswith(".reg"):
-                        # Extract to temp and run
-                        # Dangerous! Ask user? For now, we restore to Documents/RestoredRegistry
-                        # to be safe.
-                        # target_path = os.path.join(
-                        #     self.users_dir, username, "Documents", "Restored_Registry"
-                        # )
-                        zipf.extract(
-                            file, self.users_dir
-                        )  # Extracts to C:\Users\Username\...
-                        # TODO: Auto-import logic can be added here
-                    else:
-                        # 2. Normal File Restore
-                        # Target: C:\Users\Username\...
-                        target_dir = self.users_dir
+            report = options.get("run_report")
+            if report is not None and chain:
+                report.archive = archive_path if is_batch(archive_path) else chain[-1]
+            # Read every index first so the byte total covers the whole
+            # chain before the first file is written.
+            events.emit(PHASE, SCAN)
+            steps = []
+            for path in chain:
+                index = ArchiveIndex.open(path)
+                steps.append((path, index, index.select(selection)))
+            # A name a later archive writes, copies or deletes again need
+            # not be restored from an earlier one.
+            later = set()
+            for path, index, view in reversed(steps):
+                if later:
+                    view.infos = [i for i in view.infos if i.filename not in later]
+                    view.refs = {n: c for n, c in view.refs.items() if n not in later}
+                    view.deleted = [n for n in view.deleted if n not in later]
+                later.update(info.filename for info in view.infos)
+                later.update(view.refs)
+                later.update(view.deleted)
+            for path, index, view in steps:
+                events.emit(
+                    FOUND,
+                    path,
+                    sum(info.file_size for info in view.infos),
+                    files=len(view.infos),
+                )
+            events.emit(PHASE, TRANSFER)
 
-                        # Security: Prevent Zip Slip
-                        if ".." in file:
-                            continue
+            total_restored = total_failed = total_skipped = 0
+            stats = {NEW: [0, 0], UPDATED: [0, 0], IDENTICAL: [0, 0]}
+            for path, index, view in steps:
+                restored, failed, skipped = self._restore_archive(
+                    path, index, view, targets, events, options, stats
+                )
+                total_restored += restored
+                total_failed += failed
+                total_skipped += skipped
+            events.emit(PHASE, DONE)
+
+            msg = f"Batch Restore Complete: {total_restored} files restored"
+            if selection:
+                msg += f" (matching {', '.join(selection.patterns)})"
+            if total_skipped:
+                msg += f", {total_skipped} already on disk"
+            if total_failed:
+                msg += f", {total_failed} failed"
+            if options.get("sync"):
+                msg += "\nSync: " + ", ".join(
+                    f"{n} {state} ({format_bytes(size)})"
+                    for state, (n, size) in stats.items()
+                )
+            msg += "\n" + summarize(tracker.snapshot())
+            return True, msg
+        except Exception as e:  # noqa: BLE001
+            return False, str(e)
+        finally:
+            self._unwatch(events, subscribers)
+
+    def send_batch(
+        self, user_selection_map, address, options=None, progress_callback=None
+    ):
+        """
+        Streams the selected folders straight to a receiving machine (see
+        receive_batch) without writing an archive on either side.
+        address: "host:port" of the receiver.
+        options: dict { "token": str, "compress_level": Int, "codec": str,
+                        "smart_compression": Bool, "dedup": Bool,
+                        "events": EventBus, "event_log": path, plus the
+                        exclusion, throttling and scan/read/compress
+                        worker options of create_batch_backup }
+        Files are deflated at level 1 unless "compress_level" says otherwise,
+        which keeps a gigabit link busy without starving the CPU; "codec"
+        overrides that as for create_batch_backup, except "auto". Already
+        compressed files are sent as-is. Registry exports are not sent.
+        """
+        options = options or {}
+        if options.get("low_priority"):
+            return run_in_background(
+                lambda: self.send_batch(
+                    user_selection_map,
+                    address,
+                    dict(options, low_priority=False),
+                    progress_callback,
+                )
+            )
+        events, tracker, subscribers = self._watch(options, progress_callback)
+        throttle = self._throttle(options, events)
+        try:
+            host, port = parse_address(address)
+            events.emit(PHASE, SCAN)
+            roots = []
+            for username, folders in user_selection_map.items():
+                roots.extend(self.scan_roots(username, folders))
+            level = options.get("compress_level", 1)
+            codec = get_codec(options.get("codec") or DeflateCodec(level))
+            rules = self._rules(options)
+            policy = None
+            if options.get("smart_compression", True):
+                policy = CompressionPolicy(fast=codec, strong=codec)
+            dedup = Deduplicator() if options.get("dedup", True) else None
+            scanner = ProfileScanner(
+                options.get("scan_workers"), rules=rules, throttle=throttle
+            )
 
+            with connect(host, port) as sock:
+                with StreamSender(
+                    sock,
+                    options.get("token", ""),
+                    workers=options.get("compress_workers"),
+                    policy=policy,
+                    events=events,
+                    codec=codec,
+                ) as sender:
+                    sender.throttle = throttle
+                    pipeline = BackupPipeline(
+                        sender,
+                        readers=options.get("read_workers"),
+                        dedup=dedup,
+                        events=events,
+                        throttle=throttle,
+                    )
+                    pipeline.run(scanner.iter_scan(roots))
+                    sender.drain()
+                    events.emit(PHASE, FINALIZE)
+                    # Duplicates are copied on the receiving side, unless
+                    # their original never made it across.
+                    refs = []
+                    for entry, canonical in pipeline.refs:
+                        if canonical in sender.sent:
+                            refs.append((entry, canonical))
+                            continue
                         try:
-                            zipf.extract(file, target_dir)
-                        except Exception:
-                            pass
+                            sender.add_file(
+                                entry.path, entry.arcname, entry.size, entry.mtime_ns
+                            )
+                        except (PermissionError, OSError) as e:
+                            print(f"Skipping {entry.path}: {e}")
+                    sender.drain()
+                    for entry, canonical in refs:
+                        sender.send_ref(entry.arcname, canonical, entry.mtime_ns)
+                result = sender.result
+            events.emit(PHASE, DONE, **result)
 
-                    if progress_callback:
-                        progress_callback(file, i / total)
+            msg = f"Sent {result['files']} files to {host}:{port}"
+            if result["failed"]:
+                msg += f", {len(result['failed'])} failed on the receiver"
+            msg += "\n" + summarize(tracker.snapshot())
+            if dedup is not None:
+                msg += "\n" + dedup.summary()
+            if rules.stats:
+                msg += "\n" + rules.summary()
+            if throttle is not None:
+                msg += "\n" + throttle.summary()
+            return not result["failed"], msg
+        except (OSError, ValueError, TransferError) as e:
+            return False, f"Transfer failed: {e}"
+        finally:
+            if throttle is not None:
+                throttle.stop()
+            self._unwatch(events, subscribers)
 
-            return True, "Batch Restore Complete"
-        except Exception as e:
-            return False, str(e)
+    def receive_batch(self, options=None, progress_callback=None):
+        """
+        Waits for one send_batch connection and writes the profiles it sends
+        below users_dir.
+        options: dict { "port": Int, "host": str, "token": str,
+                        "listener": socket, "events": EventBus,
+                        "event_log": path }
+        Pass an already listening socket as "listener" to pick the port
+        beforehand (port 0 gets a free one). A non-empty "token" is
+        required; the sender has to present the same one.
+        """
+        options = options or {}
+        if not options.get("token"):
+            return False, "A transfer token is required to receive."
+        events, tracker, subscribers = self._watch(options, progress_callback)
+        listener = options.get("listener")
+        try:
+            if listener is None:
+                listener = listen(
+                    options.get("host", ""), options.get("port", DEFAULT_PORT)
+                )
+            receiver = StreamReceiver(self.users_dir, options.get("token", ""), events)
+            events.emit(PHASE, TRANSFER)
+            result = receiver.serve(listener)
+            events.emit(PHASE, DONE, **result)
+            msg = f"Received {result['files']} files into {self.users_dir}"
+            if receiver.failed:
+                msg += f", {len(receiver.failed)} failed"
+            msg += "\n" + summarize(tracker.snapshot())
+            return not receiver.failed, msg
+        except (OSError, TransferError) as e:
+            return False, f"Transfer failed: {e}"
+        finally:
+            if "listener" not in options and listener is not None:
+                listener.close()
+            self._unwatch(events, subscribers)
+
+    def _watch(self, options, progress_callback):
+        """Subscribes a ProgressTracker (plus any callback or log) for one run."""
+        events = options.get("events") or EventBus()
+        tracker = events.subscribe(ProgressTracker())
+        subscribers = [tracker]
+        if progress_callback:
+            subscribers.append(
+                events.subscribe(legacy_callback(tracker, progress_callback))
+            )
+        if options.get("event_log"):
+            subscribers.append(events.subscribe(EventLog(options["event_log"])))
+        return events, tracker, subscribers
+
+    def _unwatch(self, events, subscribers):
+        for subscriber in subscribers:
+            events.unsubscribe(subscriber)
+            if isinstance(subscriber, EventLog):
+                subscriber.close()
+
+    def _throttle(self, options, events):
+        """A running Throttle for the throttling options, or None."""
+        rate = options.get("max_bytes_per_sec")
+        iops = options.get("max_iops")
+        adaptive = options.get("adaptive_workers", False)
+        if not (rate or iops or adaptive):
+            return None
+        throttle = Throttle(
+            rate,
+            iops,
+            adaptive,
+            max_workers=options.get("read_workers") or default_workers(),
+            events=events,
+        )
+        throttle.start()
+        return throttle
+
+    def _reported(self, kind, options, run):
+        """
+        Runs `run(options)` with a RunReport in "run_report", then writes the
+        report next to the archive (or to the "report" path).
+        """
+        events = options.get("events") or EventBus()
+        tracker = events.subscribe(ProgressTracker())
+        report = events.subscribe(
+            RunReport(
+                kind,
+                options.get("profile", False),
+                options.get("trace_memory", False),
+                options,
+            )
+        )
+        report.start()
+        ok, msg = False, None
+        try:
+            ok, msg = run(dict(options, events=events, run_report=report))
+        finally:
+            path = options.get("report")
+            if not isinstance(path, str):
+                path = None
+                if report.archive is not None and os.path.exists(report.archive):
+                    suffix = REPORT_SUFFIX if kind == BACKUP else RESTORE_SUFFIX
+                    path = report.archive + suffix
+            written = path is not None and report.write(
+                path, ok, msg, tracker.snapshot()
+            )
+            report.close()
+            events.unsubscribe(report)
+            events.unsubscribe(tracker)
+        if written:
+            msg += f"\nRun report: {path}"
+        return ok, msg
+
+    def _settings_exporter(self, options):
+        """The exporter for "export_registry"; None where there is no registry."""
+        exporter = options.get("settings_exporter")
+        if exporter is None and self.os_type == "Windows":
+            exporter = RegistryExporter(
+                timeout=options.get("settings_timeout", DEFAULT_TIMEOUT)
+            )
+        return exporter
+
+    def _rules(self, options):
+        """The RuleMatcher for the exclusion options of a backup or send."""
+        rules = options.get("rules")
+        if rules is None:
+            profiles = options.get("exclude_profiles")
+            rules = build_rules(
+                DEFAULT_PROFILES if profiles is None else profiles,
+                options.get("exclude") or (),
+                options.get("max_file_size"),
+                options.get("max_age_days"),
+            )
+        return RuleMatcher(rules)
+
+    def _restore_archive(
+        self, archive_path, index, view, targets, events, options, stats
+    ):
+        self._apply_deletions(view.deleted, targets, events)
+
+        # File format: "Username/Folder/File.ext" or "Username/Registry/file.reg".
+        # Registry files are restored next to the profile data for now
+        # (C:\Users\Username\Registry\...).
+        # TODO: Auto-import logic can be added here
+        resume = options.get("resume", False)
+        journal = RestoreJournal.open(
+            archive_path, self.users_dir, resume, targets.user_map
+        )
+        sync = options.get("sync", False)
+        engine = RestoreEngine(
+            options.get("restore_workers"), resume=resume, events=events, sync=sync
+        )
+        engine.report = options.get("run_report")
+        try:
+            plan = engine.run(
+                archive_path,
+                self.users_dir,
+                None,
+                view.infos,
+                journal,
+                targets,
+                view.mtimes,
+            )
+        finally:
+            if journal is not None:
+                journal.close()
+        for name in plan.rejected:
+            print(f"Skipping unsafe path {name}")
+        for name, e in engine.failed:
+            print(f"Skipping {name}: {e}")
+
+        for state, (n, size) in engine.stats.items():
+            stats[state][0] += n
+            stats[state][1] += size
+        copied, ref_failed, ref_skipped = self._expand_refs(
+            archive_path, index, view, targets, events, sync, stats
+        )
+        if journal is not None and not engine.failed:
+            journal.discard()
+        restored = len(plan) - len(engine.failed) - engine.skipped + copied
+        failed = len(engine.failed) + ref_failed
+        return restored, failed, engine.skipped + ref_skipped
+
+    def _expand_refs(self, archive_path, index, view, targets, events, sync, stats):
+        """
+        Recreates deduplicated files from the member they point to; returns
+        how many were written, failed and left alone as identical.
+        """
+        copied = failed = skipped = 0
+        if not view.refs:
+            return copied, failed, skipped
+        # Only originals restored from this archive are known to be on disk
+        # with the right content; others are read from the archive.
+        restored = {info.filename for info in view.infos}
+        with open(archive_path, "rb") as fp:
+            for arcname, canonical in view.refs.items():
+                # Security: Prevent Zip Slip
+                path = targets.target(arcname)
+                source = targets.target(canonical)
+                if path is None or source is None:
+                    continue
+                mtime_ns = view.mtimes.get(arcname)
+                try:
+                    info = index.getinfo(canonical)
+                    state = None
+                    if sync:
+                        try:
+                            st = os.stat(path)
+                            existing = {path: (st.st_size, st.st_mtime_ns)}
+                        except FileNotFoundError:
+                            existing = {}
+                        state = compare(path, info, mtime_ns, existing)
+                    if state != IDENTICAL:
+                        root = targets.user_root(arcname.partition("/")[0])
+                        if not make_directory(os.path.dirname(path), root):
+                            raise OSError(f"{path} is outside {root}")
+                        if canonical in restored and os.path.isfile(source):
+                            shutil.copyfile(source, path)
+                        else:
+                            with open_member(fp, info) as src, open(path, "wb") as dst:
+                                shutil.copyfileobj(src, dst, 1 << 20)
+                        if mtime_ns is not None:
+                            os.utime(path, ns=(mtime_ns, mtime_ns))
+                        copied += 1
+                    else:
+                        skipped += 1
+                    if state is not None:
+                        stats[state][0] += 1
+                        stats[state][1] += info.file_size
+                except (OSError, KeyError, zipfile.BadZipFile) as e:
+                    failed += 1
+                    print(f"Could not restore {arcname}: {e}")
+                    events.emit(ERROR, arcname, files=0, reason=str(e))
+        return copied, failed, skipped
+
+    def _apply_deletions(self, deleted, targets, events):
+        """Removes files an incremental archive recorded as deleted."""
+        for arcname in deleted:
+            # Security: Prevent Zip Slip
+            path = targets.target(arcname)
+            if path is None:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                print(f"Could not delete {path}: {e}")
+                events.emit(ERROR, arcname, files=0, reason=f"not deleted: {e}")
@@ -0,0 +1,463 @@
+"""
+Benchmark harness for the backup and restore hot paths.
+
+    python -m pymigrate_pro.bench --shape mixed --save results.json
+    python -m pymigrate_pro.bench --shape mixed --baseline results.json
+
+A synthetic profile tree is generated (deterministically, from --seed) under
+a temporary users_dir, then scan, backup, verify and restore are timed one
+after another. Each phase runs in a fresh process so its peak RSS is its
+own. With --baseline, any metric that got worse by more than --tolerance is
+reported and the exit status is 1.
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from multiprocessing import get_context
+
+from .backend import DEFAULT_FOLDERS, MAIL_FOLDERS, ProfileBackend
+from .scanner import ProfileScanner
+from .verify import ArchiveVerifier
+
+MB = 1 << 20
+
+# File counts per kind for each shape, multiplied by --scale.
+#   tiny:  0-4 KB text files spread over the usual folders
+#   large: PST-like mail stores of --large-mb each, half compressible
+#   deep:  small files at the bottom of 32-level directory chains
+#   media: 1-8 MB incompressible photos and videos
+#   dup:   16-256 KB files every user has an identical copy of
+SHAPES = {
+    "tiny": {"tiny": 200_000},
+    "large": {"large": 2},
+    "deep": {"deep": 5_000},
+    "media": {"media": 200},
+    "dup": {"dup": 2_000},
+    "mixed": {"tiny": 20_000, "large": 1, "deep": 1_000, "media": 50, "dup": 500},
+}
+
+PHASES = ("scan", "backup", "verify", "restore")
+
+# Metrics where a bigger number is better; for the rest smaller is better.
+HIGHER_IS_BETTER = frozenset(("files_per_s", "mb_per_s"))
+
+WORDS = (  # noqa: SIM905
+    "profile migration backup restore desktop documents outlook mailbox "
+    "invoice report meeting notes budget draft final summary project"
+).split()
+
+
+# -- synthetic tree ------------------------------------------------------
+
+
+def _text(rng, size):
+    out = []
+    n = 0
+    while n < size:
+        word = rng.choice(WORDS)
+        out.append(word)
+        n += len(word) + 1
+    return " ".join(out)[:size].encode("ascii")
+
+
+def _write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def _write_large(path, size, rng):
+    """Alternates compressible and random 1 MB blocks, like a mail store."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    text = _text(rng, MB)
+    with open(path, "wb") as f:
+        for i in range(0, size, MB):
+            block = text if (i // MB) % 2 == 0 else rng.randbytes(MB)
+            f.write(block[: size - i])
+
+
+def generate_tree(users_dir, shape, scale=1.0, users=4, large_mb=1024, seed=0):
+    """
+    Writes a synthetic profile tree below `users_dir` and returns
+    {"files": n, "bytes": total}. Same arguments, same tree.
+    """
+    rng = random.Random(seed)
+    counts = {k: max(1, int(v * scale)) for k, v in SHAPES[shape].items()}
+    names = [f"user{i:02d}" for i in range(users)]
+    files = total = 0
+
+    def put(path, data):
+        nonlocal files, total
+        _write(path, data)
+        files += 1
+        total += len(data)
+
+    for i in range(counts.get("tiny", 0)):
+        user = names[i % users]
+        folder = DEFAULT_FOLDERS[i % len(DEFAULT_FOLDERS)]
+        sub = f"dir{(i // users) % 97:02d}"
+        put(
+            os.path.join(users_dir, user, folder, sub, f"note{i}.txt"),
+            _text(rng, rng.randint(0, 4096)),
+        )
+
+    for i in range(counts.get("large", 0)):
+        user = names[i % users]
+        path = os.path.join(users_dir, user, "Documents", MAIL_FOLDERS[0])
+        path = os.path.join(path, f"archive{i}.pst")
+        _write_large(path, large_mb * MB, rng)
+        files += 1
+        total += large_mb * MB
+
+    for i in range(counts.get("deep", 0)):
+        user = names[i % users]
+        chain = [f"level{d}" for d in range(32)]
+        put(
+            os.path.join(users_dir, user, "Documents", *chain, f"deep{i}.txt"),
+            _text(rng, rng.randint(100, 2000)),
+        )
+
+    for i in range(counts.get("media", 0)):
+        user = names[i % users]
+        folder, ext = ("Pictures", "jpg") if i % 3 else ("Videos", "mp4")
+        put(
+            os.path.join(users_dir, user, folder, f"media{i}.{ext}"),
+            rng.randbytes(rng.randint(1 * MB, 8 * MB)),
+        )
+
+    for i in range(counts.get("dup", 0)):
+        data = _text(rng, rng.randint(16 << 10, 256 << 10))
+        for user in names:
+            put(os.path.join(users_dir, user, "Downloads", f"shared{i}.txt"), data)
+
+    return {"files": files, "bytes": total}
+
+
+# -- phases --------------------------------------------------------------
+
+
+def peak_rss():
+    """Peak resident set size of this process in bytes, or None."""
+    try:
+        # Linux: unlike ru_maxrss, VmHWM is not inherited across exec, so it
+        # covers only this phase's process.
+        with open("/proc/self/status", "r", encoding="ascii") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        return _peak_rss_windows()
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KB, macOS bytes.
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _peak_rss_windows():
+    try:
+        import ctypes
+        from ctypes import wintypes
+
+        class Counters(ctypes.Structure):
+            _fields_ = [
+                ("cb", wintypes.DWORD),
+                ("PageFaultCount", wintypes.DWORD),
+                ("PeakWorkingSetSize", ctypes.c_size_t),
+                ("WorkingSetSize", ctypes.c_size_t),
+                ("QuotaPeakPagedPoolUsage", ctypes.c_size_t),
+                ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t),
+                ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                ("PagefileUsage", ctypes.c_size_t),
+                ("PeakPagefileUsage", ctypes.c_size_t),
+            ]
+
+        counters = Counters()
+        counters.cb = ctypes.sizeof(counters)
+        ctypes.windll.psapi.GetProcessMemoryInfo(
+            ctypes.windll.kernel32.GetCurrentProcess(),
+            ctypes.byref(counters),
+            counters.cb,
+        )
+        return counters.PeakWorkingSetSize
+    except (AttributeError, OSError):
+        return None
+
+
+def _selection(users_dir):
+    backend = ProfileBackend()
+    backend.users_dir = users_dir
+    folders = DEFAULT_FOLDERS + MAIL_FOLDERS
+    return backend, {user: folders for user in backend.get_users()}
+
+
+def _run_phase(phase, work_dir, options):
+    """Runs one phase in this process and returns its raw measurements."""
+    users_dir = os.path.join(work_dir, "users")
+    out_dir = os.path.join(work_dir, "out")
+    result = {}
+    start = time.perf_counter()
+    if phase == "scan":
+        backend, selection = _selection(users_dir)
+        roots = []
+        for user, folders in selection.items():
+            roots.extend(backend.scan_roots(user, folders))
+        manifest = ProfileScanner(options.get("scan_workers")).scan(roots)
+        result.update(files=len(manifest), bytes=manifest.total_bytes)
+    elif phase == "backup":
+        backend, selection = _selection(users_dir)
+        ok, msg = backend.create_batch_backup(selection, out_dir, dict(options))
+        if not ok:
+            raise RuntimeError(msg)
+    elif phase == "verify":
+        (archive,) = os.listdir(out_dir)
+        path = os.path.join(out_dir, archive)
+        report = ArchiveVerifier(options.get("restore_workers")).verify(path)
+        if report["error"] or report["corrupt"] or report["missing"]:
+            raise RuntimeError(f"Verification failed: {report}")
+        result.update(files=report["checked"], bytes=report["checked_bytes"])
+    elif phase == "restore":
+        (archive,) = os.listdir(out_dir)
+        backend = ProfileBackend()
+        backend.users_dir = os.path.join(work_dir, "restored")
+        os.makedirs(backend.users_dir, exist_ok=True)
+        ok, msg = backend.restore_batch_backup(
+            os.path.join(out_dir, archive), {}, options=dict(options)
+        )
+        if not ok:
+            raise RuntimeError(msg)
+    result["seconds"] = time.perf_counter() - start
+    result["peak_rss"] = peak_rss()
+    return result
+
+
+def _phase_child(phase, work_dir, options, queue):
+    try:
+        queue.put(("ok", _run_phase(phase, work_dir, options)))
+    except BaseException as e:  # noqa: BLE001
+        queue.put(("error", f"{type(e).__name__}: {e}"))
+
+
+def run_phase(phase, work_dir, options):
+    """Runs one phase in a fresh process so RSS and caches start clean."""
+    ctx = get_context("spawn")
+    queue = ctx.Queue()
+    proc = ctx.Process(target=_phase_child, args=(phase, work_dir, options, queue))
+    proc.start()
+    status, value = queue.get()
+    proc.join()
+    if status != "ok":
+        raise RuntimeError(f"{phase} failed: {value}")
+    return value
+
+
+def cold_start(runs=7):
+    """Median wall time of `python -m pymigrate_pro -h` in a new interpreter."""
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(
+            [sys.executable, "-m", "pymigrate_pro", "-h"],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            check=True,
+        )
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def run_benchmark(
+    shape, scale=1.0, users=4, large_mb=1024, seed=0, options=None, repeat=1
+):
+    """
+    Generates a tree, times every phase and returns the results dict. With
+    `repeat` > 1 the phases run that many times; times are the median and
+    RSS the maximum.
+    """
+    options = options or {}
+    work_dir = tempfile.mkdtemp(prefix="pmig-bench-")
+    try:
+        users_dir = os.path.join(work_dir, "users")
+        start = time.perf_counter()
+        tree = generate_tree(users_dir, shape, scale, users, large_mb, seed)
+        generated = time.perf_counter() - start
+
+        runs = {phase: [] for phase in PHASES}
+        for _ in range(max(1, repeat)):
+            for leftover in ("out", "restored"):
+                shutil.rmtree(os.path.join(work_dir, leftover), ignore_errors=True)
+            os.makedirs(os.path.join(work_dir, "out"))
+            for phase in PHASES:
+                runs[phase].append(run_phase(phase, work_dir, options))
+
+        phases = {}
+        for phase, raws in runs.items():
+            files = raws[0].get("files", tree["files"])
+            size = raws[0].get("bytes", tree["bytes"])
+            seconds = max(statistics.median(r["seconds"] for r in raws), 1e-6)
+            rss = [r["peak_rss"] for r in raws if r["peak_rss"]]
+            phases[phase] = {
+                "seconds": round(seconds, 4),
+                "files_per_s": round(files / seconds, 1),
+                "mb_per_s": round(size / MB / seconds, 2),
+                "peak_rss_mb": round(max(rss) / MB, 1) if rss else None,
+            }
+        (archive,) = os.listdir(os.path.join(work_dir, "out"))
+        archive_bytes = os.path.getsize(os.path.join(work_dir, "out", archive))
+        phases["backup"]["archive_ratio"] = round(
+            archive_bytes / max(tree["bytes"], 1), 4
+        )
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    return {
+        "shape": shape,
+        "scale": scale,
+        "users": users,
+        "large_mb": large_mb,
+        "seed": seed,
+        "repeat": repeat,
+        "options": options,
+        "tree": dict(tree, generate_seconds=round(generated, 2)),
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+        },
+        "phases": phases,
+        "startup_seconds": round(cold_start(), 4),
+    }
+
+
+def compare(results, baseline, tolerance=0.15):
+    """
+    Lists metrics that regressed by more than `tolerance` (a fraction)
+    against `baseline`, as human-readable strings.
+    """
+    regressions = []
+    pairs = [
+        (f"{phase}.{metric}", value, baseline.get("phases", {}).get(phase, {}))
+        for phase, metrics in results["phases"].items()
+        for metric, value in metrics.items()
+    ]
+    pairs.append(("startup_seconds", results["startup_seconds"], baseline))
+    for name, value, base_metrics in pairs:
+        base = base_metrics.get(name.rsplit(".", 1)[-1])
+        if value is None or not base:
+            continue
+        if name.rsplit(".", 1)[-1] in HIGHER_IS_BETTER:
+            worse = value < base * (1 - tolerance)
+        else:
+            worse = value > base * (1 + tolerance)
+        if worse:
+            regressions.append(f"{name}: {value} (baseline {base})")
+    return regressions
+
+
+def format_results(results):
+    lines = [
+        (
+            f"Shape {results['shape']} x{results['scale']}: "
+            f"{results['tree']['files']} files, "
+            f"{results['tree']['bytes'] / MB:.1f} MB"
+        )
+    ]
+    for phase, m in results["phases"].items():
+        line = (
+            f"  {phase:<8}{m['seconds']:>9.2f} s {m['files_per_s']:>11.0f} files/s "
+            f"{m['mb_per_s']:>9.1f} MB/s"
+        )
+        if m["peak_rss_mb"] is not None:
+            line += f" {m['peak_rss_mb']:>8.1f} MB RSS"
+        if "archive_ratio" in m:
+            line += f"  ratio {m['archive_ratio']:.3f}"
+        lines.append(line)
+    lines.append(f"  startup {results['startup_seconds'] * 1000:.0f} ms")
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m pymigrate_pro.bench",
+        description="Time scan/backup/verify/restore on a synthetic profile tree.",
+    )
+    parser.add_argument("--shape", choices=sorted(SHAPES), default="mixed")
+    parser.add_argument("--scale", type=float, default=1.0, help="File count factor")
+    parser.add_argument("--users", type=int, default=4)
+    parser.add_argument("--large-mb", type=int, default=1024, help="PST file size")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, help="Worker count for every stage")
+    parser.add_argument("--codec", help="Backup codec, e.g. zstd or auto")
+    parser.add_argument(
+        "--repeat", type=int, default=1, help="Runs per phase; the median is kept"
+    )
+    parser.add_argument("--save", help="Write results as JSON to this file")
+    parser.add_argument("--baseline", help="Compare against a saved results file")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.15,
+        help="Allowed slowdown before a metric counts as a regression",
+    )
+    parser.add_argument(
+        "--startup-budget",
+        type=float,
+        default=0.25,
+        help="Max seconds for a cold `python -m pymigrate_pro -h`",
+    )
+    args = parser.parse_args(argv)
+
+    options = {}
+    if args.workers:
+        for key in (
+            "scan_workers",
+            "read_workers",
+            "compress_workers",
+            "restore_workers",
+        ):
+            options[key] = args.workers
+    if args.codec:
+        options["codec"] = args.codec
+
+    results = run_benchmark(
+        args.shape,
+        args.scale,
+        args.users,
+        args.large_mb,
+        args.seed,
+        options,
+        args.repeat,
+    )
+    print(format_results(results))
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+    problems = []
+    if results["startup_seconds"] > args.startup_budget:
+        problems.append(
+            f"startup_seconds: {results['startup_seconds']} "
+            f"(budget {args.startup_budget})"
+        )
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            problems.extend(compare(results, json.load(f), args.tolerance))
+    for problem in problems:
+        print(f"REGRESSION {problem}")
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,576 @@
+import argparse
+import json
+import secrets
+import sys
+import threading
+import zipfile
+
+from .backend import DEFAULT_FOLDERS, MAIL_FOLDERS, ProfileBackend
+from .codec import AUTO, available_codecs, get_codec, stdlib_readable
+from .estimator import SizeEstimator, preflight, record_history, total
+from .events import (
+    DONE,
+    ERROR,
+    PHASE,
+    SKIP,
+    EventBus,
+    ProgressTracker,
+    describe,
+    format_bytes,
+    format_duration,
+)
+from .manifest import is_batch, resolve_batch, resolve_chain
+from .rules import DEFAULT_PROFILES, PROFILES
+from .scheduler import BatchScheduler
+from .transfer import DEFAULT_PORT
+from .verify import ArchiveVerifier, write_report
+
+# Nothing in this module (or anything it imports) may pull in the GUI stack:
+# customtkinter/Tk are only imported when the "gui" command runs.
+
+
+class ConsoleProgress:
+    """Subscriber printing a progress line to stderr at most every `interval`s."""
+
+    def __init__(self, tracker, stream=None, interval=1.0):
+        self.tracker = tracker
+        self.stream = stream or sys.stderr
+        self.interval = interval
+        self.tty = self.stream.isatty()
+        self._last = 0.0
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        if event.kind in (SKIP, ERROR):
+            reason = event.detail.get("reason", "")
+            self._write(f"Skipped {event.name}: {reason}", newline=True)
+        elif event.time - self._last >= self.interval:
+            with self._lock:
+                if event.time - self._last < self.interval:
+                    return  # another thread just drew it
+                self._last = event.time
+            self._write(describe(self.tracker.snapshot()), newline=not self.tty)
+
+    def _write(self, text, newline):
+        if self.tty:
+            text = "\r\033[K" + text
+        with self._lock:
+            self.stream.write(text + ("\n" if newline else ""))
+            self.stream.flush()
+
+    def close(self):
+        if self.tty:
+            self.stream.write("\n")
+
+
+def build_parser():
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument(
+        "--users-dir",
+        help="Profiles root to back up from / restore to "
+        "(default: C:\\Users or /home)",
+    )
+    common.add_argument(
+        "--format",
+        choices=("text", "json"),
+        default="text",
+        help="Result format on stdout (default: text)",
+    )
+    common.add_argument(
+        "-q", "--quiet", action="store_true", help="No progress on stderr"
+    )
+    common.add_argument("--event-log", help="Append all events to this file (JSONL)")
+
+    excludes = argparse.ArgumentParser(add_help=False)
+    excludes.add_argument(
+        "-x",
+        "--exclude",
+        nargs="+",
+        metavar="PATTERN",
+        help="Leave out matching files, or folders if the pattern ends in '/'",
+    )
+    excludes.add_argument(
+        "--exclude-profiles",
+        nargs="*",
+        metavar="NAME",
+        help=f"Built-in exclusions to apply (default: {' '.join(DEFAULT_PROFILES)}; "
+        f"available: {' '.join(PROFILES)}); give none to back up everything",
+    )
+    excludes.add_argument(
+        "--max-file-size", type=float, metavar="MB", help="Leave out bigger files"
+    )
+    excludes.add_argument(
+        "--max-age",
+        type=float,
+        metavar="DAYS",
+        help="Leave out files not modified for this long",
+    )
+
+    throttling = argparse.ArgumentParser(add_help=False)
+    throttling.add_argument(
+        "--limit-rate", type=float, metavar="MB", help="Read at most MB per second"
+    )
+    throttling.add_argument(
+        "--limit-iops", type=int, metavar="N", help="At most N reads per second"
+    )
+    throttling.add_argument(
+        "--adaptive",
+        action="store_true",
+        help="Use fewer readers while other programs are busy with the disk",
+    )
+    throttling.add_argument(
+        "--low-priority", action="store_true", help="Run at low CPU and I/O priority"
+    )
+
+    instrument = argparse.ArgumentParser(add_help=False)
+    instrument.add_argument(
+        "--run-report",
+        nargs="?",
+        const=True,
+        metavar="PATH",
+        help="Record phase timings, the slowest and all skipped files as JSON "
+        "(default: next to the archive)",
+    )
+    instrument.add_argument(
+        "--profile", action="store_true", help="Add a cProfile summary to the report"
+    )
+    instrument.add_argument(
+        "--trace-memory",
+        action="store_true",
+        help="Add a tracemalloc summary to the report",
+    )
+
+    parser = argparse.ArgumentParser(
+        prog="pymigrate_pro",
+        description="Back up and restore user profiles. Without a command the "
+        "GUI is started.",
+    )
+    sub = parser.add_subparsers(dest="command")
+
+    sub.add_parser("gui", help="Start the graphical interface")
+
+    p = sub.add_parser(
+        "backup",
+        parents=[common, excludes, throttling, instrument],
+        help="Create a batch backup archive",
+    )
+    p.add_argument("dest", help="Folder to write the .pmig archive to")
+    p.add_argument(
+        "-u", "--users", nargs="+", help="Users to back up (default: all profiles)"
+    )
+    p.add_argument(
+        "-f",
+        "--folders",
+        nargs="+",
+        help=f"Folders per user (default: {' '.join(DEFAULT_FOLDERS)})",
+    )
+    p.add_argument(
+        "--mail", action="store_true", help="Add " + " and ".join(MAIL_FOLDERS)
+    )
+    p.add_argument("--registry", action="store_true", help="Export registry settings")
+    p.add_argument("--base", help="Write an incremental backup on top of this archive")
+    p.add_argument("--resume", help="Continue an interrupted backup archive")
+    p.add_argument("--no-dedup", action="store_true", help="Store duplicates as-is")
+    p.add_argument(
+        "--no-smart-compression",
+        action="store_true",
+        help="Deflate every member instead of choosing per file",
+    )
+    p.add_argument(
+        "--codec",
+        help="Compression as NAME[:LEVEL], or 'auto' to pick by measured "
+        f"disk speeds (available: {', '.join(available_codecs())}); zstd "
+        "archives can only be restored with this tool",
+    )
+    p.add_argument("--scan-workers", type=int)
+    p.add_argument("--read-workers", type=int)
+    p.add_argument("--compress-workers", type=int)
+    p.add_argument(
+        "--shard-users",
+        action="store_true",
+        help="Write one archive per user plus a .pmigbatch manifest",
+    )
+    p.add_argument(
+        "--jobs", type=int, help="Users backed up at once with --shard-users"
+    )
+
+    p = sub.add_parser(
+        "restore",
+        parents=[common, instrument],
+        help="Restore an archive (and its bases)",
+    )
+    p.add_argument(
+        "archives", nargs="+", help="Archive or .pmigbatch, or archives in order"
+    )
+    p.add_argument("--resume", action="store_true", help="Skip files already restored")
+    p.add_argument(
+        "--sync",
+        action="store_true",
+        help="Only write files that differ from what is already on disk",
+    )
+    p.add_argument(
+        "-s",
+        "--select",
+        nargs="+",
+        metavar="PATTERN",
+        help="Only restore matching files, e.g. 'alice/Documents/Projects/**'",
+    )
+    p.add_argument(
+        "--map",
+        action="append",
+        default=[],
+        metavar="USER=TARGET",
+        help="Restore USER into another user's profile, or into a folder "
+        "if TARGET is an absolute path (repeatable)",
+    )
+    p.add_argument("--restore-workers", type=int)
+
+    p = sub.add_parser(
+        "verify", parents=[common], help="Check archive CRCs and content hashes"
+    )
+    p.add_argument("archive")
+    p.add_argument("--chain", action="store_true", help="Also verify base archives")
+    p.add_argument(
+        "--sample",
+        type=float,
+        metavar="FRACTION",
+        help="Only spot-check this share of the files, e.g. 0.05",
+    )
+    p.add_argument("--seed", type=int, help="Random seed for --sample")
+    p.add_argument("--report", help="Also write the JSON report to this file")
+    p.add_argument("--verify-workers", type=int)
+
+    p = sub.add_parser(
+        "scan",
+        parents=[common],
+        help="Estimate files and bytes per user (cached between runs)",
+    )
+    p.add_argument("-u", "--users", nargs="+")
+    p.add_argument("-f", "--folders", nargs="+")
+    p.add_argument("--mail", action="store_true")
+    p.add_argument("--scan-workers", type=int)
+    p.add_argument("--dest", help="Check free space and duration for this target")
+
+    p = sub.add_parser(
+        "send",
+        parents=[common, excludes, throttling],
+        help="Stream profiles straight to a machine running 'receive'",
+    )
+    p.add_argument("address", help="Receiver as HOST[:PORT]")
+    p.add_argument("-u", "--users", nargs="+")
+    p.add_argument("-f", "--folders", nargs="+")
+    p.add_argument("--mail", action="store_true")
+    p.add_argument(
+        "--token", required=True, help="Shared secret the receiver printed or expects"
+    )
+    p.add_argument(
+        "--level", type=int, default=1, help="Deflate level on the wire (default: 1)"
+    )
+    p.add_argument("--codec", help="Compression as NAME[:LEVEL] instead of deflate")
+    p.add_argument("--no-dedup", action="store_true")
+    p.add_argument("--scan-workers", type=int)
+    p.add_argument("--read-workers", type=int)
+    p.add_argument("--compress-workers", type=int)
+
+    p = sub.add_parser(
+        "receive",
+        parents=[common],
+        help="Wait for one 'send' and write its profiles to --users-dir",
+    )
+    p.add_argument("--host", default="", help="Address to listen on (default: all)")
+    p.add_argument("--port", type=int, default=DEFAULT_PORT)
+    p.add_argument(
+        "--token", help="Shared secret the sender must use (default: a random one)"
+    )
+
+    return parser
+
+
+def _selection(backend, args):
+    """User -> folders map from --users/--folders/--mail."""
+    users = args.users or backend.get_users()
+    folders = list(args.folders or DEFAULT_FOLDERS)
+    if args.mail:
+        folders.extend(MAIL_FOLDERS)
+    return {user: folders for user in users}
+
+
+def _excludes(args):
+    """Exclusion options from --exclude/--exclude-profiles/--max-*."""
+    max_size = args.max_file_size
+    return {
+        "exclude": args.exclude,
+        "exclude_profiles": args.exclude_profiles,
+        "max_file_size": int(max_size * 1048576) if max_size is not None else None,
+        "max_age_days": args.max_age,
+    }
+
+
+def _throttling(args):
+    """Throttling options from --limit-*/--adaptive/--low-priority."""
+    rate = args.limit_rate
+    return {
+        "max_bytes_per_sec": int(rate * 1048576) if rate else None,
+        "max_iops": args.limit_iops,
+        "adaptive_workers": args.adaptive,
+        "low_priority": args.low_priority,
+    }
+
+
+def _instrumentation(args):
+    """Run report options from --run-report/--profile/--trace-memory."""
+    return {
+        "report": args.run_report,
+        "profile": args.profile,
+        "trace_memory": args.trace_memory,
+    }
+
+
+def _warn_codec(spec):
+    """Warns on stderr if archives written with `spec` need this tool."""
+    if not spec or spec == AUTO:
+        return
+    try:
+        codec = get_codec(spec)
+    except ValueError:
+        return  # reported by the backup itself
+    if not stdlib_readable(codec):
+        print(
+            f"Warning: {codec.name} archives are not standard ZIP; only "
+            "pymigrate_pro can restore them.",
+            file=sys.stderr,
+        )
+
+
+def _run(args, job):
+    """Runs `job(events)` with progress on stderr; returns (ok, msg, result)."""
+    events = EventBus()
+    tracker = events.subscribe(ProgressTracker())
+    result = {}
+
+    def on_done(event):
+        if event.kind == PHASE and event.name == DONE:
+            result.update(event.detail)
+
+    events.subscribe(on_done)
+    console = None
+    if not args.quiet:
+        console = events.subscribe(ConsoleProgress(tracker))
+    try:
+        ok, msg = job(events)
+    finally:
+        if console is not None:
+            console.close()
+    progress = tracker.snapshot()
+    result.update(
+        files=progress.files_done,
+        bytes=progress.bytes_done,
+        bytes_written=progress.bytes_written,
+        seconds=round(progress.elapsed, 3),
+    )
+    return ok, msg, result
+
+
+def cmd_backup(backend, args):
+    selection = _selection(backend, args)
+    if not selection:
+        return False, "No user profiles found.", {}
+    _warn_codec(args.codec)
+    options = {
+        "export_registry": args.registry,
+        "base_archive": args.base,
+        "resume": args.resume,
+        "dedup": not args.no_dedup,
+        "smart_compression": not args.no_smart_compression,
+        "codec": args.codec,
+        "scan_workers": args.scan_workers,
+        "read_workers": args.read_workers,
+        "compress_workers": args.compress_workers,
+        "event_log": args.event_log,
+        **_excludes(args),
+        **_throttling(args),
+        **_instrumentation(args),
+    }
+    if args.shard_users:
+        scheduler = BatchScheduler(backend, args.jobs)
+        job = scheduler.run
+    else:
+        job = backend.create_batch_backup
+    ok, msg, result = _run(
+        args, lambda events: job(selection, args.dest, dict(options, events=events))
+    )
+    if ok:
+        record_history(result["bytes"], result["seconds"], result["bytes_written"])
+    return ok, msg, result
+
+
+def cmd_restore(backend, args):
+    archives = args.archives[0] if len(args.archives) == 1 else args.archives
+    user_map = {}
+    for item in args.map:
+        user, sep, target = item.partition("=")
+        if not sep or not user or not target:
+            return False, f"--map expects USER=TARGET, got {item!r}", {}
+        user_map[user] = target
+    options = {
+        "resume": args.resume,
+        "sync": args.sync,
+        "select": args.select,
+        "restore_workers": args.restore_workers,
+        "event_log": args.event_log,
+        **_instrumentation(args),
+    }
+    return _run(
+        args,
+        lambda events: backend.restore_batch_backup(
+            archives, user_map, options=dict(options, events=events)
+        ),
+    )
+
+
+def cmd_verify(backend, args):
+    try:
+        # Each shard of a batch is its own chain.
+        if is_batch(args.archive):
+            chains = [chain for _, chain in resolve_batch(args.archive)]
+        else:
+            chains = [resolve_chain(args.archive)]
+        if not args.chain:
+            chains = [chain[-1:] for chain in chains]
+        verifier = ArchiveVerifier(args.verify_workers, args.sample, args.seed)
+    except (OSError, ValueError, zipfile.BadZipFile) as e:
+        return False, str(e), {}
+    report = {}
+
+    def job(events):
+        verifier.events = events
+        reports = [verifier.verify_chain(chain) for chain in chains]
+        report["ok"] = all(r["ok"] for r in reports)
+        report["archives"] = [a for r in reports for a in r["archives"]]
+        return report["ok"], None
+
+    ok, _, result = _run(args, job)
+    result.update(report)
+    if args.report:
+        write_report(report, args.report)
+    lines = []
+    for r in report["archives"]:
+        checked = f"{r['checked']} of {r['members']}" if r["sampled"] else r["checked"]
+        line = f"{r['archive']}: {checked} files checked, {r['hashed']} hashed"
+        if r["error"]:
+            line = f"{r['archive']}: {r['error']}"
+        lines.append(line)
+        lines.extend(f"  corrupt: {c['name']} ({c['reason']})" for c in r["corrupt"])
+        lines.extend(f"  missing: {name}" for name in r["missing"])
+    count = len(report["archives"])
+    lines.append(f"{count} archive(s) OK" if ok else "Verification failed")
+    return ok, "\n".join(lines), result
+
+
+def cmd_send(backend, args):
+    selection = _selection(backend, args)
+    if not selection:
+        return False, "No user profiles found.", {}
+    options = {
+        "token": args.token,
+        "compress_level": args.level,
+        "codec": args.codec,
+        "dedup": not args.no_dedup,
+        "scan_workers": args.scan_workers,
+        "read_workers": args.read_workers,
+        "compress_workers": args.compress_workers,
+        "event_log": args.event_log,
+        **_excludes(args),
+        **_throttling(args),
+    }
+    return _run(
+        args,
+        lambda events: backend.send_batch(
+            selection, args.address, dict(options, events=events)
+        ),
+    )
+
+
+def cmd_receive(backend, args):
+    token = args.token or secrets.token_urlsafe(12)
+    options = {
+        "host": args.host,
+        "port": args.port,
+        "token": token,
+        "event_log": args.event_log,
+    }
+    if not args.token:
+        # Printed even with --quiet: the sender cannot connect without it.
+        print(f"Transfer token: {token}", file=sys.stderr)
+    if not args.quiet:
+        print(f"Waiting for a sender on port {args.port}", file=sys.stderr)
+    return _run(
+        args,
+        lambda events: backend.receive_batch(dict(options, events=events)),
+    )
+
+
+def cmd_scan(backend, args):
+    roots = {
+        user: backend.scan_roots(user, folders)
+        for user, folders in _selection(backend, args).items()
+    }
+    estimator = SizeEstimator(workers=args.scan_workers)
+    estimates = estimator.estimate([r for rs in roots.values() for r in rs])
+    users = {}
+    lines = []
+    for user, user_roots in roots.items():
+        est = total(estimates, user_roots)
+        users[user] = {"files": est.files, "bytes": est.bytes}
+        lines.append(f"{user}: {est.files} files, {format_bytes(est.bytes)}")
+    if not lines:
+        return True, "No user profiles found.", {"users": users}
+    result = {"users": users, "cached_dirs": estimator.reused}
+
+    if args.dest:
+        size = sum(u["bytes"] for u in users.values())
+        try:
+            check = preflight(size, args.dest)
+        except OSError as e:
+            lines.append(f"Cannot check free space at {args.dest}: {e}")
+            return False, "\n".join(lines), result
+        result["preflight"] = check._asdict()
+        lines.append(
+            f"Needs about {format_bytes(check.required)}, "
+            f"{format_bytes(check.free)} free at {args.dest}"
+        )
+        if check.seconds is not None:
+            lines.append(f"Expected duration: {format_duration(check.seconds)}")
+        if not check.enough:
+            lines.append("Not enough free space.")
+            return False, "\n".join(lines), result
+    return True, "\n".join(lines), result
+
+
+COMMANDS = {
+    "backup": cmd_backup,
+    "restore": cmd_restore,
+    "verify": cmd_verify,
+    "scan": cmd_scan,
+    "send": cmd_send,
+    "receive": cmd_receive,
+}
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.command in (None, "gui"):
+        from .app import PyMigrateApp
+
+        PyMigrateApp().mainloop()
+        return 0
+
+    backend = ProfileBackend()
+    if args.users_dir:
+        backend.users_dir = args.users_dir
+    ok, msg, result = COMMANDS[args.command](backend, args)
+    if args.format == "json":
+        print(json.dumps(dict(result, ok=ok, message=msg), indent=2))
+    else:
+        print(msg)
+    return 0 if ok else 1
@@ -0,0 +1,442 @@
+import bz2
+import lzma
+import os
+import threading
+import time
+import zipfile
+import zlib
+
+try:
+    import zstandard
+except ImportError:  # optional, see Codec.available
+    zstandard = None
+
+# Compression method numbers from the zip specification (APPNOTE 4.4.5).
+ZIP_ZSTANDARD = 93
+# The methods zipfile can extract.
+_STDLIB_METHODS = (
+    zipfile.ZIP_STORED,
+    zipfile.ZIP_DEFLATED,
+    zipfile.ZIP_BZIP2,
+    zipfile.ZIP_LZMA,
+)
+
+# What decompressors raise for damaged data. bz2 raises a plain OSError
+# (without an errno), which callers have to tell from real I/O errors.
+DECOMPRESS_ERRORS = (zlib.error, lzma.LZMAError)
+if zstandard is not None:
+    DECOMPRESS_ERRORS += (zstandard.ZstdError,)
+
+# Deflate back-references reach this far, so a chunk's dictionary is the
+# tail of the previous chunk.
+DICT_SIZE = 1 << 15
+
+
+class Codec:
+    """
+    One compression method at one level.
+
+    `parallel` codecs compress every chunk of a member on its own and the
+    outputs concatenate into one valid stream, so a large file can be spread
+    over the whole pool. The others keep state across chunks and compress a
+    member's chunks one after another (different members still run in
+    parallel).
+    """
+
+    name = None
+    method = None
+    version = 20  # "version needed to extract" for the zip headers
+    flags = 0
+    parallel = False
+    uses_dict = False
+    default_level = None
+
+    def __init__(self, level=None):
+        self.level = self.default_level if level is None else level
+
+    def __repr__(self):
+        return self.label
+
+    def __eq__(self, other):
+        return isinstance(other, Codec) and self.label == other.label
+
+    def __hash__(self):
+        return hash(self.label)
+
+    @property
+    def label(self):
+        if self.level is None:
+            return self.name
+        return f"{self.name}:{self.level}"
+
+    @classmethod
+    def available(cls):
+        return True
+
+    def compress_chunk(self, data, zdict, final):
+        """Compresses one chunk independently (parallel codecs only)."""
+        raise NotImplementedError
+
+    def compressor(self):
+        """A fresh object with compress(data) and flush()."""
+        raise NotImplementedError
+
+    def decompressor(self):
+        """A fresh object with decompress(data) and flush()."""
+        raise NotImplementedError
+
+
+class StoredCodec(Codec):
+    name = "stored"
+    method = zipfile.ZIP_STORED
+    version = 10
+    parallel = True
+
+    def compress_chunk(self, data, zdict, final):
+        return data
+
+    def compressor(self):
+        return _Passthrough()
+
+    def decompressor(self):
+        return _Passthrough()
+
+
+class DeflateCodec(Codec):
+    name = "deflate"
+    method = zipfile.ZIP_DEFLATED
+    parallel = True
+    uses_dict = True
+    default_level = 6
+
+    def compress_chunk(self, data, zdict, final):
+        """
+        Non-final chunks end with a sync flush, and each is primed with the
+        tail of the previous one, so the outputs of all chunks form a single
+        raw deflate stream that compresses almost as well as a serial one.
+        """
+        if zdict:
+            c = zlib.compressobj(self.level, zlib.DEFLATED, -15, zdict=zdict)
+        else:
+            c = zlib.compressobj(self.level, zlib.DEFLATED, -15)
+        out = c.compress(data)
+        return out + c.flush(zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH)
+
+    def compressor(self):
+        return zlib.compressobj(self.level, zlib.DEFLATED, -15)
+
+    def decompressor(self):
+        return zlib.decompressobj(-15)
+
+
+class Bzip2Codec(Codec):
+    name = "bzip2"
+    method = zipfile.ZIP_BZIP2
+    version = 46
+    default_level = 9
+
+    def compressor(self):
+        return bz2.BZ2Compressor(self.level)
+
+    def decompressor(self):
+        return _Flushless(bz2.BZ2Decompressor())
+
+
+class LzmaCodec(Codec):
+    """LZMA in the zip flavour (zipfile's properties header, EOS marker)."""
+
+    name = "lzma"
+    method = zipfile.ZIP_LZMA
+    version = 63
+    flags = 0x02
+
+    def compressor(self):
+        return zipfile.LZMACompressor()
+
+    def decompressor(self):
+        return _Flushless(zipfile.LZMADecompressor())
+
+
+class ZstdCodec(Codec):
+    """
+    Zstandard, if the zstandard package is installed. Chunks become
+    independent frames, which a reader decodes as one stream. zipfile
+    cannot read method 93, so such archives need this tool to restore.
+    """
+
+    name = "zstd"
+    method = ZIP_ZSTANDARD
+    version = 63
+    parallel = True
+    default_level = 3
+
+    def __init__(self, level=None):
+        super().__init__(level)
+        self._local = threading.local()
+
+    @classmethod
+    def available(cls):
+        return zstandard is not None
+
+    def compress_chunk(self, data, zdict, final):
+        # Compressor contexts are reusable but not thread-safe.
+        c = getattr(self._local, "c", None)
+        if c is None:
+            c = self._local.c = zstandard.ZstdCompressor(level=self.level)
+        return c.compress(data)
+
+    def compressor(self):
+        return zstandard.ZstdCompressor(level=self.level).compressobj()
+
+    def decompressor(self):
+        obj = zstandard.ZstdDecompressor().decompressobj(read_across_frames=True)
+        return _Flushless(obj)
+
+
+class _Passthrough:
+    def compress(self, data):
+        return data
+
+    decompress = compress
+
+    def flush(self):
+        return b""
+
+
+class _Flushless:
+    """Gives decompressors that have no flush() one."""
+
+    def __init__(self, obj):
+        self._obj = obj
+
+    def decompress(self, data):
+        return self._obj.decompress(data)
+
+    def flush(self):
+        return b""
+
+
+CODECS = {
+    cls.name: cls
+    for cls in (StoredCodec, DeflateCodec, Bzip2Codec, LzmaCodec, ZstdCodec)
+}
+_BY_METHOD = {cls.method: cls for cls in CODECS.values()}
+
+
+def get_codec(spec):
+    """
+    Parses "name" or "name:level" (e.g. "deflate:9", "zstd", "stored").
+    Raises ValueError for unknown or unavailable codecs.
+    """
+    if isinstance(spec, Codec):
+        return spec
+    name, _, level = spec.partition(":")
+    cls = CODECS.get(name.lower())
+    if cls is None:
+        raise ValueError(f"Unknown codec {name!r} (choose from {', '.join(CODECS)})")
+    if not cls.available():
+        raise ValueError(f"Codec {name!r} needs an optional package that is missing")
+    return cls(int(level) if level else None)
+
+
+def for_method(method, level=None):
+    """The codec writing zip compression method `method`, or ValueError."""
+    cls = _BY_METHOD.get(method)
+    if cls is None or not cls.available():
+        raise ValueError(f"Unsupported compression method {method}")
+    return cls(level)
+
+
+def available_codecs():
+    return [name for name, cls in CODECS.items() if cls.available()]
+
+
+def version_needed(method):
+    cls = _BY_METHOD.get(method)
+    return cls.version if cls is not None else 20
+
+
+# -- automatic selection ---------------------------------------------------
+
+AUTO = "auto"
+
+
+def auto_candidates():
+    """
+    Codecs the auto mode chooses between, cheapest first. All of them are
+    methods zipfile can read; zstd is never picked automatically, since
+    its archives can only be restored with this tool.
+    """
+    return [
+        DeflateCodec(1),
+        DeflateCodec(6),
+        DeflateCodec(9),
+        Bzip2Codec(9),
+        LzmaCodec(),
+    ]
+
+
+def stdlib_readable(codec):
+    """True if zipfile can extract members written with `codec`."""
+    return codec.method in _STDLIB_METHODS
+
+
+def probe_write_speed(directory, size=16 << 20, block=1 << 20):
+    """
+    Writes and fsyncs `size` bytes in `directory` and returns bytes per
+    second. The data is random so compressing file systems cannot cheat.
+    """
+    path = os.path.join(directory, f".pmig-probe-{os.getpid()}")
+    data = os.urandom(block)
+    start = time.perf_counter()
+    try:
+        with open(path, "wb") as f:
+            f.writelines(data for _ in range(max(1, size // block)))
+            f.flush()
+            os.fsync(f.fileno())
+        return size / max(time.perf_counter() - start, 1e-6)
+    finally:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+class AutoCodec:
+    """
+    Picks the codec that should move data fastest end to end.
+
+    For the first `window` seconds the archive compresses with `initial`
+    while this object collects samples of compressible file heads and times
+    source reads. It then measures each candidate's speed (per core) and
+    ratio on the samples and picks the one maximising
+
+        min(read speed, codec speed * workers, write speed / ratio)
+
+    preferring the smaller output among codecs within `slack` of the best.
+    A slow USB target thus gets a stronger codec, a fast SSD a cheaper one.
+    `choice` holds the decision, with the measured numbers in `stats`.
+    """
+
+    def __init__(
+        self,
+        write_speed=None,
+        workers=None,
+        readers=None,
+        candidates=None,
+        initial=None,
+        window=2.0,
+        sample_size=4 << 20,
+        budget=0.25,
+        slack=0.05,
+    ):
+        self.write_speed = write_speed
+        self.workers = max(1, workers or os.cpu_count() or 1)
+        self.readers = max(1, readers or 1)
+        self.candidates = candidates or auto_candidates()
+        self.codec = initial or DeflateCodec(1)
+        self.window = window
+        self.sample_size = sample_size
+        self.budget = budget
+        self.slack = slack
+        self.choice = None
+        self.stats = {}
+        self._samples = []
+        self._sampled = 0
+        self._read_bytes = 0
+        self._read_seconds = 0.0
+        self._started = None
+        self._lock = threading.Lock()
+
+    def timed(self, read):
+        """Wraps a read function so its speed counts towards the estimate."""
+        if self.choice is not None:
+            return read
+
+        def timed_read(n):
+            start = time.perf_counter()
+            data = read(n)
+            seconds = time.perf_counter() - start
+            with self._lock:
+                self._read_bytes += len(data)
+                self._read_seconds += seconds
+            return data
+
+        return timed_read
+
+    def pick(self, head):
+        """Returns the codec for a compressible file starting with `head`."""
+        if self.choice is not None:
+            return self.codec
+        calibrate = False
+        with self._lock:
+            if self._started is None:
+                self._started = time.monotonic()
+            if self._sampled < self.sample_size and head:
+                piece = head[: 256 << 10]
+                self._samples.append(piece)
+                self._sampled += len(piece)
+            due = time.monotonic() - self._started >= self.window
+            if self.choice is None and (due or self._sampled >= self.sample_size):
+                self.choice = False  # calibrating; others keep the initial codec
+                calibrate = True
+        codec = self.codec
+        if calibrate:
+            self._calibrate()
+        return codec
+
+    def _calibrate(self):
+        sample = b"".join(self._samples)
+        self._samples = []
+        if self._read_seconds > 0:
+            read_speed = self._read_bytes / self._read_seconds * self.readers
+        else:
+            read_speed = float("inf")
+        write_speed = self.write_speed or float("inf")
+        results = []
+        for codec in self.candidates:
+            speed, ratio = measure(codec, sample, self.budget)
+            cpu = speed * self.workers
+            throughput = min(read_speed, cpu, write_speed / max(ratio, 1e-3))
+            self.stats[codec.label] = {
+                "speed": speed,
+                "ratio": ratio,
+                "throughput": throughput,
+            }
+            results.append((throughput, ratio, codec))
+        best = max(t for t, _, _ in results)
+        close = [r for r in results if r[0] >= best * (1 - self.slack)]
+        self.codec = min(close, key=lambda r: r[1])[2]
+        self.stats["read_speed"] = read_speed
+        self.stats["write_speed"] = write_speed
+        self.choice = self.codec
+
+    def summary(self):
+        if not self.choice:
+            return f"Codec: {self.codec.label} (not enough data to calibrate)"
+        read = self.stats["read_speed"] / 1048576
+        write = self.stats["write_speed"] / 1048576
+        return (
+            f"Codec: {self.codec.label} (auto; read {read:.0f} MB/s, "
+            f"write {write:.0f} MB/s)"
+        )
+
+
+def measure(codec, sample, budget=0.25, block=256 << 10):
+    """
+    Compresses `sample` with `codec` for at most `budget` seconds of CPU
+    time; returns (input bytes per second, output/input ratio).
+    """
+    if not sample:
+        return float("inf"), 1.0
+    c = codec.compressor()
+    done = out = 0
+    start = time.thread_time()
+    while done < len(sample):
+        out += len(c.compress(sample[done : done + block]))
+        done += min(block, len(sample) - done)
+        if time.thread_time() - start >= budget:
+            break
+    out += len(c.flush())
+    seconds = max(time.thread_time() - start, 1e-6)
+    return done / seconds, out / done
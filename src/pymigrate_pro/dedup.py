@@ -0,0 +1,127 @@
+import threading
+
+from .archive import content_hash
+
+# Files bigger than this are compared on their first block before being
+# hashed in full.
+HEAD_SIZE = 64 << 10
+READ_SIZE = 1 << 20
+
+
+def hash_file(path, limit=None):
+    """Content hash of a file, or of its first `limit` bytes."""
+    h = content_hash()
+    remaining = limit
+    with open(path, "rb") as f:
+        while remaining is None or remaining > 0:
+            n = READ_SIZE if remaining is None else min(READ_SIZE, remaining)
+            data = f.read(n)
+            if not data:
+                break
+            h.update(data)
+            if remaining is not None:
+                remaining -= len(data)
+    return h.hexdigest()
+
+
+class _Candidate:
+    __slots__ = ("arcname", "digest", "path")
+
+    def __init__(self, arcname, path):
+        self.arcname = arcname
+        self.path = path
+        self.digest = None
+
+
+class Deduplicator:
+    """
+    Finds files with identical content across users as they stream past.
+
+    Files are grouped by size first, which rules out almost everything
+    without reading a byte: a file is only read here once another file of
+    the same size has been seen. Same-size files are then compared by
+    content hash (large files by their first block, then in full). check()
+    may be called from several reader threads at once.
+    """
+
+    def __init__(self, min_size=1024):
+        self.min_size = min_size
+        self.duplicate_files = 0
+        self.duplicate_bytes = 0
+        self._first = {}  # size -> first ScanEntry of that size, until indexed
+        self._buckets = {}  # (size, head digest) -> [_Candidate]
+        self._lock = threading.Lock()
+
+    def check(self, entry):
+        """
+        Returns the arcname of an earlier file with the same content, or
+        None if `entry` has to be written. Every entry this returns None for
+        may become the target of later references.
+        """
+        if entry.size < self.min_size:
+            return None
+        with self._lock:
+            first = self._first.setdefault(entry.size, entry)
+        if first is entry:
+            return None
+        if first is not None:
+            self._index(first)
+
+        head = self._hash(entry.path, entry.size, head=True)
+        if head is None:
+            return None
+        key = (entry.size, head)
+        with self._lock:
+            bucket = list(self._buckets.get(key, ()))
+        full = None
+        for candidate in bucket:
+            if entry.size <= HEAD_SIZE:
+                # The head digest covered the whole file.
+                return self._found(entry, candidate)
+            if full is None:
+                full = self._hash(entry.path, entry.size)
+                if full is None:
+                    return None
+            if candidate.digest is None:
+                candidate.digest = self._hash(candidate.path, entry.size)
+            if candidate.digest == full:
+                return self._found(entry, candidate)
+
+        mine = _Candidate(entry.arcname, entry.path)
+        mine.digest = full
+        with self._lock:
+            self._buckets.setdefault(key, []).append(mine)
+        return None
+
+    def _index(self, first):
+        """Adds the first file of a size to the buckets once a twin shows up."""
+        with self._lock:
+            if self._first.get(first.size) is not first:
+                return
+            self._first[first.size] = None
+        head = self._hash(first.path, first.size, head=True)
+        if head is not None:
+            with self._lock:
+                self._buckets.setdefault((first.size, head), []).append(
+                    _Candidate(first.arcname, first.path)
+                )
+
+    def _found(self, entry, candidate):
+        with self._lock:
+            self.duplicate_files += 1
+            self.duplicate_bytes += entry.size
+        return candidate.arcname
+
+    @staticmethod
+    def _hash(path, size, head=False):
+        try:
+            return hash_file(path, HEAD_SIZE if head and size > HEAD_SIZE else None)
+        except OSError:
+            # Unreadable files are left to the writer to report.
+            return None
+
+    def summary(self):
+        return (
+            f"Deduplicated: {self.duplicate_files} files / "
+            f"{self.duplicate_bytes / 1048576:.1f} MB"
+        )
@@ -0,0 +1,235 @@
+import json
+import os
+import shutil
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from .scanner import default_workers
+
+SizeEstimate = namedtuple("SizeEstimate", "files bytes")
+
+# Outcome of a pre-flight check: bytes the archive is expected to need,
+# bytes free at the destination, whether that is enough, and the expected
+# duration in seconds (None until a backup has been measured).
+Preflight = namedtuple("Preflight", "required free enough seconds")
+
+CACHE_VERSION = 1
+# A destination's measured write speed is reused for this many seconds.
+WRITE_SPEED_MAX_AGE = 30 * 86400
+# Partial totals are reported after this many directories.
+REPORT_EVERY = 256
+
+
+def cache_dir():
+    """Per-user cache folder for size and throughput data."""
+    try:
+        from appdirs import user_cache_dir
+    except ImportError:
+        return os.path.join(os.path.expanduser("~"), ".cache", "PyMigratePro")
+    return user_cache_dir("PyMigratePro", False)
+
+
+def _load_json(path):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if not isinstance(data, dict) or data.get("version") != CACHE_VERSION:
+        return {}
+    return data
+
+
+def _save_json(path, data):
+    """Writes atomically, so a crash never leaves a torn cache behind."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(dict(data, version=CACHE_VERSION), f)
+    os.replace(tmp, path)
+
+
+class SizeEstimator:
+    """
+    Counts files and bytes below scan roots, remembering every directory it
+    has read in an on-disk cache.
+
+    A cached directory is reused as long as its device, inode and mtime
+    match, which is what changes when entries are added, removed or renamed
+    in it. Revisiting an unchanged tree therefore costs one stat per
+    directory instead of a scandir plus a stat per file. Files rewritten in
+    place keep their old size until their directory changes, which is fine
+    for an estimate.
+    """
+
+    def __init__(self, cache_path=None, workers=None):
+        self.cache_path = cache_path or os.path.join(cache_dir(), "sizes.json")
+        self.workers = max(1, workers or default_workers())
+        self._dirs = _load_json(self.cache_path).get("dirs", {})
+        self._lock = threading.Lock()
+        self.reused = 0
+        self.scanned = 0
+
+    def estimate(self, roots, callback=None, stop=None):
+        """
+        Sizes every ScanRoot and returns {arc_prefix: SizeEstimate}. Roots
+        are walked in parallel; `callback(arc_prefix, estimate, done)` gets
+        running totals from the worker threads as they grow. Setting the
+        `stop` event ends the walk early with partial results. The cache is
+        saved before returning.
+        """
+        results = {}
+        with ThreadPoolExecutor(self.workers) as pool:
+            futures = {
+                root.arc_prefix: pool.submit(self._walk, root, callback, stop)
+                for root in roots
+            }
+            for prefix, fut in futures.items():
+                results[prefix] = fut.result()
+        self.save()
+        return results
+
+    def _walk(self, root, callback, stop):
+        files = size = dirs = 0
+        stack = [root.path]
+        while stack:
+            if stop is not None and stop.is_set():
+                break
+            path = stack.pop()
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            ident = [st.st_dev, st.st_ino, st.st_mtime_ns]
+            cached = self._dirs.get(path)
+            if cached is not None and cached[:3] == ident:
+                own_files, own_bytes, subdirs = cached[3:]
+                self.reused += 1
+            else:
+                own_files = own_bytes = 0
+                subdirs = []
+                try:
+                    with os.scandir(path) as it:
+                        for entry in it:
+                            try:
+                                if entry.is_dir(follow_symlinks=False):
+                                    subdirs.append(entry.name)
+                                elif entry.is_file():
+                                    own_files += 1
+                                    own_bytes += entry.stat().st_size
+                            except OSError:
+                                pass
+                except OSError:
+                    continue
+                with self._lock:
+                    self._dirs[path] = ident + [own_files, own_bytes, subdirs]
+                self.scanned += 1
+            files += own_files
+            size += own_bytes
+            stack.extend(os.path.join(path, name) for name in subdirs)
+            dirs += 1
+            if callback and dirs % REPORT_EVERY == 0:
+                callback(root.arc_prefix, SizeEstimate(files, size), False)
+        estimate = SizeEstimate(files, size)
+        if callback:
+            callback(root.arc_prefix, estimate, True)
+        return estimate
+
+    def save(self):
+        with self._lock:
+            dirs = dict(self._dirs)
+        try:
+            _save_json(self.cache_path, {"dirs": dirs})
+        except OSError as e:
+            print(f"Could not save size cache: {e}")
+
+
+def total(estimates, roots):
+    """Sums the estimates of `roots` (missing ones count as empty)."""
+    files = size = 0
+    for root in roots:
+        est = estimates.get(root.arc_prefix)
+        if est is not None:
+            files += est.files
+            size += est.bytes
+    return SizeEstimate(files, size)
+
+
+# -- throughput history and pre-flight -------------------------------------
+
+
+def history_path():
+    return os.path.join(cache_dir(), "throughput.json")
+
+
+def load_history(path=None):
+    """Average backup speed ("bytes_per_s") and archive ratio ("ratio")."""
+    return _load_json(path or history_path())
+
+
+def record_history(bytes_done, seconds, bytes_written, path=None, weight=0.3):
+    """
+    Folds a finished backup into the history as an exponential moving
+    average, so one unusual run does not swing the next prediction.
+    """
+    if bytes_done <= 0 or seconds <= 0:
+        return
+    path = path or history_path()
+    history = load_history(path)
+    rate = bytes_done / seconds
+    ratio = bytes_written / bytes_done
+    if "bytes_per_s" in history:
+        rate = history["bytes_per_s"] * (1 - weight) + rate * weight
+        ratio = history["ratio"] * (1 - weight) + ratio * weight
+    try:
+        _save_json(path, {"bytes_per_s": rate, "ratio": ratio})
+    except OSError as e:
+        print(f"Could not save throughput history: {e}")
+
+
+def write_speed_path():
+    return os.path.join(cache_dir(), "write_speed.json")
+
+
+def cached_write_speed(destination, probe, path=None, max_age=WRITE_SPEED_MAX_AGE):
+    """
+    Write speed of the disk holding `destination`, in bytes per second.
+    `probe(destination)` measures it only if the disk (by device id) has
+    no measurement younger than `max_age` seconds, so a backup to the same
+    USB disk does not write and fsync a probe file every time.
+    """
+    path = path or write_speed_path()
+    try:
+        device = str(os.stat(destination).st_dev)
+    except OSError:
+        return probe(destination)
+    speeds = _load_json(path)
+    cached = speeds.get(device)
+    now = time.time()
+    if isinstance(cached, dict) and now - cached.get("time", 0) < max_age:
+        return cached["bytes_per_s"]
+    speed = probe(destination)
+    speeds[device] = {"bytes_per_s": speed, "time": now}
+    speeds.pop("version", None)
+    try:
+        _save_json(path, speeds)
+    except OSError as e:
+        print(f"Could not save write speed: {e}")
+    return speed
+
+
+def preflight(total_bytes, destination, history=None, margin=1.1):
+    """
+    Checks that `destination` can hold a backup of `total_bytes` source
+    bytes. Without history the archive is assumed to be as big as its
+    source; `margin` adds headroom on top of the expected size.
+    """
+    history = history if history is not None else load_history()
+    ratio = min(1.0, history.get("ratio", 1.0))
+    required = int(total_bytes * ratio * margin)
+    free = shutil.disk_usage(destination).free
+    rate = history.get("bytes_per_s")
+    seconds = total_bytes / rate if rate else None
+    return Preflight(required, free, free >= required, seconds)
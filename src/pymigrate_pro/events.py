@@ -0,0 +1,230 @@
+import json
+import threading
+import time
+from collections import deque, namedtuple
+
+# Event kinds.
+PHASE = "phase"  # name: the phase that starts now
+FOUND = "found"  # work discovered: size bytes, detail["files"] files (default 1)
+BYTES = "bytes"  # size bytes of file data read (backup) or written (restore)
+MEMBER = "member"  # a file finished: size, detail["seconds"], ["compressed"]
+SKIP = "skip"  # a found file left out after all: size, detail["reason"]
+ERROR = "error"  # a found file that failed: size, detail["reason"]
+THROTTLE = "throttle"  # detail: limits and achieved rates (Throttle.snapshot)
+# SKIP and ERROR take the file back out of the totals; detail["files"] = 0
+# marks a failure that was never counted (e.g. an unreadable directory).
+
+# Phases, in order. Totals only grow while scanning.
+SCAN = "scan"
+TRANSFER = "transfer"
+FINALIZE = "finalize"
+DONE = "done"
+
+Event = namedtuple("Event", "kind time name size detail")
+Progress = namedtuple(
+    "Progress",
+    "phase current files_done files_total bytes_done bytes_total bytes_written "
+    "rate eta elapsed throttle",
+    defaults=(None,),
+)
+
+
+class EventBus:
+    """
+    Fans structured events out to subscribers. emit() may be called from
+    any thread; subscribers are called on the emitting thread without any
+    lock held, so worker threads never wait for each other's subscribers.
+    A subscriber may thus run on several threads at once and must do its
+    own locking; it may also emit events itself. Subscribers should return
+    quickly. With nobody subscribed emit() costs next to nothing.
+    """
+
+    def __init__(self):
+        self._subscribers = ()
+        self._lock = threading.Lock()
+
+    def subscribe(self, callback):
+        """Calls `callback(event)` for every event from now on."""
+        with self._lock:
+            self._subscribers = self._subscribers + (callback,)
+        return callback
+
+    def unsubscribe(self, callback):
+        with self._lock:
+            self._subscribers = tuple(s for s in self._subscribers if s is not callback)
+
+    def emit(self, kind, name=None, size=0, **detail):
+        subscribers = self._subscribers  # replaced, never changed in place
+        if not subscribers:
+            return
+        event = Event(kind, time.monotonic(), name, size, detail)
+        for callback in subscribers:
+            try:
+                callback(event)
+            except Exception as e:  # noqa: BLE001
+                print(f"Event subscriber failed: {e}")
+
+
+class ProgressTracker:
+    """
+    Turns an event stream into byte-weighted progress with a rolling
+    throughput and an ETA. Subscribe it to a bus, then call snapshot() from
+    whatever thread draws the progress, as often as it likes.
+    """
+
+    def __init__(self, window=5.0):
+        self.window = window
+        self.phase = None
+        self.current = None
+        self.files_done = 0
+        self.files_total = 0
+        self.bytes_done = 0
+        self.bytes_total = 0
+        self.bytes_written = 0
+        self.throttle = None
+        self.started = time.monotonic()
+        self._samples = deque([(self.started, 0)])
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        with self._lock:
+            kind = event.kind
+            if kind == BYTES:
+                self.bytes_done += event.size
+                samples = self._samples
+                if event.time - samples[-1][0] >= 0.25:
+                    samples.append((event.time, self.bytes_done))
+                    while event.time - samples[0][0] > self.window:
+                        samples.popleft()
+            elif kind == MEMBER:
+                self.files_done += 1
+                self.bytes_written += event.detail.get("compressed", 0)
+                self.current = event.name
+            elif kind == FOUND:
+                self.files_total += event.detail.get("files", 1)
+                self.bytes_total += event.size
+            elif kind in (SKIP, ERROR):
+                # Nothing more will happen to this file.
+                self.files_total -= event.detail.get("files", 1)
+                self.bytes_total -= event.size
+            elif kind == PHASE:
+                self.phase = event.name
+            elif kind == THROTTLE:
+                self.throttle = event.detail
+
+    def fraction(self):
+        """Share of bytes done, 0..1."""
+        with self._lock:
+            if self.bytes_total <= 0:
+                return 1.0 if self.phase in (FINALIZE, DONE) else 0.0
+            return min(1.0, self.bytes_done / self.bytes_total)
+
+    def snapshot(self):
+        with self._lock:
+            now = time.monotonic()
+            # Samples are only taken as bytes arrive, so during a stall the
+            # rate decays instead of freezing at its last value.
+            t0, b0 = self._samples[0]
+            rate = (self.bytes_done - b0) / max(now - t0, 1e-3)
+            eta = None
+            if self.phase not in (None, SCAN) and rate > 0:
+                eta = max(0, self.bytes_total - self.bytes_done) / rate
+            return Progress(
+                self.phase,
+                self.current,
+                self.files_done,
+                self.files_total,
+                self.bytes_done,
+                self.bytes_total,
+                self.bytes_written,
+                rate,
+                eta,
+                now - self.started,
+                self.throttle,
+            )
+
+
+class EventLog:
+    """Subscriber that appends every event to a file as a JSON line."""
+
+    def __init__(self, path):
+        self._fp = open(path, "a", encoding="utf-8")  # noqa: SIM115
+        self._start = time.monotonic()
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        row = {"t": round(event.time - self._start, 4), "kind": event.kind}
+        if event.name is not None:
+            row["name"] = event.name
+        if event.size:
+            row["size"] = event.size
+        row.update(event.detail)
+        line = json.dumps(row, default=str) + "\n"
+        with self._lock:
+            self._fp.write(line)
+
+    def close(self):
+        with self._lock:
+            self._fp.close()
+
+
+def format_bytes(n):
+    for unit in ("B", "KB", "MB", "GB"):
+        if abs(n) < 1024:
+            return f"{n:.0f} {unit}" if unit == "B" else f"{n:.1f} {unit}"
+        n /= 1024
+    return f"{n:.1f} TB"
+
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    h, rest = divmod(seconds, 3600)
+    m, s = divmod(rest, 60)
+    return f"{h}:{m:02d}:{s:02d}" if h else f"{m}:{s:02d}"
+
+
+def legacy_callback(tracker, progress_callback):
+    """
+    Subscriber driving an old-style `progress_callback(name, fraction)` from
+    MEMBER events. Subscribe it after `tracker` so the fraction is current.
+    The fraction never goes backwards, even while a scan is still raising
+    the total.
+    """
+    last = [0.0]
+    lock = threading.Lock()
+
+    def on_event(event):
+        if event.kind == MEMBER:
+            with lock:
+                last[0] = max(last[0], tracker.fraction())
+                progress_callback(event.name, last[0])
+
+    return on_event
+
+
+def describe(progress):
+    """One-line summary of a Progress snapshot, for labels and consoles."""
+    text = (
+        f"{format_bytes(progress.bytes_done)} / {format_bytes(progress.bytes_total)}"
+        f" - {progress.files_done}/{progress.files_total} files"
+        f" - {format_bytes(progress.rate)}/s"
+    )
+    if progress.phase == SCAN:
+        text += " - scanning..."
+    elif progress.eta is not None and progress.phase == TRANSFER:
+        text += f" - ETA {format_duration(progress.eta)}"
+    throttle = progress.throttle
+    if throttle:
+        text += f" - {throttle['workers']} readers"
+        if throttle["bytes_per_sec"]:
+            text += f", capped at {format_bytes(throttle['bytes_per_sec'])}/s"
+    return text
+
+
+def summarize(progress):
+    """Closing line for a finished run: volume, time and average rate."""
+    rate = progress.bytes_done / max(progress.elapsed, 1e-3)
+    return (
+        f"Transferred {format_bytes(progress.bytes_done)} in "
+        f"{format_duration(progress.elapsed)} ({format_bytes(rate)}/s average)"
+    )
@@ -0,0 +1,347 @@
+import fnmatch
+import json
+import os
+import re
+import struct
+import zipfile
+import zlib
+
+from .manifest import INCREMENTAL, META_PREFIX, BackupManifest, is_meta
+from .restore import data_offset, restorable
+from .rules import glob_to_regex
+
+INDEX_NAME = META_PREFIX + "index"
+INDEX_VERSION = 1
+# The end-of-central-directory comment of an indexed archive is this prefix
+# followed by the header offset of the index member.
+COMMENT_PREFIX = b"PMIG-INDEX "
+
+_LENGTH = struct.Struct("<L")
+_END_ARCHIVE = b"PK\005\006"
+
+
+def group_of(arcname):
+    """The (user, folder) an archive name is filed under in the index."""
+    parts = arcname.split("/", 2)
+    if len(parts) < 3:
+        return parts[0], ""
+    return parts[0], parts[1]
+
+
+def build_index(records, refs=None, deleted=(), manifest=None):
+    """
+    Serialises an index of the MemberRecords of an archive.
+
+    Layout: a 4-byte length, the zlib-compressed table of contents, then
+    one zlib-compressed block per user folder. The table maps
+    "user/folder" to [block offset, block length, files, bytes], so a
+    reader only decompresses the folders it is asked for. Each block lists
+    the folder's members with everything needed to extract them (and their
+    mtime), plus its dedup references and deletions.
+    """
+    groups = {}
+
+    def group(arcname):
+        key = "/".join(group_of(arcname))
+        block = groups.get(key)
+        if block is None:
+            block = groups[key] = {"members": [], "refs": [], "deleted": []}
+        return block
+
+    for rec in records:
+        if is_meta(rec.arcname):
+            continue
+        group(rec.arcname)["members"].append(
+            [
+                rec.arcname,
+                rec.header_offset,
+                rec.compress_size,
+                rec.file_size,
+                rec.crc,
+                rec.compress_type,
+                rec.flags,
+                list(rec.dos_time),
+                rec.mtime_ns,
+            ]
+        )
+    entries = manifest.entries if manifest is not None else {}
+    for arcname, canonical in (refs or {}).items():
+        known = entries.get(arcname)
+        mtime_ns = known[1] if known else None
+        group(arcname)["refs"].append([arcname, canonical, mtime_ns])
+    for arcname in deleted:
+        group(arcname)["deleted"].append(arcname)
+
+    toc = {"version": INDEX_VERSION, "groups": {}}
+    if manifest is not None:
+        toc["manifest"] = {
+            "id": manifest.id,
+            "kind": manifest.kind,
+            "base": manifest.base,
+        }
+    blocks = []
+    offset = 0
+    for key, block in groups.items():
+        data = zlib.compress(json.dumps(block, separators=(",", ":")).encode(), 6)
+        size = sum(m[3] for m in block["members"])
+        toc["groups"][key] = [offset, len(data), len(block["members"]), size]
+        blocks.append(data)
+        offset += len(data)
+    head = zlib.compress(json.dumps(toc, separators=(",", ":")).encode(), 6)
+    return _LENGTH.pack(len(head)) + head + b"".join(blocks)
+
+
+def index_comment(header_offset):
+    return COMMENT_PREFIX + str(header_offset).encode("ascii")
+
+
+def _read_comment(fp):
+    """Returns the archive comment, read from the end of the file."""
+    fp.seek(0, os.SEEK_END)
+    size = fp.tell()
+    tail_size = min(size, 22 + 0xFFFF)
+    fp.seek(size - tail_size)
+    tail = fp.read(tail_size)
+    pos = tail.rfind(_END_ARCHIVE)
+    if pos < 0 or len(tail) < pos + 22:
+        return b""
+    (length,) = struct.unpack("<H", tail[pos + 20 : pos + 22])
+    return tail[pos + 22 : pos + 22 + length]
+
+
+def _empty_block():
+    return {"infos": [], "by_name": {}, "refs": [], "deleted": []}
+
+
+def _info(entry):
+    name, offset, compress_size, file_size, crc, method, flags, dos = entry[:8]
+    info = zipfile.ZipInfo(name, _date_time(dos))
+    info.header_offset = offset
+    info.compress_size = compress_size
+    info.file_size = file_size
+    info.CRC = crc
+    info.compress_type = method
+    info.flag_bits = flags
+    return info
+
+
+def _date_time(dos):
+    t, d = dos
+    return (
+        (d >> 9) + 1980,
+        (d >> 5) & 0xF,
+        d & 0x1F,
+        t >> 11,
+        (t >> 5) & 0x3F,
+        (t & 0x1F) * 2,
+    )
+
+
+class Selection:
+    """
+    Archive-name patterns such as "UserA/Documents/Projects/**".
+
+    "*" and "?" stay within one path component, "**" spans any number of
+    them, and a pattern also selects everything below what it names, so
+    "UserA/Desktop" means the whole Desktop. Matching ignores case, like
+    the Windows file systems the names come from. No patterns select
+    everything.
+    """
+
+    def __init__(self, patterns=None):
+        self.patterns = [p.strip("/") for p in patterns or () if p.strip("/")]
+        self._regex = None
+        if self.patterns:
+            self._regex = re.compile(
+                "|".join(f"(?:{_translate(p)})" for p in self.patterns),
+                re.IGNORECASE,
+            )
+
+    def __bool__(self):
+        return bool(self.patterns)
+
+    def matches(self, arcname):
+        return self._regex is None or self._regex.fullmatch(arcname) is not None
+
+    def may_match(self, user, folder):
+        """False if nothing in this user folder can match."""
+        if self._regex is None:
+            return True
+        for pattern in self.patterns:
+            parts = pattern.split("/")
+            wanted = [user, folder] if folder else [user]
+            for part, name in zip(parts, wanted):
+                if "**" in part:
+                    return True
+                if not fnmatch.fnmatchcase(name.lower(), part.lower()):
+                    break
+            else:
+                return True
+        return False
+
+
+def _translate(pattern):
+    return glob_to_regex(pattern) + "(?:/.*)?"
+
+
+class ArchiveView:
+    """
+    The members, references and deletions of one archive a restore uses,
+    with the mtimes ({arcname: ns}) of the members and references that
+    have one on record.
+    """
+
+    def __init__(self, infos, refs, deleted, mtimes=None):
+        self.infos = infos
+        self.refs = refs
+        self.deleted = deleted
+        self.mtimes = mtimes or {}
+
+
+class ArchiveIndex:
+    """
+    Reads the index of a .pmig archive. load() only touches the end record
+    and the table of contents; folders are decompressed when a selection
+    asks for them, so the cost of a selective restore follows the size of
+    the selection, not of the archive.
+
+    Archives written before the index existed are read through their
+    central directory and manifest instead (see from_zip), with the same
+    interface.
+    """
+
+    def __init__(self, path, toc, base_offset):
+        self.path = path
+        self.toc = toc
+        self.manifest = toc.get("manifest")
+        self._base = base_offset
+        self._blocks = {}
+
+    @classmethod
+    def load(cls, path):
+        """The index of `path`, or None if the archive has none."""
+        with open(path, "rb") as fp:
+            comment = _read_comment(fp)
+            if not comment.startswith(COMMENT_PREFIX):
+                return None
+            try:
+                info = zipfile.ZipInfo(INDEX_NAME)
+                info.header_offset = int(comment[len(COMMENT_PREFIX) :])
+                start = data_offset(fp, info)
+                fp.seek(start)
+                (length,) = _LENGTH.unpack(fp.read(_LENGTH.size))
+                toc = json.loads(zlib.decompress(fp.read(length)))
+            except (ValueError, zlib.error, struct.error, zipfile.BadZipFile):
+                return None
+        if toc.get("version") != INDEX_VERSION:
+            return None
+        return cls(path, toc, start + _LENGTH.size + length)
+
+    @classmethod
+    def open(cls, path):
+        """load(), falling back to from_zip() for archives without an index."""
+        return cls.load(path) or cls.from_zip(path)
+
+    @classmethod
+    def from_zip(cls, path):
+        with zipfile.ZipFile(path, "r") as zipf:
+            manifest = BackupManifest.read(zipf)
+            infolist = zipf.infolist()
+        blocks = {}
+        for info in infolist:
+            if is_meta(info.filename):
+                continue
+            key = "/".join(group_of(info.filename))
+            block = blocks.setdefault(key, _empty_block())
+            block["infos"].append(info)
+            block["by_name"][info.filename] = info
+        entries = manifest.entries if manifest is not None else {}
+        mtimes = {name: known[1] for name, known in entries.items()}
+        if manifest is not None:
+            for arcname, canonical in manifest.refs.items():
+                key = "/".join(group_of(arcname))
+                blocks.setdefault(key, _empty_block())
+                blocks[key]["refs"].append([arcname, canonical, mtimes.get(arcname)])
+            for arcname in manifest.deleted:
+                key = "/".join(group_of(arcname))
+                blocks.setdefault(key, _empty_block())
+                blocks[key]["deleted"].append(arcname)
+        toc = {"groups": {}}
+        for key, block in blocks.items():
+            size = sum(info.file_size for info in block["infos"])
+            toc["groups"][key] = [0, 0, len(block["infos"]), size]
+        if manifest is not None:
+            toc["manifest"] = {
+                "id": manifest.id,
+                "kind": manifest.kind,
+                "base": manifest.base,
+            }
+        index = cls(path, toc, 0)
+        for block in blocks.values():
+            block["mtimes"] = {
+                info.filename: mtimes[info.filename]
+                for info in block["infos"]
+                if info.filename in mtimes
+            }
+        index._blocks = blocks
+        return index
+
+    @property
+    def is_incremental(self):
+        return self.manifest is not None and self.manifest["kind"] == INCREMENTAL
+
+    def groups(self, selection=None):
+        """Keys ("user/folder") of the groups `selection` may touch."""
+        keys = []
+        for key in self.toc["groups"]:
+            user, _, folder = key.partition("/")
+            if selection is None or selection.may_match(user, folder):
+                keys.append(key)
+        return keys
+
+    def users(self):
+        return sorted({key.partition("/")[0] for key in self.toc["groups"]})
+
+    def _block(self, key):
+        block = self._blocks.get(key)
+        if block is None:
+            offset, length, _, _ = self.toc["groups"][key]
+            with open(self.path, "rb") as fp:
+                fp.seek(self._base + offset)
+                raw = json.loads(zlib.decompress(fp.read(length)))
+            infos = [_info(m) for m in raw["members"]]
+            block = {
+                "infos": infos,
+                "by_name": {info.filename: info for info in infos},
+                "refs": raw["refs"],
+                "deleted": raw["deleted"],
+                "mtimes": {m[0]: m[8] for m in raw["members"] if len(m) > 8},
+            }
+            self._blocks[key] = block
+        return block
+
+    def select(self, selection=None):
+        """ArchiveView of the members, refs and deletions matching `selection`."""
+        selection = selection or Selection()
+        infos, refs, deleted, mtimes = [], {}, [], {}
+        for key in self.groups(selection):
+            block = self._block(key)
+            for info in block["infos"]:
+                if restorable(info) and selection.matches(info.filename):
+                    infos.append(info)
+                    if info.filename in block["mtimes"]:
+                        mtimes[info.filename] = block["mtimes"][info.filename]
+            for ref in block["refs"]:
+                if selection.matches(ref[0]):
+                    refs[ref[0]] = ref[1]
+                    if len(ref) > 2 and ref[2] is not None:
+                        mtimes[ref[0]] = ref[2]
+            deleted.extend(name for name in block["deleted"] if selection.matches(name))
+        return ArchiveView(infos, refs, deleted, mtimes)
+
+    def getinfo(self, arcname):
+        """The ZipInfo of one member (e.g. the original of a reference)."""
+        key = "/".join(group_of(arcname))
+        if key not in self.toc["groups"]:
+            raise KeyError(arcname)
+        return self._block(key)["by_name"][arcname]
@@ -0,0 +1,165 @@
+import json
+import os
+
+from .archive import MemberRecord
+
+JOURNAL_SUFFIX = ".journal"
+RESTORE_JOURNAL_SUFFIX = ".restore.journal"
+
+
+def _sync(fp):
+    fp.flush()
+    os.fsync(fp.fileno())
+
+
+def _read_rows(path):
+    """
+    Parses a journal's JSON lines up to the first one a crash left torn;
+    returns them and the offset where the last good line ends.
+    """
+    rows = []
+    end = 0
+    with open(path, "rb") as f:
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            try:
+                rows.append(json.loads(line))
+            except ValueError:
+                break
+            end += len(line)
+    return rows, end
+
+
+def _reopen(path, end):
+    """
+    Cuts a torn tail off the journal and opens it for appending, so new
+    lines do not run on from a half-written one.
+    """
+    with open(path, "r+b") as f:
+        f.truncate(end)
+    return open(path, "a", encoding="utf-8")
+
+
+class BackupJournal:
+    """
+    Append-only log kept next to an archive while it is being written.
+
+    The first line is a JSON header describing the backup; each further line
+    is a finished member and the archive offset where its data ends. The
+    writer only appends a member after the archive data it refers to has
+    been fsynced, so on resume everything up to `end` can be trusted.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.header = {}
+        self.records = []
+        self.end = 0
+        self._fp = None
+
+    @classmethod
+    def create(cls, path, header):
+        journal = cls(path)
+        journal.header = header
+        journal._fp = open(path, "w", encoding="utf-8")  # noqa: SIM115
+        journal._fp.write(json.dumps(header) + "\n")
+        _sync(journal._fp)
+        return journal
+
+    @classmethod
+    def load(cls, path):
+        """Reads an existing journal and reopens it for appending."""
+        journal = cls(path)
+        rows, end = _read_rows(path)
+        if not rows:
+            raise ValueError(f"{path} has no header")
+        journal.header = rows[0]
+        for row in rows[1:]:
+            journal.end = row.pop()
+            row[6] = tuple(row[6])
+            journal.records.append(MemberRecord(*row))
+        journal._fp = _reopen(path, end)
+        return journal
+
+    def append(self, items):
+        """Logs (MemberRecord, end_offset) pairs and syncs the journal."""
+        if not items:
+            return
+        for rec, end in items:
+            self._fp.write(json.dumps(list(rec) + [end]) + "\n")
+            self.records.append(rec)
+            self.end = end
+        _sync(self._fp)
+
+    def close(self):
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
+
+    def discard(self):
+        """Closes and deletes the journal once the archive is complete."""
+        self.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class RestoreJournal:
+    """
+    Log of members a restore has finished, kept next to the archive. It is
+    tied to the restore root and user mapping, so a restore to another
+    place starts fresh.
+    """
+
+    def __init__(self, path, root, user_map=None):
+        self.path = path
+        self.root = root
+        self.user_map = user_map or {}
+        self.done = set()
+        self._fp = None
+
+    @classmethod
+    def open(cls, archive_path, root, resume, user_map=None):
+        """
+        Opens the journal for `archive_path`, keeping earlier progress when
+        `resume` is set. Returns None if the journal cannot be written, e.g.
+        when the archive is on read-only media.
+        """
+        journal = cls(archive_path + RESTORE_JOURNAL_SUFFIX, root, user_map)
+        header = {"root": root, "map": journal.user_map}
+        try:
+            if resume and os.path.exists(journal.path):
+                rows, end = _read_rows(journal.path)
+                known = rows[0] if rows and isinstance(rows[0], dict) else None
+                if (
+                    known is not None
+                    and dict(known, map=known.get("map", {})) == header
+                ):
+                    journal.done.update(rows[1:])
+                    journal._fp = _reopen(journal.path, end)
+            if journal._fp is None:
+                journal._fp = open(journal.path, "w", encoding="utf-8")  # noqa: SIM115
+                journal._fp.write(json.dumps(header) + "\n")
+                journal._fp.flush()
+        except OSError:
+            return None
+        return journal
+
+    def append(self, names):
+        for name in names:
+            self._fp.write(json.dumps(name) + "\n")
+        self._fp.flush()
+
+    def close(self):
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
+
+    def discard(self):
+        self.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,248 @@
+import json
+import os
+import uuid
+import zipfile
+from datetime import datetime
+
+# Archive members under this prefix are PyMigrate metadata, not user files.
+META_PREFIX = ".pmig/"
+MANIFEST_NAME = META_PREFIX + "manifest.json"
+
+FULL = "full"
+INCREMENTAL = "incremental"
+
+# File name suffix of the manifest tying per-user shards together.
+BATCH_SUFFIX = ".pmigbatch"
+
+
+def is_meta(arcname):
+    return arcname.startswith(META_PREFIX)
+
+
+class BackupManifest:
+    """
+    Describes the profile state captured by a backup.
+
+    `entries` maps every archived path to [size, mtime_ns, hash] and covers
+    the full state, including files an incremental archive did not rewrite
+    because they were unchanged since its base. `deleted` lists paths that
+    existed in the base but are gone now. `refs` maps paths that were not
+    stored because their content is identical to another member to the
+    arcname of that member.
+    """
+
+    VERSION = 1
+
+    def __init__(self, kind=FULL, base=None):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.created = datetime.now().isoformat(timespec="seconds")
+        # {"name": file name of the base archive, "id": its manifest id}
+        self.base = base
+        self.entries = {}
+        self.deleted = []
+        self.refs = {}
+
+    def add(self, arcname, size, mtime_ns, digest):
+        self.entries[arcname] = [size, mtime_ns, digest]
+
+    def is_unchanged(self, entry):
+        """True if a ScanEntry matches what this manifest recorded."""
+        known = self.entries.get(entry.arcname)
+        return (
+            known is not None and known[0] == entry.size and known[1] == entry.mtime_ns
+        )
+
+    def to_json(self):
+        return json.dumps(
+            {
+                "version": self.VERSION,
+                "id": self.id,
+                "kind": self.kind,
+                "created": self.created,
+                "base": self.base,
+                "entries": self.entries,
+                "deleted": self.deleted,
+                "refs": self.refs,
+            },
+            separators=(",", ":"),
+        )
+
+    @classmethod
+    def from_json(cls, data):
+        raw = json.loads(data)
+        manifest = cls(raw.get("kind", FULL), raw.get("base"))
+        manifest.id = raw["id"]
+        manifest.created = raw.get("created")
+        manifest.entries = raw.get("entries", {})
+        manifest.deleted = raw.get("deleted", [])
+        manifest.refs = raw.get("refs", {})
+        return manifest
+
+    @classmethod
+    def load(cls, archive_path):
+        """Reads the manifest embedded in a .pmig, or None for older archives."""
+        with zipfile.ZipFile(archive_path, "r") as zipf:
+            return cls.read(zipf)
+
+    @classmethod
+    def read(cls, zipf):
+        try:
+            return cls.from_json(zipf.read(MANIFEST_NAME))
+        except KeyError:
+            return None
+
+
+class BaseDiff:
+    """
+    Compares streamed scan entries with the manifest of a base archive and
+    fills in the manifest of the incremental archive being written.
+    """
+
+    def __init__(self, base, manifest):
+        self.base = base
+        self.manifest = manifest
+        self.changed = 0
+        self._seen = set()
+
+    def accept(self, entry):
+        """True if `entry` is new or changed and must be written."""
+        self._seen.add(entry.arcname)
+        if self.base.is_unchanged(entry):
+            self.manifest.entries[entry.arcname] = self.base.entries[entry.arcname]
+            return False
+        self.changed += 1
+        return True
+
+    def finish(self, roots, rules=None):
+        """
+        Records deletions once the scan is complete. Only paths below a
+        scanned folder can be known as deleted; anything else in the base
+        state (e.g. users not selected this time) carries on unchanged.
+        Paths the scan's RuleMatcher now excludes are dropped from the state
+        without counting as deleted, so a restore leaves them alone.
+        """
+        prefixes = tuple(root.arc_prefix + "/" for root in roots)
+        for arcname, known in self.base.entries.items():
+            if arcname in self._seen:
+                continue
+            if arcname.startswith(prefixes):
+                if rules and rules.excludes(arcname, known[0], known[1]):
+                    continue
+                self.manifest.deleted.append(arcname)
+            else:
+                self.manifest.entries[arcname] = known
+        self._seen = set()
+
+
+def is_batch(path):
+    return isinstance(path, str) and path.endswith(BATCH_SUFFIX)
+
+
+class BatchManifest:
+    """
+    Ties together the per-user shard archives of one sharded backup (see
+    scheduler.py). `shards` maps each user to {"archive": file name of the
+    shard next to this manifest, or None if there was nothing to back up,
+    "ok": Bool, "message": str}. `base` is the file name of the batch an
+    incremental batch was based on.
+    """
+
+    VERSION = 1
+
+    def __init__(self, kind=FULL, base=None):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.created = datetime.now().isoformat(timespec="seconds")
+        self.base = base
+        self.shards = {}
+
+    def to_json(self):
+        return json.dumps(
+            {
+                "version": self.VERSION,
+                "id": self.id,
+                "kind": self.kind,
+                "created": self.created,
+                "base": self.base,
+                "shards": self.shards,
+            },
+            indent=1,
+        )
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "r", encoding="utf-8") as f:
+            raw = json.load(f)
+        if raw.get("version") != cls.VERSION:
+            raise ValueError(f"{path} is not a batch manifest this version can read")
+        batch = cls(raw.get("kind", FULL), raw.get("base"))
+        batch.id = raw["id"]
+        batch.created = raw.get("created")
+        batch.shards = raw.get("shards", {})
+        return batch
+
+    def save(self, path):
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(self.to_json())
+        os.replace(tmp, path)
+
+    def archives(self, path):
+        """(user, shard path) for every shard written, given this file's path."""
+        folder = os.path.dirname(path)
+        return [
+            (user, os.path.join(folder, shard["archive"]))
+            for user, shard in self.shards.items()
+            if shard["ok"] and shard["archive"]
+        ]
+
+
+def resolve_chain(archive_path):
+    """
+    Returns the archives needed to restore `archive_path`, oldest first.
+    Bases of incremental archives are looked up next to the archive.
+    """
+    chain = []
+    path = archive_path
+    while True:
+        header = _chain_header(path)
+        chain.append(path)
+        if header is None or header["kind"] != INCREMENTAL:
+            break
+        base_path = os.path.join(os.path.dirname(path), header["base"]["name"])
+        if base_path in chain:
+            raise ValueError(f"Archive chain loops back to {base_path}")
+        if not os.path.exists(base_path):
+            raise FileNotFoundError(f"Base archive not found: {base_path}")
+        base = _chain_header(base_path)
+        if base is None or base["id"] != header["base"]["id"]:
+            raise ValueError(f"{base_path} is not the base of {path}")
+        path = base_path
+    chain.reverse()
+    return chain
+
+
+def resolve_batch(batch_path):
+    """
+    Returns [(user, chain)] for the shards of a batch manifest, each chain
+    as resolve_chain() returns it.
+    """
+    batch = BatchManifest.load(batch_path)
+    return [(user, resolve_chain(path)) for user, path in batch.archives(batch_path)]
+
+
+def _chain_header(path):
+    """
+    The id, kind and base of an archive. Indexed archives answer from the
+    index header, which is much cheaper than parsing the whole manifest.
+    """
+    from .index import ArchiveIndex  # index.py imports this module
+
+    index = ArchiveIndex.load(path)
+    if index is not None and index.manifest is not None:
+        return index.manifest
+    manifest = BackupManifest.load(path)
+    if manifest is None:
+        return None
+    return {"id": manifest.id, "kind": manifest.kind, "base": manifest.base}
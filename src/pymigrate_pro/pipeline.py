@@ -0,0 +1,124 @@
+import queue
+import threading
+
+from .events import BYTES, ERROR, FOUND, MEMBER, PHASE, SKIP, TRANSFER
+from .scanner import ScanError, default_workers
+
+
+class BackupPipeline:
+    """
+    Streams files from a live scan into an ArchiveWriter.
+
+    The stages overlap instead of running one after another:
+
+        scanner threads -> dispatcher (filters) -> reader threads
+            -> compression pool -> archive writer thread
+
+    Every hand-off is a bounded queue or semaphore, so memory for file data
+    stays flat however many files there are, and the first bytes reach the
+    archive as soon as the scanner finds the first file.
+
+    Progress is reported on `events` (an EventBus): FOUND for every file
+    dispatched, TRANSFER once the scan is complete, and SKIP/ERROR for files
+    that cannot be read. The archive itself reports BYTES and MEMBER.
+
+    With a Throttle, readers take one of its slots per file, so an adaptive
+    throttle decides how many of them work at once.
+    """
+
+    def __init__(
+        self,
+        archive,
+        readers=None,
+        dedup=None,
+        events=None,
+        queue_size=256,
+        throttle=None,
+    ):
+        self.archive = archive
+        self.readers = max(1, readers or default_workers())
+        self.dedup = dedup
+        self.events = events
+        self.queue_size = queue_size
+        self.throttle = throttle
+
+        self.discovered = 0
+        self.dispatched = 0
+        self.refs = []  # (entry, arcname of identical member)
+        self.error = None
+        self._lock = threading.Lock()
+
+    def run(self, items, accept=None):
+        """
+        Consumes an iterable of ScanEntry/ScanError items (usually
+        ProfileScanner.iter_scan) on the calling thread and returns once every
+        accepted entry has been handed to the archive. `accept(entry)` can
+        drop entries, e.g. files unchanged since a base archive.
+        """
+        work = queue.Queue(maxsize=self.queue_size)
+        threads = [
+            threading.Thread(target=self._read_loop, args=(work,), daemon=True)
+            for _ in range(self.readers)
+        ]
+        for t in threads:
+            t.start()
+        try:
+            for item in items:
+                if isinstance(item, ScanError):
+                    print(f"Skipping {item.path}: {item.error}")
+                    if self.events is not None:
+                        self.events.emit(
+                            ERROR, item.path, files=0, reason=str(item.error)
+                        )
+                    continue
+                self.discovered += 1
+                if accept is not None and not accept(item):
+                    continue
+                if self.error is not None:
+                    break
+                self.dispatched += 1
+                if self.events is not None:
+                    self.events.emit(FOUND, item.arcname, item.size)
+                work.put(item)
+            else:
+                if self.events is not None:
+                    self.events.emit(PHASE, TRANSFER)
+        finally:
+            for _ in threads:
+                work.put(None)
+            for t in threads:
+                t.join()
+        if self.error is not None:
+            raise self.error
+
+    def _read_loop(self, work):
+        while True:
+            entry = work.get()
+            if entry is None:
+                return
+            if self.error is not None:
+                continue  # keep draining so the dispatcher never blocks
+            try:
+                if self.throttle is not None:
+                    with self.throttle.slot():
+                        self._process(entry)
+                else:
+                    self._process(entry)
+            except Exception as e:  # noqa: BLE001
+                self.error = self.error or e
+
+    def _process(self, entry):
+        canonical = self.dedup.check(entry) if self.dedup else None
+        if canonical is not None:
+            with self._lock:
+                self.refs.append((entry, canonical))
+            if self.events is not None:
+                self.events.emit(BYTES, entry.arcname, entry.size)
+                self.events.emit(MEMBER, entry.arcname, entry.size, ref=canonical)
+            return
+        try:
+            self.archive.add_file(entry.path, entry.arcname, entry.size, entry.mtime_ns)
+        except (PermissionError, OSError) as e:
+            print(f"Skipping {entry.path}: {e}")
+            if self.events is not None:
+                self.events.emit(SKIP, entry.arcname, entry.size, reason=str(e))
@@ -0,0 +1,105 @@
+import os
+import threading
+import zlib
+
+from .codec import DeflateCodec, StoredCodec
+
+STORED = "stored"
+FAST = "fast"
+STRONG = "strong"
+
+# Formats that are already compressed; deflating them burns CPU for ~0% gain.
+STORED_EXTENSIONS = frozenset(
+    """
+    jpg jpeg png gif webp heic heif avif tif tiff
+    mp4 m4v mov mkv avi wmv webm flv mpg mpeg
+    mp3 m4a aac ogg oga opus flac wma
+    zip 7z rar gz tgz bz2 xz zst lz4 cab msi msix appx jar apk iso dmg
+    docx xlsx pptx odt ods odp epub
+    ost
+    """.split()  # noqa: SIM905
+)
+
+# Text-like formats that always compress well, no need to sample them.
+TEXT_EXTENSIONS = frozenset(
+    """
+    txt log csv tsv xml json html htm css js md ini cfg conf reg rtf svg
+    sql yaml yml py ps1 bat cmd vbs eml msf
+    """.split()  # noqa: SIM905
+)
+
+
+class CompressionPolicy:
+    """
+    Chooses stored, a fast codec or a strong codec for each member (deflate
+    at levels 1 and 6 unless others are given).
+
+    The decision uses the file extension first, then a level-1 deflate of
+    the first block of the file as a cheap compressibility estimate, and the
+    file size. Counts and bytes per decision are kept in `stats`. With an
+    AutoCodec as `auto`, it supplies the codec for every compressible file.
+    """
+
+    def __init__(
+        self,
+        fast=None,
+        strong=None,
+        min_size=64,
+        large_size=64 << 20,
+        sample_size=64 << 10,
+        stored_ratio=0.97,
+        strong_ratio=0.5,
+        auto=None,
+    ):
+        self.fast = fast or DeflateCodec(1)
+        self.strong = strong or DeflateCodec(6)
+        self.stored = StoredCodec()
+        self.auto = auto
+        self.min_size = min_size
+        self.large_size = large_size
+        self.sample_size = sample_size
+        self.stored_ratio = stored_ratio
+        self.strong_ratio = strong_ratio
+        self.stats = {STORED: [0, 0], FAST: [0, 0], STRONG: [0, 0]}
+        self._lock = threading.Lock()
+
+    def classify(self, arcname, size, head):
+        """Returns STORED, FAST or STRONG. `head` is the start of the file."""
+        if size < self.min_size:
+            return STORED
+        ext = os.path.splitext(arcname)[1][1:].lower()
+        if ext in STORED_EXTENSIONS:
+            return STORED
+        if ext not in TEXT_EXTENSIONS:
+            sample = head[: self.sample_size]
+            if sample:
+                ratio = len(zlib.compress(sample, 1)) / len(sample)
+                if ratio >= self.stored_ratio:
+                    return STORED
+                if ratio > self.strong_ratio:
+                    return FAST
+        if size >= self.large_size:
+            return FAST
+        return STRONG
+
+    def choose(self, arcname, size, head):
+        """Returns the codec for a member and records the decision."""
+        decision = self.classify(arcname, size, head)
+        with self._lock:
+            entry = self.stats[decision]
+            entry[0] += 1
+            entry[1] += size
+        if decision == STORED:
+            return self.stored
+        if self.auto is not None:
+            return self.auto.pick(head)
+        if decision == FAST:
+            return self.fast
+        return self.strong
+
+    def summary(self):
+        """One-line report of how many files and bytes went to each decision."""
+        parts = []
+        for decision, (count, nbytes) in self.stats.items():
+            parts.append(f"{decision} {count} files / {nbytes / 1048576:.1f} MB")
+        return "Compression: " + ", ".join(parts)
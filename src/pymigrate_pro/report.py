@@ -0,0 +1,317 @@
+import cProfile
+import heapq
+import json
+import os
+import platform
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+
+from .events import ERROR, MEMBER, PHASE, SKIP
+from .manifest import META_PREFIX
+
+# Name of the report inside an archive, and suffix of the copy next to it.
+REPORT_NAME = META_PREFIX + "report.json"
+REPORT_SUFFIX = ".report.json"
+RESTORE_SUFFIX = ".restore" + REPORT_SUFFIX
+REPORT_VERSION = 1
+# How many of the slowest members, profiled functions and allocation sites
+# are kept, and how many skipped files are listed one by one.
+SLOWEST = 25
+TOP_FUNCTIONS = 40
+TOP_ALLOCATIONS = 20
+SKIPPED_LIMIT = 100000
+
+
+class RunReport:
+    """
+    Records where a backup or restore spent its time, for diagnosing slow
+    runs after the fact.
+
+    Subscribed to the run's EventBus it times every phase (wall clock and
+    process CPU), keeps the SLOWEST members by time taken and lists every
+    skipped or failed file with its reason (up to SKIPPED_LIMIT, counted by
+    reason beyond that). Work that is not a phase is timed in named
+    sections, with section() on the calling thread or timed() around a
+    function worker threads call; sections that run on many threads at
+    once add up to more than the wall clock.
+
+    `profile` runs cProfile on the calling thread and on every thread
+    started while it runs; `memory` traces allocations with tracemalloc.
+    Both slow the run down noticeably.
+    """
+
+    def __init__(self, kind, profile=False, memory=False, options=None):
+        self.kind = kind
+        self.profile = profile
+        self.memory = memory
+        self.options = _plain(options or {})
+        self.archive = None
+        self.sections = {}
+        self.slowest = []  # heap of (seconds, name, size, compressed)
+        self.skipped = []
+        self.skipped_by_reason = {}
+        self._phases = []  # [name, wall start, cpu start]
+        self._lock = threading.Lock()
+        self._profiles = []
+        self._profiling = False
+        self._started = None
+
+    def start(self):
+        self._started = (datetime.now(), time.monotonic(), time.process_time())
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        if self.profile:
+            main = cProfile.Profile()
+            self._profiles.append(main)
+            # Before 3.12 a profiler only sees the thread that enabled it.
+            if sys.version_info < (3, 12):
+                threading.setprofile(self._profile_thread)
+            main.enable()
+            self._profiling = True
+
+    def _profile_thread(self, frame, event, arg):
+        profile = cProfile.Profile()
+        with self._lock:
+            self._profiles.append(profile)
+        profile.enable()
+
+    def __call__(self, event):
+        kind = event.kind
+        if kind == MEMBER:
+            seconds = event.detail.get("seconds")
+            if seconds is None:
+                return
+            item = (seconds, event.name, event.size, event.detail.get("compressed"))
+            with self._lock:
+                if len(self.slowest) < SLOWEST:
+                    heapq.heappush(self.slowest, item)
+                elif seconds > self.slowest[0][0]:
+                    heapq.heapreplace(self.slowest, item)
+        elif kind in (SKIP, ERROR):
+            reason = event.detail.get("reason", "")
+            with self._lock:
+                self.skipped_by_reason[reason] = (
+                    self.skipped_by_reason.get(reason, 0) + 1
+                )
+                if len(self.skipped) < SKIPPED_LIMIT:
+                    self.skipped.append(
+                        {
+                            "name": event.name,
+                            "size": event.size,
+                            "error": kind == ERROR,
+                            "reason": reason,
+                        }
+                    )
+        elif kind == PHASE:
+            with self._lock:
+                self._phases.append([event.name, event.time, time.process_time()])
+
+    def add(self, name, seconds, cpu_seconds=None):
+        """Adds time spent on `name` somewhere else (e.g. another thread)."""
+        with self._lock:
+            section = self.sections.get(name)
+            if section is None:
+                section = self.sections[name] = {
+                    "seconds": 0.0,
+                    "cpu_seconds": 0.0,
+                    "calls": 0,
+                }
+            section["seconds"] += seconds
+            if cpu_seconds is not None:
+                section["cpu_seconds"] += cpu_seconds
+            section["calls"] += 1
+
+    @contextmanager
+    def section(self, name):
+        """Times the body as section `name`."""
+        started = time.perf_counter()
+        cpu = time.thread_time()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - started, time.thread_time() - cpu)
+
+    def timed(self, name, fn):
+        """Wraps `fn` so each call is timed as section `name`."""
+
+        def timed_fn(*args, **kwargs):
+            started = time.perf_counter()
+            cpu = time.thread_time()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.add(name, time.perf_counter() - started, time.thread_time() - cpu)
+
+        return timed_fn
+
+    def to_dict(self, ok=None, message=None, progress=None):
+        """The report so far, as plain data for json.dumps()."""
+        now = time.monotonic()
+        cpu_now = time.process_time()
+        started_at, started, cpu_started = self._started or (
+            datetime.now(),
+            now,
+            cpu_now,
+        )
+        with self._lock:
+            marks = self._phases + [[None, now, cpu_now]]
+            phases = [
+                {
+                    "name": name,
+                    "seconds": round(marks[i + 1][1] - wall, 3),
+                    "cpu_seconds": round(marks[i + 1][2] - cpu, 3),
+                }
+                for i, (name, wall, cpu) in enumerate(marks[:-1])
+            ]
+            sections = {
+                name: {k: round(v, 3) for k, v in section.items()}
+                for name, section in self.sections.items()
+            }
+            slowest = [
+                {
+                    "name": name,
+                    "size": size,
+                    "seconds": round(seconds, 3),
+                    "compressed": compressed,
+                }
+                for seconds, name, size, compressed in sorted(
+                    self.slowest, reverse=True
+                )
+            ]
+            skipped = list(self.skipped)
+            by_reason = dict(self.skipped_by_reason)
+        report = {
+            "version": REPORT_VERSION,
+            "kind": self.kind,
+            "archive": self.archive,
+            "ok": ok,
+            "message": message,
+            "started": started_at.isoformat(timespec="seconds"),
+            "seconds": round(now - started, 3),
+            "cpu_seconds": round(cpu_now - cpu_started, 3),
+            "system": {
+                "platform": platform.platform(),
+                "python": platform.python_version(),
+                "cpus": os.cpu_count(),
+            },
+            "options": self.options,
+            "phases": phases,
+            "sections": sections,
+            "slowest": slowest,
+            "skipped": skipped,
+            "skipped_by_reason": by_reason,
+        }
+        if progress is not None:
+            report["totals"] = {
+                "files": progress.files_done,
+                "files_found": progress.files_total,
+                "bytes": progress.bytes_done,
+                "bytes_found": progress.bytes_total,
+                "bytes_written": progress.bytes_written,
+            }
+        if self.profile:
+            report["profile"] = self._top_functions()
+        if self.memory and tracemalloc.is_tracing():
+            report["memory"] = _memory()
+        return report
+
+    def to_json(self, ok=None, message=None, progress=None):
+        return json.dumps(self.to_dict(ok, message, progress), indent=1)
+
+    def write(self, path, ok=None, message=None, progress=None):
+        """Writes the report to `path`; returns False (and says why) if it fails."""
+        try:
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(self.to_json(ok, message, progress))
+        except OSError as e:
+            print(f"Could not write run report {path}: {e}")
+            return False
+        return True
+
+    def _top_functions(self):
+        with self._lock:
+            profiles = list(self._profiles)
+        stats = None
+        for profile in profiles:
+            try:
+                if stats is None:
+                    stats = pstats.Stats(profile)
+                else:
+                    stats.add(profile)
+            except TypeError:
+                pass  # a thread that never made a call
+        if self._profiling:
+            # Collecting stats turned off profiling on this thread.
+            profiles[0].enable()
+        if stats is None:
+            return []
+        rows = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)
+        return [
+            {
+                "function": f"{os.path.basename(file)}:{line}({name})",
+                "calls": calls,
+                "seconds": round(own, 3),
+                "cumulative": round(cumulative, 3),
+            }
+            for (file, line, name), (_, calls, own, cumulative, _) in rows[
+                :TOP_FUNCTIONS
+            ]
+        ]
+
+    def close(self):
+        """Stops profiling and tracing."""
+        if self._profiling:
+            self._profiling = False
+            threading.setprofile(None)
+            self._profiles[0].disable()
+        if self.memory and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+
+def wants_report(options):
+    """True if `options` ask for a run report that is not being kept yet."""
+    wanted = options.get("report") or options.get("profile")
+    return bool(wanted or options.get("trace_memory")) and not options.get("run_report")
+
+
+def section(report, name):
+    """report.section(name), or a context that does nothing without a report."""
+    return report.section(name) if report is not None else nullcontext()
+
+
+def _memory():
+    current, peak = tracemalloc.get_traced_memory()
+    top = tracemalloc.take_snapshot().statistics("lineno")[:TOP_ALLOCATIONS]
+    return {
+        "current": current,
+        "peak": peak,
+        "top": [
+            {
+                "where": f"{os.path.basename(s.traceback[0].filename)}:"
+                f"{s.traceback[0].lineno}",
+                "size": s.size,
+                "count": s.count,
+            }
+            for s in top
+        ],
+    }
+
+
+def _plain(options):
+    """The options that json.dumps() can write; objects become their type."""
+    plain = {}
+    for key, value in options.items():
+        if value is None or isinstance(value, (bool, int, float, str)):
+            plain[key] = value
+        elif isinstance(value, (list, tuple)) and all(
+            isinstance(v, (bool, int, float, str)) for v in value
+        ):
+            plain[key] = list(value)
+        else:
+            plain[key] = type(value).__name__
+    return plain
@@ -0,0 +1,656 @@
+import errno
+import os
+import shutil
+import struct
+import sys
+import threading
+import time
+import zipfile
+import zlib
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from .codec import for_method
+from .events import BYTES, ERROR, MEMBER, SKIP
+from .manifest import is_meta
+from .scanner import default_workers
+
+# Members at least this big get a task of their own and are streamed.
+LARGE_SIZE = 8 << 20
+# Small members are grouped into tasks of about this many bytes.
+BATCH_BYTES = 32 << 20
+BATCH_MEMBERS = 256
+COPY_SIZE = 1 << 20
+# Large members are copied through bigger buffers (one per worker).
+LARGE_COPY_SIZE = 8 << 20
+# Methods zipfile decompresses itself; codec.py handles any others.
+ZIPFILE_METHODS = (
+    zipfile.ZIP_STORED,
+    zipfile.ZIP_DEFLATED,
+    zipfile.ZIP_BZIP2,
+    zipfile.ZIP_LZMA,
+)
+
+PlannedMember = namedtuple("PlannedMember", "info target")
+
+# How a sync restore classified a member (see RestoreEngine).
+NEW = "new"
+UPDATED = "updated"
+IDENTICAL = "identical"
+
+
+def safe_target(root, arcname):
+    """
+    Maps an archive name to a path below `root`, or None if the name could
+    escape it (absolute paths, drive letters, ".." components).
+    """
+    parts = arcname.split("/")
+    for part in parts:
+        if part in ("", ".", ".."):
+            return None
+        if os.sep in part or (os.altsep and os.altsep in part) or ":" in part:
+            return None
+    return os.path.join(root, *parts)
+
+
+def make_directory(path, root):
+    """
+    Creates directory `path` (and its parents) if it stays inside `root`, a
+    real path; returns False, having created nothing, if it would not (e.g.
+    below a symlink pointing elsewhere). The nearest existing ancestor is
+    checked before anything is created, and `path` itself once it exists.
+    `path` must be `root` or a path below it, as safe_target() makes them.
+    """
+    existing = path
+    # `root` is resolved already, so only the part below it can escape.
+    while len(existing) > len(root) and not os.path.lexists(existing):
+        existing = os.path.dirname(existing)
+    if not _inside(root, os.path.realpath(existing)):
+        return False
+    os.makedirs(path, exist_ok=True)
+    return _inside(root, os.path.realpath(path))
+
+
+def _inside(root, real):
+    try:
+        return os.path.commonpath([root, real]) == root
+    except ValueError:  # another drive
+        return False
+
+
+def restorable(info):
+    """True for members a restore writes out (not metadata or directories)."""
+    return not (is_meta(info.filename) or info.is_dir() or "/" not in info.filename)
+
+
+def open_member(fp, info):
+    """
+    Opens a member for reading straight from a raw file object, using a
+    ZipInfo from an already parsed central directory. This lets workers
+    share one parse of the directory instead of each building a ZipFile.
+    The codec is taken from each member's compression method.
+    """
+    fp.seek(data_offset(fp, info))
+    if info.compress_type in ZIPFILE_METHODS:
+        return zipfile.ZipExtFile(fp, "r", info)
+    try:
+        codec = for_method(info.compress_type)
+    except ValueError as e:
+        raise NotImplementedError(f"{info.filename}: {e}") from None
+    return CodecReader(fp, info, codec.decompressor())
+
+
+def data_offset(fp, info):
+    """Offset of a member's data, found through its local header."""
+    fp.seek(info.header_offset)
+    header = fp.read(30)
+    if len(header) != 30 or header[:4] != b"PK\003\004":
+        raise zipfile.BadZipFile(f"Bad local header for {info.filename}")
+    name_len, extra_len = struct.unpack("<HH", header[26:30])
+    return info.header_offset + 30 + name_len + extra_len
+
+
+def open_entry(zipf, name):
+    """open_member() for a member of an open ZipFile, by name."""
+    return open_member(zipf.fp, zipf.getinfo(name))
+
+
+def first_bad_member(path):
+    """Reads every member of an archive; returns the first corrupt name or None."""
+    with zipfile.ZipFile(path, "r") as zipf:
+        for info in zipf.infolist():
+            try:
+                with open_entry(zipf, info.filename) as src:
+                    while src.read(COPY_SIZE):
+                        pass
+            except (zipfile.BadZipFile, NotImplementedError, OSError, EOFError):
+                return info.filename
+    return None
+
+
+class CodecReader:
+    """
+    Decompresses a member written with a codec zipfile does not know,
+    checking its CRC and size at the end like ZipExtFile does.
+    """
+
+    def __init__(self, fp, info, decompressor):
+        self._fp = fp
+        self._info = info
+        self._decompressor = decompressor
+        self._left = info.compress_size
+        self._buffer = b""
+        self._crc = 0
+        self._size = 0
+        self._eof = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def close(self):
+        pass
+
+    def read(self, n=-1):
+        while not self._eof and (n < 0 or len(self._buffer) < n):
+            raw = self._fp.read(min(self._left, COPY_SIZE))
+            self._left -= len(raw)
+            data = self._decompressor.decompress(raw)
+            if not raw or self._left <= 0:
+                data += self._decompressor.flush()
+                self._eof = True
+            self._crc = zlib.crc32(data, self._crc)
+            self._size += len(data)
+            self._buffer += data
+        if n < 0:
+            out, self._buffer = self._buffer, b""
+        else:
+            out, self._buffer = self._buffer[:n], self._buffer[n:]
+        if self._eof and not self._buffer:
+            self._check()
+        return out
+
+    def _check(self):
+        if self._size != self._info.file_size or self._crc != self._info.CRC:
+            raise zipfile.BadZipFile(f"Bad CRC-32 for file {self._info.filename!r}")
+
+
+class TargetMap:
+    """
+    Maps archive names ("User/Folder/...") to paths on disk. Every user is
+    restored below `root` under their own name unless `user_map` sends them
+    elsewhere: to another user name below `root` ({"UserA": "UserB"}) or to
+    an absolute folder ({"UserA": "D:\\Recovered\\UserA"}).
+    """
+
+    def __init__(self, root, user_map=None):
+        self.root = os.path.realpath(root)
+        self.user_map = dict(user_map or {})
+        for user, dest in self.user_map.items():
+            if not os.path.isabs(dest) and (
+                "/" in dest or safe_target(self.root, dest) is None
+            ):
+                raise ValueError(f"Cannot map {user} to {dest!r}")
+        self._roots = {}
+
+    def user_root(self, user):
+        root = self._roots.get(user)
+        if root is None:
+            dest = self.user_map.get(user, user)
+            if not os.path.isabs(dest):
+                dest = os.path.join(self.root, dest)
+            root = self._roots[user] = os.path.realpath(dest)
+        return root
+
+    def target(self, arcname):
+        """The path for `arcname`, or None if the name could escape its root."""
+        user, _, rest = arcname.partition("/")
+        if not rest or safe_target(self.root, user) is None:
+            return None
+        return safe_target(self.user_root(user), rest)
+
+
+class ExtractionPlan:
+    """
+    Everything a restore will do, worked out before any data is read:
+    the directories to create (once each), and the members in archive
+    order, split into small ones and large ones.
+    """
+
+    def __init__(self, targets):
+        self.targets = targets
+        self.directories = []  # (directory, user root it must stay in)
+        self.small = []
+        self.large = []
+        self.rejected = []
+
+    @classmethod
+    def build(cls, infolist, root, large_size=LARGE_SIZE, targets=None):
+        plan = cls(targets or TargetMap(root))
+        directories = {}
+        for info in sorted(infolist, key=lambda i: i.header_offset):
+            if not restorable(info):
+                continue
+            name = info.filename
+            target = plan.targets.target(name)
+            if target is None:
+                plan.rejected.append(name)
+                continue
+            directories[os.path.dirname(target)] = plan.targets.user_root(
+                name.partition("/")[0]
+            )
+            member = PlannedMember(info, target)
+            if info.file_size >= large_size:
+                plan.large.append(member)
+            else:
+                plan.small.append(member)
+        plan.directories = sorted(directories.items())
+        return plan
+
+    def __len__(self):
+        return len(self.small) + len(self.large)
+
+    def create_directories(self):
+        """
+        Creates every target directory once. Members whose directory resolves
+        outside its user's root (e.g. through a symlink) are moved to
+        `rejected`, and nothing is created for them.
+        """
+        escaped = set()
+        for d, root in self.directories:
+            if not make_directory(d, root):
+                escaped.add(d)
+        if escaped:
+            for members in (self.small, self.large):
+                keep = []
+                for m in members:
+                    if os.path.dirname(m.target) in escaped:
+                        self.rejected.append(m.info.filename)
+                    else:
+                        keep.append(m)
+                members[:] = keep
+
+    def batches(self):
+        """Yields lists of members; one list is one task for a worker."""
+        batch, batch_bytes = [], 0
+        for m in self.small:
+            batch.append(m)
+            batch_bytes += m.info.file_size
+            if len(batch) >= BATCH_MEMBERS or batch_bytes >= BATCH_BYTES:
+                yield batch
+                batch, batch_bytes = [], 0
+        if batch:
+            yield batch
+        for m in self.large:
+            yield [m]
+
+
+class RestoreEngine:
+    """
+    Extracts an archive on a pool of worker threads. Each worker opens its
+    own handle on the archive, so reads never contend on a shared file
+    object, and copies through a fixed-size buffer, so memory is bounded by
+    the worker count rather than by member sizes.
+
+    With `resume` set, members already present on disk are skipped: those a
+    RestoreJournal lists as done need only a size match, anything else must
+    also match the member's CRC.
+
+    With `sync` set, the target folders are listed up front and every
+    member is compared with what is there: missing files are NEW, files of
+    another size are UPDATED, and files whose size and mtime match are
+    IDENTICAL and left alone. When only the mtime differs the file's CRC
+    decides. Counts and bytes per class are kept in `stats`.
+
+    Members are given the mtimes passed in `mtimes` ({arcname: ns}).
+    With an EventBus, bytes written, finished members, skips and failures
+    are reported as they happen. Set `report` to a report.RunReport to time
+    the extraction.
+    """
+
+    def __init__(
+        self,
+        workers=None,
+        large_size=LARGE_SIZE,
+        resume=False,
+        events=None,
+        sync=False,
+    ):
+        self.workers = max(1, workers or default_workers())
+        self.large_size = large_size
+        self.resume = resume
+        self.sync = sync
+        self.events = events
+        self.failed = []
+        self.skipped = 0
+        self.stats = {NEW: [0, 0], UPDATED: [0, 0], IDENTICAL: [0, 0]}
+        self.report = None
+
+    def run(
+        self,
+        archive_path,
+        root,
+        progress_callback=None,
+        infolist=None,
+        journal=None,
+        targets=None,
+        mtimes=None,
+    ):
+        """
+        Restores every member below `root`, or where a TargetMap sends it.
+        Pass `infolist` if the caller has already read the central directory
+        (or only wants some members). Finished members are logged to
+        `journal` if given. Returns the ExtractionPlan.
+        """
+        mtimes = mtimes or {}
+        done_before = journal.done if journal is not None else ()
+        if infolist is None:
+            with zipfile.ZipFile(archive_path, "r") as zipf:
+                infolist = zipf.infolist()
+        plan = ExtractionPlan.build(infolist, root, self.large_size, targets)
+        plan.create_directories()
+        events = self.events
+        if events is not None and plan.rejected:
+            sizes = {info.filename: info.file_size for info in infolist}
+            for name in plan.rejected:
+                events.emit(SKIP, name, sizes[name], reason="unsafe path")
+        existing = None
+        if self.sync:
+            existing = scan_existing([d for d, _ in plan.directories], self.workers)
+
+        local = threading.local()
+        handles = []
+        handles_lock = threading.Lock()
+
+        def handle():
+            fp = getattr(local, "fp", None)
+            if fp is None:
+                fp = local.fp = open(archive_path, "rb")  # noqa: SIM115
+                with handles_lock:
+                    handles.append(fp)
+            return fp
+
+        def work(batch):
+            fp = handle()
+            failed = []
+            skipped = 0
+            counts = {}
+            for m in batch:
+                info = m.info
+                mtime_ns = mtimes.get(info.filename)
+                state = None
+                try:
+                    if existing is not None:
+                        state = compare(m.target, info, mtime_ns, existing)
+                        if state == IDENTICAL:
+                            count = counts.setdefault(state, [0, 0])
+                            count[0] += 1
+                            count[1] += info.file_size
+                            skipped += 1
+                            if events is not None:
+                                events.emit(
+                                    SKIP,
+                                    info.filename,
+                                    info.file_size,
+                                    reason="identical",
+                                )
+                            continue
+                    elif self.resume and verified_on_disk(
+                        m.target, info, info.filename in done_before
+                    ):
+                        skipped += 1
+                        if events is not None:
+                            events.emit(
+                                SKIP, info.filename, info.file_size, reason="on disk"
+                            )
+                        continue
+                    started = time.monotonic()
+                    if info.file_size >= self.large_size:
+                        extract_large(fp, info, m.target, events)
+                    else:
+                        extract_member(fp, info, m.target, events)
+                    if mtime_ns is not None:
+                        os.utime(m.target, ns=(mtime_ns, mtime_ns))
+                    if state is not None:
+                        count = counts.setdefault(state, [0, 0])
+                        count[0] += 1
+                        count[1] += info.file_size
+                    if events is not None:
+                        events.emit(
+                            MEMBER,
+                            info.filename,
+                            info.file_size,
+                            compressed=info.compress_size,
+                            seconds=time.monotonic() - started,
+                        )
+                except Exception as e:  # noqa: BLE001
+                    failed.append((info.filename, e))
+                    if events is not None:
+                        events.emit(ERROR, info.filename, info.file_size, reason=str(e))
+            return batch, failed, skipped, counts
+
+        total = len(plan)
+        done = 0
+        try:
+            with ThreadPoolExecutor(self.workers) as pool:
+                if self.report is not None:
+                    work = self.report.timed("extract", work)
+                futures = [pool.submit(work, b) for b in plan.batches()]
+                for fut in as_completed(futures):
+                    batch, failed, skipped, counts = fut.result()
+                    self.failed.extend(failed)
+                    self.skipped += skipped
+                    for state, (n, size) in counts.items():
+                        self.stats[state][0] += n
+                        self.stats[state][1] += size
+                    if journal is not None:
+                        bad = {name for name, _ in failed}
+                        journal.append(
+                            m.info.filename for m in batch if m.info.filename not in bad
+                        )
+                    done += len(batch)
+                    if progress_callback:
+                        progress_callback(batch[-1].info.filename, done / total)
+        finally:
+            for fp in handles:
+                fp.close()
+        return plan
+
+
+def verified_on_disk(target, info, trusted):
+    """True if `target` already holds the member (size, then CRC unless trusted)."""
+    try:
+        if os.path.getsize(target) != info.file_size:
+            return False
+    except OSError:
+        return False
+    if trusted:
+        return True
+    return file_crc(target) == info.CRC
+
+
+def file_crc(path):
+    crc = 0
+    with open(path, "rb") as f:
+        while True:
+            data = f.read(COPY_SIZE)
+            if not data:
+                break
+            crc = zlib.crc32(data, crc)
+    return crc
+
+
+def scan_existing(directories, workers=None):
+    """
+    Lists the files in `directories` (not below them) on a thread pool and
+    returns {path: (size, mtime_ns)}. One scandir per folder is much
+    cheaper than a stat per archive member on a large profile.
+    """
+
+    def scan(directory):
+        found = {}
+        try:
+            with os.scandir(directory) as it:
+                for entry in it:
+                    try:
+                        if entry.is_file(follow_symlinks=False):
+                            st = entry.stat(follow_symlinks=False)
+                            found[entry.path] = (st.st_size, st.st_mtime_ns)
+                    except OSError:
+                        pass
+        except OSError:
+            pass
+        return found
+
+    existing = {}
+    with ThreadPoolExecutor(max(1, workers or default_workers())) as pool:
+        for found in pool.map(scan, directories):
+            existing.update(found)
+    return existing
+
+
+def compare(target, info, mtime_ns, existing):
+    """
+    Classifies a member against the pre-scanned target (NEW, UPDATED or
+    IDENTICAL). A file that only differs in mtime but has the member's CRC
+    is IDENTICAL, and gets the member's mtime so the next run can tell
+    without reading it.
+    """
+    known = existing.get(target)
+    if known is None:
+        return NEW
+    size, disk_mtime = known
+    if size != info.file_size:
+        return UPDATED
+    if mtime_ns is not None and disk_mtime == mtime_ns:
+        return IDENTICAL
+    try:
+        if file_crc(target) != info.CRC:
+            return UPDATED
+        if mtime_ns is not None:
+            os.utime(target, ns=(mtime_ns, mtime_ns))
+    except OSError:
+        return UPDATED
+    return IDENTICAL
+
+
+def extract_member(fp, info, target, events=None):
+    with open_member(fp, info) as src, open(target, "wb") as dst:
+        if events is None:
+            shutil.copyfileobj(src, dst, COPY_SIZE)
+            return
+        while True:
+            data = src.read(COPY_SIZE)
+            if not data:
+                break
+            dst.write(data)
+            events.emit(BYTES, info.filename, len(data))
+
+
+def extract_large(fp, info, target, events=None):
+    """
+    Extracts a big member: the target is preallocated so it is laid out in
+    one piece, stored members are copied by the kernel (see copy_range)
+    and then checked against their CRC, and everything else goes through
+    LARGE_COPY_SIZE buffers. Memory use stays at one buffer.
+    """
+    if info.compress_type != zipfile.ZIP_STORED:
+        with open_member(fp, info) as src, open(target, "wb") as dst:
+            preallocate(dst.fileno(), info.file_size)
+            while True:
+                data = src.read(LARGE_COPY_SIZE)
+                if not data:
+                    break
+                dst.write(data)
+                if events is not None:
+                    events.emit(BYTES, info.filename, len(data))
+        return
+
+    offset = data_offset(fp, info)
+    with open(target, "wb", buffering=0) as dst:
+        preallocate(dst.fileno(), info.file_size)
+        copy_range(fp, dst, offset, info.file_size, events, info.filename)
+    crc = 0
+    with open(target, "rb", buffering=0) as f:
+        while True:
+            data = f.read(LARGE_COPY_SIZE)
+            if not data:
+                break
+            crc = zlib.crc32(data, crc)
+    if crc != info.CRC:
+        raise zipfile.BadZipFile(f"Bad CRC-32 for file {info.filename!r}")
+
+
+def preallocate(fd, size):
+    """Reserves `size` bytes for a new file where the OS supports it."""
+    if size <= 0:
+        return
+    if hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(fd, 0, size)
+            return
+        except OSError:
+            pass  # not supported by this file system
+    # Setting the length allocates the file on NTFS.
+    os.ftruncate(fd, size)
+    os.lseek(fd, 0, os.SEEK_SET)
+
+
+# Kernel copy paths still believed to work; dropped after the first failure.
+_KERNEL_COPY = [name for name in ("copy_file_range", "sendfile") if hasattr(os, name)]
+if sys.platform != "linux":
+    # sendfile() elsewhere only writes to sockets.
+    _KERNEL_COPY = [name for name in _KERNEL_COPY if name != "sendfile"]
+# Errors meaning "not possible between these two files", not a failed copy.
+_UNSUPPORTED = {
+    errno.EXDEV,
+    errno.ENOSYS,
+    errno.EINVAL,
+    errno.EOPNOTSUPP,
+    errno.ENOTSUP,
+    errno.EBADF,
+}
+
+
+def copy_range(fp, dst, offset, count, events=None, name=None):
+    """
+    Copies `count` bytes from `offset` in `fp` to the current position of
+    the unbuffered file `dst`. copy_file_range() or sendfile() move the
+    data inside the kernel (and copy_file_range may share the blocks on
+    copy-on-write file systems); otherwise it is read and written in
+    LARGE_COPY_SIZE blocks.
+    """
+    src_fd = fp.fileno()
+    dst_fd = dst.fileno()
+    done = 0
+    while done < count:
+        n = min(LARGE_COPY_SIZE, count - done)
+        sent = 0
+        for path in list(_KERNEL_COPY):
+            try:
+                if path == "copy_file_range":
+                    sent = os.copy_file_range(src_fd, dst_fd, n, offset + done)
+                else:
+                    sent = os.sendfile(dst_fd, src_fd, offset + done, n)
+                break
+            except OSError as e:
+                if e.errno not in _UNSUPPORTED:
+                    raise
+                try:
+                    _KERNEL_COPY.remove(path)
+                except ValueError:
+                    pass  # another worker got there first
+        if not sent:
+            fp.seek(offset + done)
+            data = fp.read(n)
+            if not data:
+                raise zipfile.BadZipFile(f"Truncated member {name!r}")
+            view = memoryview(data)
+            while view:
+                view = view[dst.write(view) :]
+            sent = len(data)
+        done += sent
+        if events is not None:
+            events.emit(BYTES, name, sent)
@@ -0,0 +1,323 @@
+import re
+import threading
+import time
+
+from .events import format_bytes
+
+DAY_NS = 86400 * 10**9
+
+
+def glob_to_regex(pattern):
+    """
+    Translates a path glob to a regex: "*" and "?" stay within one path
+    component, "**" spans any number of them.
+    """
+    out = []
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith("**/", i):
+            out.append("(?:.*/)?")
+            i += 3
+        elif pattern.startswith("**", i):
+            out.append(".*")
+            i += 2
+        elif pattern[i] == "*":
+            out.append("[^/]*")
+            i += 1
+        elif pattern[i] == "?":
+            out.append("[^/]")
+            i += 1
+        else:
+            out.append(re.escape(pattern[i]))
+            i += 1
+    return "".join(out)
+
+
+class Rule:
+    """
+    One exclusion, named for the report.
+
+    `patterns` are globs matched without regard to case. A pattern without
+    a "/" matches a file name anywhere ("*.tmp"); one with a "/" matches
+    the path below the user's profile ("AppData/Roaming/Thunderbird/**").
+    A trailing "/" makes it match directories instead ("node_modules/"),
+    which are then not descended into at all.
+
+    `max_size` (bytes) and `max_age_days` exclude files that are bigger or
+    were last modified longer ago; with patterns as well, only matching
+    files are checked. `folders` limits the rule to those folders of the
+    profile (e.g. ["Documents"]).
+    """
+
+    def __init__(
+        self, name, patterns=(), max_size=None, max_age_days=None, folders=None
+    ):
+        self.name = name
+        self.patterns = list(patterns)
+        self.max_size = max_size
+        self.max_age_days = max_age_days
+        self.folders = [f.strip("/").lower() for f in folders or ()]
+
+    def __repr__(self):
+        return f"Rule({self.name!r})"
+
+
+# Built-in rule sets, by name.
+PROFILES = {
+    "temp": [
+        Rule(
+            "temporary files",
+            ["*.tmp", "*.temp", "*.crdownload", "*.partial"],
+        ),
+        Rule(
+            "lock files",
+            ["~$*", ".~lock.*#", "*.lck", "parent.lock", ".parentlock"],
+        ),
+        Rule("thumbnail caches", ["Thumbs.db", "ehthumbs.db", ".DS_Store"]),
+    ],
+    "mail": [
+        Rule(
+            "mail client caches",
+            [
+                "AppData/Roaming/Thunderbird/Crash Reports/",
+                "AppData/Roaming/Thunderbird/Profiles/*/cache2/",
+                "AppData/Roaming/Thunderbird/Profiles/*/startupCache/",
+                "AppData/Roaming/Thunderbird/Profiles/*/crashes/",
+                "AppData/Roaming/Thunderbird/Profiles/*/minidumps/",
+                "AppData/Roaming/Thunderbird/Profiles/*/datareporting/",
+                "AppData/Roaming/Thunderbird/Profiles/*/saved-telemetry-pings/",
+                "AppData/Roaming/Thunderbird/Profiles/*/shader-cache/",
+            ],
+        ),
+        # Offline copies of server mailboxes. Outlook can download them
+        # again, but for IMAP accounts the .ost is the only local store.
+        Rule("outlook offline caches", ["*.ost"]),
+    ],
+    "dev": [
+        Rule(
+            "dependency folders",
+            ["node_modules/", "bower_components/", ".venv/", ".tox/", ".gradle/"],
+        ),
+        Rule(
+            "build caches",
+            [
+                "__pycache__/",
+                ".pytest_cache/",
+                ".mypy_cache/",
+                ".ruff_cache/",
+                ".next/",
+                ".parcel-cache/",
+                "*.pyc",
+            ],
+        ),
+    ],
+}
+# "mail" is opt-in: the mail folders are backed up only when asked for,
+# and then users expect all of them.
+DEFAULT_PROFILES = ("temp", "dev")
+
+
+def build_rules(
+    profiles=DEFAULT_PROFILES, exclude=(), max_size=None, max_age_days=None
+):
+    """
+    The Rules for a backup: the named built-in profiles, extra `exclude`
+    patterns, and global size and age limits. Raises ValueError for an
+    unknown profile.
+    """
+    rules = []
+    for name in profiles or ():
+        if name not in PROFILES:
+            choices = ", ".join(PROFILES)
+            raise ValueError(
+                f"Unknown exclusion profile {name!r} (choose from {choices})"
+            )
+        rules.extend(PROFILES[name])
+    if exclude:
+        rules.append(Rule("--exclude", exclude))
+    if max_size is not None:
+        rules.append(Rule("size limit", max_size=max_size))
+    if max_age_days is not None:
+        rules.append(Rule("age limit", max_age_days=max_age_days))
+    return rules
+
+
+class _Patterns:
+    """The patterns of one or more rules, for either files or directories."""
+
+    def __init__(self):
+        self.names = {}  # exact lower-case name -> rule
+        self.name_globs = []  # (rule index, regex)
+        self.path_globs = []
+
+    def add(self, index, rule, pattern):
+        if "/" in pattern:
+            self.path_globs.append((index, glob_to_regex(pattern.strip("/"))))
+        elif "*" in pattern or "?" in pattern:
+            self.name_globs.append((index, glob_to_regex(pattern)))
+        else:
+            self.names.setdefault(pattern.lower(), rule)
+
+    def compile(self):
+        self.name_regex = _combine(self.name_globs)
+        self.path_regex = _combine(self.path_globs)
+
+    def match(self, rules, name, rel):
+        rule = self.names.get(name.lower())
+        if rule is not None:
+            return rule
+        for regex, text in ((self.name_regex, name), (self.path_regex, rel)):
+            if regex is not None:
+                m = regex.fullmatch(text)
+                if m is not None:
+                    return rules[int(m.lastgroup[1:])]
+        return None
+
+
+def _combine(globs):
+    """One regex for many globs; the named group that matched is the rule."""
+    if not globs:
+        return None
+    by_rule = {}
+    for index, regex in globs:
+        by_rule.setdefault(index, []).append(regex)
+    return re.compile(
+        "|".join(f"(?P<r{i}>{'|'.join(rs)})" for i, rs in by_rule.items()),
+        re.IGNORECASE,
+    )
+
+
+class RuleMatcher:
+    """
+    Rules compiled once for use during a scan.
+
+    Plain names go into a dict and all globs of a kind into one regex, so
+    testing an entry costs a lookup and a regex match or two however many
+    rules there are. Size and age limits are only checked for files that
+    get that far. Rules limited to some folders are kept apart and only
+    tried on entries in those folders.
+
+    skip_dir() and skip_file() are safe to call from the scanner threads and
+    count what each rule excluded in `stats` ({rule name: [dirs, files,
+    bytes]}). Bytes below a skipped directory are not known, which is the
+    point of skipping it.
+    """
+
+    def __init__(self, rules, now_ns=None):
+        self.rules = list(rules)
+        now_ns = time.time_ns() if now_ns is None else now_ns
+        self.stats = {}
+        self._lock = threading.Lock()
+        self._dirs = _Patterns()
+        self._files = _Patterns()
+        self._limits = []  # (rule, oldest mtime_ns kept, its _Patterns or None)
+        self._scoped = []  # (folders, RuleMatcher) for folder-limited rules
+        for index, rule in enumerate(self.rules):
+            if rule.folders:
+                unscoped = Rule(
+                    rule.name, rule.patterns, rule.max_size, rule.max_age_days
+                )
+                self._scoped.append((rule.folders, RuleMatcher([unscoped], now_ns)))
+                continue
+            for pattern in rule.patterns:
+                if pattern.endswith("/"):
+                    self._dirs.add(index, rule, pattern.rstrip("/"))
+                elif rule.max_size is None and rule.max_age_days is None:
+                    self._files.add(index, rule, pattern)
+            if rule.max_size is not None or rule.max_age_days is not None:
+                oldest = None
+                if rule.max_age_days is not None:
+                    oldest = now_ns - int(rule.max_age_days * DAY_NS)
+                limited = _Patterns()
+                for pattern in rule.patterns:
+                    if not pattern.endswith("/"):
+                        limited.add(0, rule, pattern)
+                limited.compile()
+                self._limits.append((rule, oldest, limited if rule.patterns else None))
+        self._dirs.compile()
+        self._files.compile()
+
+    def __bool__(self):
+        return bool(self.rules)
+
+    def match_dir(self, arcname):
+        """The Rule excluding directory `arcname` ("user/rel/path"), or None."""
+        rel = arcname.partition("/")[2]
+        name = rel.rpartition("/")[2]
+        rule = self._dirs.match(self.rules, name, rel)
+        if rule is None:
+            for folders, matcher in self._scoped:
+                if _within(rel, folders):
+                    rule = matcher.match_dir(arcname)
+                    if rule is not None:
+                        break
+        return rule
+
+    def match_file(self, arcname, size, mtime_ns):
+        """The Rule excluding file `arcname`, or None."""
+        rel = arcname.partition("/")[2]
+        name = rel.rpartition("/")[2]
+        rule = self._files.match(self.rules, name, rel)
+        if rule is not None:
+            return rule
+        for rule, oldest, limited in self._limits:
+            if rule.max_size is not None and size <= rule.max_size:
+                continue
+            if oldest is not None and mtime_ns >= oldest:
+                continue
+            if limited is None or limited.match([rule], name, rel) is not None:
+                return rule
+        for folders, matcher in self._scoped:
+            if _within(rel, folders):
+                rule = matcher.match_file(arcname, size, mtime_ns)
+                if rule is not None:
+                    return rule
+        return None
+
+    def skip_dir(self, arcname):
+        rule = self.match_dir(arcname)
+        if rule is not None:
+            self._count(rule, 1, 0, 0)
+        return rule is not None
+
+    def skip_file(self, arcname, size, mtime_ns):
+        rule = self.match_file(arcname, size, mtime_ns)
+        if rule is not None:
+            self._count(rule, 0, 1, size)
+        return rule is not None
+
+    def excludes(self, arcname, size, mtime_ns):
+        """
+        True if a scan would leave `arcname` out, through its own rules or a
+        skipped parent directory. Nothing is counted.
+        """
+        parts = arcname.split("/")
+        for i in range(2, len(parts)):
+            if self.match_dir("/".join(parts[:i])) is not None:
+                return True
+        return self.match_file(arcname, size, mtime_ns) is not None
+
+    def _count(self, rule, dirs, files, size):
+        with self._lock:
+            counts = self.stats.get(rule.name)
+            if counts is None:
+                counts = self.stats[rule.name] = [0, 0, 0]
+            counts[0] += dirs
+            counts[1] += files
+            counts[2] += size
+
+    def summary(self):
+        parts = []
+        for name, (dirs, files, size) in sorted(self.stats.items()):
+            counts = []
+            if dirs:
+                counts.append(f"{dirs} folders")
+            if files:
+                counts.append(f"{files} files / {format_bytes(size)}")
+            parts.append(f"{name} {', '.join(counts)}")
+        return "Excluded: " + ("; ".join(parts) if parts else "nothing")
+
+
+def _within(rel, folders):
+    rel = rel.lower()
+    return any(rel == f or rel.startswith(f + "/") for f in folders)
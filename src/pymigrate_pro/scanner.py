@@ -0,0 +1,186 @@
+import os
+import queue
+import threading
+from collections import namedtuple
+
+# A file found during the scan. Size and mtime come from the scandir entry, so
+# later stages never need to stat the file again.
+ScanEntry = namedtuple("ScanEntry", "path arcname size mtime_ns")
+
+# A folder to scan: files below `path` are archived as "<arc_prefix>/<rel>".
+ScanRoot = namedtuple("ScanRoot", "username path arc_prefix")
+
+# A directory that could not be read.
+ScanError = namedtuple("ScanError", "path error")
+
+_DONE = object()
+
+
+def default_workers():
+    """Default worker count for I/O bound stages."""
+    return min(32, (os.cpu_count() or 1) + 4)
+
+
+class ScanManifest:
+    """Compact list of everything a scan found."""
+
+    def __init__(self):
+        self.entries = []
+        self.errors = []
+        self.total_bytes = 0
+
+    def add(self, entry):
+        self.entries.append(entry)
+        self.total_bytes += entry.size
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(self.entries)
+
+
+class ProfileScanner:
+    """
+    Walks user folders with os.scandir on a bounded pool of worker threads.
+    Every directory is a unit of work, so users, folders and subtrees are all
+    scanned concurrently.
+
+    With a RuleMatcher as `rules`, excluded files are left out and excluded
+    directories are never entered. With a Throttle, every directory read
+    counts against its I/O rate.
+    """
+
+    def __init__(self, workers=None, batch_size=512, rules=None, throttle=None):
+        self.workers = max(1, workers or default_workers())
+        self.batch_size = batch_size
+        self.rules = rules or None
+        self.throttle = throttle
+
+    @staticmethod
+    def make_roots(username, user_root, folder_paths):
+        """
+        Builds scan roots for one user. Folders nested inside another selected
+        folder (e.g. "Outlook Files" inside "Documents") are dropped so their
+        files are not archived twice.
+        """
+        roots = []
+        prefixes = []
+        for path in sorted(folder_paths, key=len):
+            rel = os.path.relpath(path, user_root).replace(os.sep, "/")
+            prefix = f"{username}/{rel}"
+            if any(prefix == p or prefix.startswith(p + "/") for p in prefixes):
+                continue
+            prefixes.append(prefix)
+            roots.append(ScanRoot(username, path, prefix))
+        return roots
+
+    def iter_scan(self, roots):
+        """
+        Yields ScanEntry and ScanError items as directories are read. Order is
+        not deterministic. Closing the generator early stops the workers.
+        """
+        work = queue.Queue()
+        out = queue.Queue(maxsize=self.workers * 4)
+        stop = threading.Event()
+        state = {"pending": len(roots)}
+        lock = threading.Lock()
+
+        if not roots:
+            return
+
+        for root in roots:
+            work.put((root.path, root.arc_prefix))
+
+        def emit(item):
+            while not stop.is_set():
+                try:
+                    out.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    continue
+
+        def worker():
+            while True:
+                item = work.get()
+                if item is None:
+                    return
+                path, prefix = item
+                try:
+                    if not stop.is_set():
+                        self._scan_dir(path, prefix, work, lock, state, emit)
+                except OSError as e:
+                    emit(ScanError(path, e))
+                finally:
+                    with lock:
+                        state["pending"] -= 1
+                        finished = state["pending"] == 0
+                    if finished:
+                        for _ in range(self.workers):
+                            work.put(None)
+                        emit(_DONE)
+
+        threads = [
+            threading.Thread(target=worker, daemon=True) for _ in range(self.workers)
+        ]
+        for t in threads:
+            t.start()
+
+        try:
+            while True:
+                item = out.get()
+                if item is _DONE:
+                    break
+                if isinstance(item, list):
+                    yield from item
+                else:
+                    yield item
+        finally:
+            stop.set()
+            for t in threads:
+                t.join()
+
+    def _scan_dir(self, path, prefix, work, lock, state, emit):
+        batch = []
+        rules = self.rules
+        if self.throttle is not None:
+            self.throttle.op()
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    arcname = f"{prefix}/{entry.name}"
+                    if entry.is_dir(follow_symlinks=False):
+                        if rules is not None and rules.skip_dir(arcname):
+                            continue
+                        with lock:
+                            state["pending"] += 1
+                        work.put((entry.path, arcname))
+                    elif entry.is_file():
+                        st = entry.stat()
+                        if rules is not None and rules.skip_file(
+                            arcname, st.st_size, st.st_mtime_ns
+                        ):
+                            continue
+                        batch.append(
+                            ScanEntry(entry.path, arcname, st.st_size, st.st_mtime_ns)
+                        )
+                        if len(batch) >= self.batch_size:
+                            emit(batch)
+                            batch = []
+                except OSError as e:
+                    emit(ScanError(entry.path, e))
+        if batch:
+            emit(batch)
+
+    def scan(self, roots, progress_callback=None):
+        """Scans all roots and returns a ScanManifest."""
+        manifest = ScanManifest()
+        for item in self.iter_scan(roots):
+            if isinstance(item, ScanError):
+                manifest.errors.append(item)
+                continue
+            manifest.add(item)
+            if progress_callback and len(manifest) % 50 == 0:
+                name = item.arcname.rsplit("/", 1)[-1]
+                progress_callback(f"Scanning: {name}...", 0)
+        return manifest
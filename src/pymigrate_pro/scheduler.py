@@ -0,0 +1,278 @@
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime
+
+from .backend import NOTHING_FOUND, ProfileBackend
+from .estimator import SizeEstimator, total
+from .events import (
+    BYTES,
+    DONE,
+    PHASE,
+    SCAN,
+    THROTTLE,
+    TRANSFER,
+    EventBus,
+    format_bytes,
+    summarize,
+)
+from .manifest import BATCH_SUFFIX, FULL, INCREMENTAL, BatchManifest, is_batch
+
+# Child processes send their events up in batches this often (seconds).
+FORWARD_INTERVAL = 0.25
+# Options that belong to the whole batch and are not passed to a shard.
+_BATCH_OPTIONS = ("events", "event_log", "resume", "base_archive", "archive_name")
+
+
+class BatchScheduler:
+    """
+    Backs up each user into an archive of their own, several users at a
+    time, and writes a batch manifest (.pmigbatch) naming the shards.
+
+    Every shard is an ordinary .pmig written by create_batch_backup in a
+    process of its own, so one user's failure or crash only loses that
+    shard, and a single user can be restored from their shard alone. At
+    most `jobs` shards are written at once. Users are started largest
+    first (by the size estimate of their folders), so a big profile is not
+    left to run alone at the end.
+
+    Each process gets its share of the throttling caps and of the CPUs for
+    compression. Their progress events are forwarded to the "events" bus
+    of the batch, so one ProgressTracker follows the whole batch.
+    """
+
+    def __init__(self, backend=None, jobs=None, estimator=None):
+        self.backend = backend or ProfileBackend()
+        self.jobs = jobs
+        self.estimator = estimator
+
+    def run(
+        self, user_selection_map, destination_path, options, progress_callback=None
+    ):
+        """
+        Takes the arguments of create_batch_backup and returns (ok, msg);
+        ok only if every shard was written. "base_archive" may be an
+        earlier .pmigbatch, whose shards become the bases of the new ones;
+        users without a shard there get a full backup. "resume" is not
+        supported: rerun the batch, or back up a failed user on their own.
+        """
+        options = options or {}
+        backend = self.backend
+        if options.get("resume"):
+            return False, "Sharded backups cannot be resumed; run the batch again."
+        base_path = options.get("base_archive")
+        bases = {}
+        if base_path:
+            if not is_batch(base_path):
+                return False, f"{base_path} is not a batch manifest ({BATCH_SUFFIX})."
+            try:
+                bases = dict(BatchManifest.load(base_path).archives(base_path))
+            except (OSError, ValueError, KeyError) as e:
+                return False, f"Cannot read {base_path}: {e}"
+
+        events, tracker, subscribers = backend._watch(options, progress_callback)
+        try:
+            events.emit(PHASE, SCAN)
+            sizes = self._estimate(user_selection_map)
+            users = sorted(user_selection_map, key=lambda u: sizes[u], reverse=True)
+            jobs = max(1, min(len(users), self.jobs or _default_jobs()))
+            child = _child_options(options, jobs)
+
+            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+            batch = BatchManifest(INCREMENTAL if bases else FULL, None)
+            if base_path:
+                batch.base = os.path.basename(base_path)
+            batch_path = os.path.join(destination_path, f"MultiBackup_{timestamp}")
+            batch_path += BATCH_SUFFIX
+
+            events.emit(PHASE, TRANSFER)
+            tasks = {}
+            for user in users:
+                suffix = "_incr" if user in bases else ""
+                name = f"MultiBackup_{timestamp}_{user}{suffix}.pmig"
+                user_options = dict(
+                    child, archive_name=name, base_archive=bases.get(user)
+                )
+                tasks[user] = (
+                    name,
+                    (
+                        backend.users_dir,
+                        user,
+                        user_selection_map[user],
+                        destination_path,
+                        user_options,
+                    ),
+                )
+            ctx = multiprocessing.get_context("spawn")
+            queue = ctx.Queue()
+            relay = threading.Thread(target=_relay, args=(queue, events), daemon=True)
+            relay.start()
+            try:
+                results, broken = _run_pool(ctx, queue, jobs, tasks)
+                # A process that dies takes the pool and everything queued
+                # in it down; run those users again one at a time to find
+                # out which of them actually crashes.
+                for user in broken:
+                    done, _ = _run_pool(ctx, queue, 1, {user: tasks[user]})
+                    results[user] = done.get(user) or (
+                        False,
+                        "Backup process crashed.",
+                    )
+            finally:
+                queue.put(None)
+                relay.join()
+
+            for user in users:
+                ok, msg = results[user]
+                name = tasks[user][0]
+                if not ok and msg == NOTHING_FOUND:
+                    batch.shards[user] = _shard(None, True, msg)
+                else:
+                    batch.shards[user] = _shard(name if ok else None, ok, msg)
+            batch.save(batch_path)
+            events.emit(PHASE, DONE, archive=batch_path)
+
+            failed = [u for u, shard in batch.shards.items() if not shard["ok"]]
+            written = sum(1 for shard in batch.shards.values() if shard["archive"])
+            msg = f"Batch manifest created: {batch_path}"
+            msg += f"\n{written} of {len(users)} users backed up in {jobs} jobs"
+            for user in users:
+                shard = batch.shards[user]
+                state = shard["archive"] or shard["message"].splitlines()[0]
+                if not shard["ok"]:
+                    state = f"FAILED: {shard['message']}"
+                msg += f"\n  {user} ({format_bytes(sizes[user])}): {state}"
+            msg += "\n" + summarize(tracker.snapshot())
+            return not failed, msg
+        finally:
+            backend._unwatch(events, subscribers)
+
+    def _estimate(self, user_selection_map):
+        """Estimated bytes per user, from the size cache where possible."""
+        roots = {
+            user: self.backend.scan_roots(user, folders)
+            for user, folders in user_selection_map.items()
+        }
+        estimator = self.estimator or SizeEstimator()
+        estimates = estimator.estimate([r for rs in roots.values() for r in rs])
+        return {user: total(estimates, rs).bytes for user, rs in roots.items()}
+
+
+def _run_pool(ctx, queue, jobs, tasks):
+    """
+    Runs _run_job for each of `tasks` ({user: (name, args)}) in a pool of
+    `jobs` processes, in order. Returns ({user: (ok, msg)}, [users whose
+    process or pool died]).
+    """
+    results = {}
+    broken = []
+    with ProcessPoolExecutor(
+        jobs, ctx, initializer=_init_worker, initargs=(queue,)
+    ) as pool:
+        futures = {
+            pool.submit(_run_job, *args): user for user, (_, args) in tasks.items()
+        }
+        for fut in as_completed(futures):
+            user = futures[fut]
+            try:
+                results[user] = fut.result()
+            except BrokenProcessPool:
+                broken.append(user)
+            except Exception as e:  # noqa: BLE001
+                results[user] = False, f"Backup process failed: {e!r}"
+    return results, broken
+
+
+def _default_jobs():
+    return max(1, (os.cpu_count() or 1) // 2)
+
+
+def _shard(archive, ok, message):
+    return {"archive": archive, "ok": ok, "message": message}
+
+
+def _child_options(options, jobs):
+    """The options of one shard: the batch's, with caps split between jobs."""
+    child = {k: v for k, v in options.items() if k not in _BATCH_OPTIONS}
+    for key in ("max_bytes_per_sec", "max_iops"):
+        if child.get(key):
+            child[key] = max(1, child[key] // jobs)
+    if isinstance(child.get("report"), str):
+        # One report per shard, next to it, instead of all to one path.
+        child["report"] = True
+    if not child.get("compress_workers"):
+        child["compress_workers"] = max(1, (os.cpu_count() or 1) // jobs)
+    return child
+
+
+# -- worker processes --------------------------------------------------------
+
+_queue = None
+
+
+def _init_worker(queue):
+    global _queue
+    _queue = queue
+
+
+def _run_job(users_dir, user, folders, destination_path, options):
+    """Writes one shard; runs in a worker process."""
+    backend = ProfileBackend()
+    backend.users_dir = users_dir
+    events = EventBus()
+    forwarder = events.subscribe(_Forwarder(_queue))
+    try:
+        return backend.create_batch_backup(
+            {user: folders}, destination_path, dict(options, events=events)
+        )
+    finally:
+        forwarder.flush()
+
+
+class _Forwarder:
+    """
+    Event subscriber in a worker process that puts events on the queue to
+    the parent, in batches every FORWARD_INTERVAL. BYTES events are added
+    up into one; phases and throttle reports only make sense per process
+    and are dropped.
+    """
+
+    def __init__(self, queue):
+        self.queue = queue
+        self.pending = []
+        self.bytes = 0
+        self.last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        with self._lock:
+            if event.kind == BYTES:
+                self.bytes += event.size
+            elif event.kind not in (PHASE, THROTTLE):
+                self.pending.append((event.kind, event.name, event.size, event.detail))
+            due = event.time - self.last >= FORWARD_INTERVAL
+        if due:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            if self.bytes:
+                self.pending.append((BYTES, None, self.bytes, {}))
+                self.bytes = 0
+            pending, self.pending = self.pending, []
+            self.last = time.monotonic()
+        if pending:
+            self.queue.put(pending)
+
+
+def _relay(queue, events):
+    """Re-emits forwarded events on the batch's bus until it gets None."""
+    while True:
+        batch = queue.get()
+        if batch is None:
+            return
+        for kind, name, size, detail in batch:
+            events.emit(kind, name, size, **detail)
@@ -0,0 +1,139 @@
+import getpass
+import os
+import subprocess
+import tempfile
+import threading
+import time
+from functools import cache
+
+# Seconds each key may take to export.
+DEFAULT_TIMEOUT = 30
+
+
+@cache
+def current_user():
+    """Name of the user running this process, looked up once."""
+    try:
+        return os.getlogin()
+    except OSError:
+        # No controlling terminal, e.g. started from a service.
+        try:
+            return getpass.getuser()
+        except (KeyError, OSError):
+            return ""
+
+
+def reg_export_command(exports):
+    """
+    One cmd.exe command line running `reg export` for every (HKCU key,
+    output file) pair, one after the other.
+    """
+    script = " & ".join(
+        f'reg export "HKEY_CURRENT_USER\\{key}" "{path}" /y' for key, path in exports
+    )
+    return f'cmd /d /s /c "{script}"'
+
+
+class RegistryExporter:
+    """
+    Exports registry keys to .reg data with a single child process per
+    export() call, however many keys it is given.
+
+    `command(exports)` builds that process's command line from [(key,
+    output file)]; the default is reg_export_command. Any other command
+    that writes the output files works too, e.g. a stub to test or time the
+    export stage where there is no registry. The process may run for
+    `timeout` seconds per key before it is killed.
+    """
+
+    def __init__(self, command=None, timeout=DEFAULT_TIMEOUT):
+        self.command = command or reg_export_command
+        self.timeout = timeout
+
+    def export(self, keys):
+        """
+        Exports {name: key} and returns {name: data} for the keys that
+        were exported. The output files live in the system temp folder
+        only as long as the child process runs.
+        """
+        if not keys:
+            return {}
+        with tempfile.TemporaryDirectory(
+            prefix="pymigrate_settings_", ignore_cleanup_errors=True
+        ) as tmp:
+            paths = {name: os.path.join(tmp, f"{name}.reg") for name in keys}
+            timeout = self.timeout * len(keys)
+            timed_out = False
+            try:
+                subprocess.run(
+                    self.command([(keys[name], paths[name]) for name in keys]),
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL,
+                    timeout=timeout,
+                    check=False,
+                )
+            except subprocess.TimeoutExpired:
+                print(f"Settings export timed out after {timeout:g}s")
+                timed_out = True
+            except OSError as e:
+                print(f"Settings export failed: {e}")
+                return {}
+            results = {}
+            for name, path in paths.items():
+                try:
+                    with open(path, "rb") as f:
+                        results[name] = f.read()
+                except OSError:
+                    pass
+            if timed_out and results:
+                # Keys are exported in order; the last one may be cut short.
+                results.pop(list(results)[-1])
+            return results
+
+
+class SettingsStage:
+    """
+    Exports settings on a thread of its own while the backup scans files;
+    results() then hands the .reg files over to be written into the archive.
+
+    `reg export` can only read HKEY_CURRENT_USER, so only the user running
+    the backup (`user`, by default current_user()) is exported; the hives of
+    other users are not loaded.
+    """
+
+    def __init__(self, targets, exporter, user=None):
+        self.targets = targets
+        self.exporter = exporter
+        self.user = current_user() if user is None else user
+        self.report = None
+        self._members = []
+        self._thread = None
+
+    def start(self, users):
+        wanted = [u for u in users if u.lower() == self.user.lower()]
+        if wanted and self.targets and self.exporter is not None:
+            self._thread = threading.Thread(
+                target=self._export, args=(wanted,), daemon=True
+            )
+            self._thread.start()
+
+    def _export(self, users):
+        export = self.exporter.export
+        if self.report is not None:
+            export = self.report.timed("settings export", export)
+        for user in users:
+            try:
+                exported = export(self.targets)
+            except (OSError, ValueError, subprocess.SubprocessError) as e:
+                print(f"Could not export settings of {user}: {e}")
+                continue
+            mtime_ns = time.time_ns()
+            for name, data in exported.items():
+                self._members.append((f"{user}/Registry/{name}.reg", data, mtime_ns))
+
+    def results(self):
+        """Waits for the export; returns [(arcname, data, mtime_ns)]."""
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        return self._members
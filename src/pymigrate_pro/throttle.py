@@ -0,0 +1,312 @@
+import ctypes
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+from .events import THROTTLE, format_bytes
+
+# ioprio_set(2) syscall numbers, which glibc does not wrap.
+_IOPRIO_SET = {"x86_64": 251, "i686": 289, "aarch64": 30, "armv7l": 314}
+_IOPRIO_WHO_PROCESS = 1
+_IOPRIO_CLASS_IDLE = 3
+_IOPRIO_CLASS_SHIFT = 13
+# SetPriorityClass() modes that lower CPU, I/O and memory priority.
+_PROCESS_MODE_BACKGROUND_BEGIN = 0x00100000
+_PROCESS_MODE_BACKGROUND_END = 0x00200000
+# Intervals the adaptive limit stays put after finding the disk saturated.
+HOLD_INTERVALS = 10
+
+
+class TokenBucket:
+    """
+    Lets `rate` units per second through, in bursts of up to `burst` units
+    (one second's worth by default). take() may overdraw the bucket, which
+    puts the caller, and everyone after it, to sleep until the debt is
+    repaid, so a single take() may be larger than the burst. A `rate` of
+    None lets everything through. Safe to share between threads.
+    """
+
+    def __init__(self, rate=None, burst=None):
+        self.rate = rate
+        self.burst = burst or rate or 0
+        self._tokens = self.burst
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def take(self, n=1):
+        """Takes `n` units; returns the seconds spent waiting for them."""
+        if not self.rate:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.burst, self._tokens + (now - self._last) * self.rate
+            )
+            self._last = now
+            self._tokens -= n
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+class Throttle:
+    """
+    Keeps a backup from starving the rest of the machine.
+
+    Source reads go through timed(): each one is an I/O operation for the
+    `iops` bucket and its bytes count against the `bytes_per_sec` bucket.
+    Scanning a directory counts as one operation.
+
+    With `adaptive` set, at most `limit` of the pipeline's readers work at a
+    time (see slot()). Every `interval` seconds a controller thread compares
+    the average read latency with the best seen so far: if it has more than
+    doubled, something else is using the disk and the limit drops by a
+    quarter. Otherwise one more reader is let in, and taken back out if
+    throughput did not grow by 5%, after which the limit holds for
+    HOLD_INTERVALS. The limit stays between `min_workers` and `max_workers`.
+
+    The controller reports the limits, the current reader limit and the
+    achieved rates as THROTTLE events (see snapshot()).
+    """
+
+    def __init__(
+        self,
+        bytes_per_sec=None,
+        iops=None,
+        adaptive=False,
+        max_workers=None,
+        min_workers=1,
+        interval=1.0,
+        events=None,
+    ):
+        self.bytes_per_sec = bytes_per_sec
+        self.iops = iops
+        self.adaptive = adaptive
+        self.max_workers = max(1, max_workers or os.cpu_count() or 1)
+        self.min_workers = max(1, min(min_workers, self.max_workers))
+        self.limit = self.max_workers
+        if adaptive:
+            self.limit = max(self.min_workers, self.max_workers // 4)
+        self.interval = interval
+        self.events = events
+        # Quarter-second bursts keep the achieved rate close to the cap.
+        self._bytes = TokenBucket(bytes_per_sec, bytes_per_sec and bytes_per_sec / 4)
+        self._ops = TokenBucket(iops, iops and max(1, iops / 4))
+        self._active = 0
+        self._slots = threading.Condition()
+        self._stats_lock = threading.Lock()
+        self._window = _Window()
+        self._best_latency = None
+        self._last_rate = 0.0
+        self._last_step = 0
+        self._hold = 0
+        self._rates = (0.0, 0.0)
+        self._latency = 0.0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def timed(self, read):
+        """Wraps a read function so it obeys the caps and is measured."""
+
+        def throttled(n):
+            waited = self._ops.take(1)
+            started = time.perf_counter()
+            data = read(n)
+            seconds = time.perf_counter() - started
+            waited += self._bytes.take(len(data))
+            with self._stats_lock:
+                window = self._window
+                window.bytes += len(data)
+                window.reads += 1
+                window.seconds += seconds
+                window.waited += waited
+            return data
+
+        return throttled
+
+    def op(self, n=1):
+        """Counts `n` I/O operations that are not reads, e.g. a scandir."""
+        self._ops.take(n)
+        with self._stats_lock:
+            self._window.ops += n
+
+    @contextmanager
+    def slot(self):
+        """Holds one of the `limit` reader slots while the body runs."""
+        if not self.adaptive:
+            yield
+            return
+        with self._slots:
+            while self._active >= self.limit:
+                self._slots.wait()
+            self._active += 1
+        try:
+            yield
+        finally:
+            with self._slots:
+                self._active -= 1
+                self._slots.notify()
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._control_loop, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _control_loop(self):
+        last = time.monotonic()
+        while not self._stop.wait(self.interval):
+            now = time.monotonic()
+            with self._stats_lock:
+                window, self._window = self._window, _Window()
+            elapsed = max(now - last, 1e-6)
+            last = now
+            rate = window.bytes / elapsed
+            self._rates = (rate, (window.reads + window.ops) / elapsed)
+            if window.reads:
+                self._latency = window.seconds / window.reads
+                if self.adaptive:
+                    self._adapt(rate, window.waited)
+            if self.events is not None:
+                self.events.emit(THROTTLE, **self.snapshot())
+
+    def _adapt(self, rate, waited):
+        latency = self._latency
+        if self._best_latency is None or latency < self._best_latency:
+            self._best_latency = latency
+        else:
+            # Let the baseline drift up slowly, so one lucky interval on
+            # an idle disk does not hold the limit down for the whole run.
+            self._best_latency *= 1.02
+        limit = self.limit
+        step = 0
+        if latency > self._best_latency * 2:
+            limit = max(self.min_workers, limit * 3 // 4)
+        elif self._last_step > 0 and rate < self._last_rate * 1.05:
+            # The last reader added did not help: the disk is saturated.
+            limit = max(self.min_workers, limit - 1)
+            self._hold = HOLD_INTERVALS
+        elif self._hold:
+            self._hold -= 1
+        elif waited == 0 and limit < self.max_workers:
+            # Not held back by a cap; see whether one more reader helps.
+            limit += 1
+            step = 1
+        self._last_step = step
+        self._last_rate = rate
+        if limit != self.limit:
+            with self._slots:
+                self.limit = limit
+                self._slots.notify_all()
+
+    def summary(self):
+        parts = []
+        if self.bytes_per_sec:
+            parts.append(f"{format_bytes(self.bytes_per_sec)}/s")
+        if self.iops:
+            parts.append(f"{self.iops} IOPS")
+        caps = f"capped at {' and '.join(parts)}" if parts else "no caps"
+        readers = f"{self.limit} of {self.max_workers} readers"
+        if self.adaptive:
+            readers += " (adaptive)"
+        return f"Throttle: {caps}, {readers}"
+
+    def snapshot(self):
+        """Limits and achieved rates over the last interval, as a dict."""
+        return {
+            "bytes_per_sec": self.bytes_per_sec,
+            "iops": self.iops,
+            "workers": self.limit,
+            "max_workers": self.max_workers,
+            "byte_rate": self._rates[0],
+            "op_rate": self._rates[1],
+            "latency": self._latency,
+        }
+
+
+class _Window:
+    """What the readers did since the controller last looked."""
+
+    __slots__ = ("bytes", "ops", "reads", "seconds", "waited")
+
+    def __init__(self):
+        self.bytes = self.reads = self.ops = 0
+        self.seconds = self.waited = 0.0
+
+
+def lower_priority():
+    """
+    Lowers the CPU and I/O priority of the calling thread (Linux: nice 10
+    and the idle I/O class) or of the whole process (Windows: background
+    mode). Threads started afterwards inherit it on Linux. Returns what
+    was changed, as a list of strings.
+    """
+    changed = []
+    if sys.platform == "win32":
+        kernel32 = ctypes.windll.kernel32
+        if kernel32.SetPriorityClass(
+            kernel32.GetCurrentProcess(), _PROCESS_MODE_BACKGROUND_BEGIN
+        ):
+            changed.append("background mode")
+        return changed
+    try:
+        os.setpriority(os.PRIO_PROCESS, 0, os.getpriority(os.PRIO_PROCESS, 0) + 10)
+        changed.append("nice +10")
+    except (AttributeError, OSError):
+        pass
+    number = _IOPRIO_SET.get(os.uname().machine) if sys.platform == "linux" else None
+    if number is not None:
+        try:
+            libc = ctypes.CDLL(None, use_errno=True)
+            value = _IOPRIO_CLASS_IDLE << _IOPRIO_CLASS_SHIFT
+            if libc.syscall(number, _IOPRIO_WHO_PROCESS, 0, value) == 0:
+                changed.append("idle I/O class")
+        except (OSError, AttributeError):
+            pass
+    return changed
+
+
+def restore_priority():
+    """Ends Windows background mode; a no-op elsewhere."""
+    if sys.platform == "win32":
+        kernel32 = ctypes.windll.kernel32
+        kernel32.SetPriorityClass(
+            kernel32.GetCurrentProcess(), _PROCESS_MODE_BACKGROUND_END
+        )
+
+
+def run_in_background(job):
+    """
+    Runs `job()` at lowered priority and returns its result. On Linux the
+    job runs on a thread of its own, so only it and the threads it starts
+    are slowed down, never the caller (e.g. a GUI thread).
+    """
+    if sys.platform == "win32":
+        lower_priority()
+        try:
+            return job()
+        finally:
+            restore_priority()
+    outcome = {}
+
+    def target():
+        lower_priority()
+        try:
+            outcome["result"] = job()
+        except BaseException as e:  # noqa: BLE001
+            outcome["error"] = e
+
+    thread = threading.Thread(target=target)
+    thread.start()
+    thread.join()
+    if "error" in outcome:
+        raise outcome["error"]
+    return outcome["result"]
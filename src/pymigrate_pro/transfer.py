@@ -0,0 +1,394 @@
+import hmac
+import json
+import os
+import queue
+import shutil
+import socket
+import struct
+import threading
+import time
+import zlib
+
+from .archive import CHUNK_SIZE, MemberWriter
+from .codec import for_method
+from .events import BYTES, ERROR, MEMBER
+from .restore import make_directory, safe_target
+
+PROTOCOL_VERSION = 1
+DEFAULT_PORT = 50505
+
+# Every frame is: kind (1 byte), payload length, CRC32 of the payload.
+_FRAME = struct.Struct("<BLL")
+MAX_PAYLOAD = 64 << 20
+BUFFER_SIZE = 256 << 10
+
+# Frame kinds. Sender -> receiver unless noted.
+HELLO = 1  # JSON {"version", "token"}
+FILE = 2  # JSON {"name", "mtime_ns", "method"}: a file starts
+DATA = 3  # the next piece of the current file, compressed per "method"
+END = 4  # JSON {"crc", "size"}: the current file is complete
+ABORT = 5  # the current file could not be read; drop it
+REF = 6  # JSON {"name", "source", "mtime_ns"}: a copy of a file sent earlier
+DONE = 7  # JSON {"files"}: nothing more to send
+RESULT = 8  # receiver -> sender, JSON summary (or {"error"})
+
+# Suffix of files still being received; renamed once their CRC checks out.
+PARTIAL_SUFFIX = ".pmigpart"
+
+
+class TransferError(Exception):
+    """The connection broke, a frame was corrupt, or the peer refused us."""
+
+
+def write_frame(fp, kind, payload=b""):
+    fp.write(_FRAME.pack(kind, len(payload), zlib.crc32(payload)))
+    fp.write(payload)
+
+
+def read_frame(fp):
+    """Reads one frame from a buffered binary file; returns (kind, payload)."""
+    header = fp.read(_FRAME.size)
+    if len(header) < _FRAME.size:
+        raise TransferError("Connection closed by peer")
+    kind, length, crc = _FRAME.unpack(header)
+    if length > MAX_PAYLOAD:
+        raise TransferError(f"Oversized frame ({length} bytes)")
+    payload = fp.read(length)
+    if len(payload) < length:
+        raise TransferError("Connection closed by peer")
+    if zlib.crc32(payload) != crc:
+        raise TransferError("Corrupt frame (CRC mismatch)")
+    return kind, payload
+
+
+def _json(data):
+    return json.dumps(data).encode("utf-8")
+
+
+def parse_address(address, default_host=""):
+    """Accepts "host:port", "host", ":port" or a (host, port) tuple."""
+    if isinstance(address, tuple):
+        return address
+    host, _, port = address.rpartition(":") if ":" in address else (address, "", "")
+    return host or default_host, int(port) if port else DEFAULT_PORT
+
+
+class StreamSender(MemberWriter):
+    """
+    Sends files over a connected socket instead of writing an archive.
+
+    Reading, compressing and sending overlap exactly as for ArchiveWriter;
+    the writer thread frames each member's chunks onto the socket. When the
+    receiver falls behind, TCP flow control blocks the writer thread, which
+    stops the compression pool and then the readers, so nothing queues up
+    without bound on either side.
+    """
+
+    def __init__(
+        self,
+        sock,
+        token="",
+        workers=None,
+        level=1,
+        chunk_size=CHUNK_SIZE,
+        policy=None,
+        events=None,
+        codec=None,
+    ):
+        self._sock = sock
+        self._out = sock.makefile("wb", buffering=BUFFER_SIZE)
+        self.sent = set()  # arcnames the receiver has been sent in full
+        self.result = None
+        write_frame(
+            self._out, HELLO, _json({"version": PROTOCOL_VERSION, "token": token})
+        )
+        super().__init__(workers, level, chunk_size, policy, False, events, codec)
+
+    def _write_member(self, member):
+        fut = member.chunks.get()
+        if fut is None:
+            return
+        header = {
+            "name": member.arcname,
+            "mtime_ns": member.mtime_ns,
+            "method": member.compress_type,
+        }
+        write_frame(self._out, FILE, _json(header))
+        compress_size, ok = self._write_chunks(
+            member, fut, lambda data: write_frame(self._out, DATA, data)
+        )
+        if ok:
+            end = {"crc": member.crc, "size": member.file_size}
+            write_frame(self._out, END, _json(end))
+            self.sent.add(member.arcname)
+            self._finished(member, compress_size)
+        elif self._error is None:
+            # The source failed half way; the socket itself is still fine.
+            write_frame(self._out, ABORT)
+
+    def send_ref(self, arcname, source, mtime_ns=None):
+        """
+        Tells the receiver to copy `source`, a member already sent, to
+        `arcname` on its own disk. Call after drain().
+        """
+        self._check()
+        ref = {"name": arcname, "source": source, "mtime_ns": mtime_ns}
+        write_frame(self._out, REF, _json(ref))
+
+    def _finish(self):
+        write_frame(self._out, DONE, _json({"files": len(self.sent)}))
+        self._out.flush()
+        with self._sock.makefile("rb") as fp:
+            kind, payload = read_frame(fp)
+        if kind != RESULT:
+            raise TransferError(f"Unexpected frame {kind} instead of the result")
+        self.result = json.loads(payload)
+        if "error" in self.result:
+            raise TransferError(self.result["error"])
+
+    def _release(self):
+        try:
+            self._out.close()
+        except OSError:
+            pass
+
+
+class StreamReceiver:
+    """
+    Receives files from a StreamSender and writes them below `root` as they
+    arrive. The network thread checks frames and hands them to a disk
+    thread through a bounded queue; when the disk is slower than the
+    network, the queue fills, the network thread stops reading and TCP
+    pushes back on the sender.
+
+    Files are written next to their target with a PARTIAL_SUFFIX and only
+    renamed into place after their CRC and size match, so an interrupted
+    transfer never leaves a truncated file under a real name.
+
+    Anyone who can connect could write into every profile below `root`, so
+    a non-empty `token` is required and the sender must present it. Dedup
+    references may only copy files received in the same transfer.
+    """
+
+    def __init__(self, root, token, events=None, queue_size=64):
+        if not token:
+            raise ValueError("A transfer token is required")
+        self.root = os.path.realpath(root)
+        self.token = token
+        self.events = events
+        self.queue_size = queue_size
+        self.files = 0
+        self.bytes = 0
+        self.failed = []  # (name, reason)
+        self.refs = []
+        self.received = set()  # names written in full
+        self._dirs = set()
+
+    def serve(self, listener):
+        """Accepts one sender on a listening socket and receives from it."""
+        sock, _ = listener.accept()
+        with sock:
+            return self.receive(sock)
+
+    def receive(self, sock):
+        """Runs until the sender is done; returns a summary dict."""
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 << 20)
+        fp = sock.makefile("rb", buffering=BUFFER_SIZE)
+        out = sock.makefile("wb")
+        try:
+            kind, payload = read_frame(fp)
+            hello = json.loads(payload) if kind == HELLO else {}
+            if hello.get("version") != PROTOCOL_VERSION:
+                return self._refuse(out, "Unsupported sender version")
+            token = str(hello.get("token") or "")
+            if not token or not hmac.compare_digest(token, self.token):
+                return self._refuse(out, "Wrong transfer token")
+
+            frames = queue.Queue(maxsize=self.queue_size)
+            writer = threading.Thread(target=self._disk_loop, args=(frames,))
+            writer.start()
+            try:
+                while True:
+                    kind, payload = read_frame(fp)
+                    frames.put((kind, payload))
+                    if kind == DONE:
+                        break
+            finally:
+                frames.put(None)
+                writer.join()
+            self._expand_refs()
+            result = {
+                "files": self.files,
+                "bytes": self.bytes,
+                "failed": [name for name, _ in self.failed],
+            }
+            write_frame(out, RESULT, _json(result))
+            out.flush()
+            return result
+        finally:
+            fp.close()
+            out.close()
+
+    def _refuse(self, out, reason):
+        write_frame(out, RESULT, _json({"error": reason}))
+        out.flush()
+        raise TransferError(reason)
+
+    def _disk_loop(self, frames):
+        current = None  # _Incoming, or False while skipping a rejected file
+        while True:
+            item = frames.get()
+            if item is None:
+                # The sender is done, or the connection dropped mid-file.
+                if current:
+                    current.discard()
+                break
+            kind, payload = item
+            name = None  # of the file a failing frame belongs to
+            try:
+                if kind == FILE:
+                    if current:
+                        current.discard()
+                    # Until it is open, the new file's frames are skipped.
+                    current = False
+                    header = json.loads(payload)
+                    name = header["name"]
+                    current = self._open(header)
+                elif kind == DATA:
+                    if current:
+                        current.write(payload, self.events)
+                elif kind == END:
+                    if current:
+                        self._close(current, json.loads(payload))
+                    current = None
+                elif kind == ABORT:
+                    if current:
+                        current.discard()
+                    current = None
+                elif kind == REF:
+                    self.refs.append(json.loads(payload))
+            except Exception as e:  # noqa: BLE001
+                if current:
+                    name = current.name
+                    current.discard()
+                self._fail(name or "(unreadable frame)", e)
+                current = False
+
+    def _open(self, header):
+        name = header["name"]
+        target = safe_target(self.root, name)
+        if target is None:
+            self._fail(name, "unsafe path")
+            return False
+        parent = os.path.dirname(target)
+        if parent not in self._dirs:
+            if not make_directory(parent, self.root):
+                self._fail(name, "unsafe path")
+                return False
+            self._dirs.add(parent)
+        try:
+            return _Incoming(name, target, header)
+        except (OSError, ValueError) as e:
+            self._fail(name, e)
+            return False
+
+    def _close(self, incoming, end):
+        incoming.finish()
+        if incoming.crc != end["crc"] or incoming.size != end["size"]:
+            incoming.discard()
+            self._fail(incoming.name, "CRC mismatch")
+            return
+        mtime_ns = incoming.header.get("mtime_ns")
+        if mtime_ns is not None:
+            os.utime(incoming.partial, ns=(mtime_ns, mtime_ns))
+        os.replace(incoming.partial, incoming.target)
+        self.received.add(incoming.name)
+        self.files += 1
+        self.bytes += incoming.size
+        if self.events is not None:
+            self.events.emit(
+                MEMBER,
+                incoming.name,
+                incoming.size,
+                seconds=time.monotonic() - incoming.started,
+            )
+
+    def _fail(self, name, reason):
+        self.failed.append((name, reason))
+        print(f"Skipping {name}: {reason}")
+        if self.events is not None:
+            self.events.emit(ERROR, name, files=0, reason=str(reason))
+
+    def _expand_refs(self):
+        for ref in self.refs:
+            target = safe_target(self.root, ref["name"])
+            source = safe_target(self.root, ref["source"])
+            if target is None or source is None:
+                self._fail(ref["name"], "unsafe path")
+                continue
+            if ref["source"] not in self.received:
+                self._fail(ref["name"], "source was not received")
+                continue
+            try:
+                if not make_directory(os.path.dirname(target), self.root):
+                    self._fail(ref["name"], "unsafe path")
+                    continue
+                shutil.copyfile(source, target)
+                if ref.get("mtime_ns") is not None:
+                    os.utime(target, ns=(ref["mtime_ns"], ref["mtime_ns"]))
+                self.files += 1
+            except OSError as e:
+                self._fail(ref["name"], e)
+
+
+class _Incoming:
+    """A file being received."""
+
+    def __init__(self, name, target, header):
+        self.name = name
+        self.target = target
+        self.partial = target + PARTIAL_SUFFIX
+        self.header = header
+        self.crc = 0
+        self.size = 0
+        self.started = time.monotonic()
+        # Raises ValueError for a codec this side does not have.
+        self._decompressor = for_method(header.get("method", 0)).decompressor()
+        self._fp = open(self.partial, "wb")  # noqa: SIM115
+
+    def write(self, payload, events=None):
+        self._append(self._decompressor.decompress(payload), events)
+
+    def finish(self):
+        self._append(self._decompressor.flush())
+        self._fp.close()
+
+    def _append(self, data, events=None):
+        if not data:
+            return
+        self._fp.write(data)
+        self.crc = zlib.crc32(data, self.crc)
+        self.size += len(data)
+        if events is not None:
+            events.emit(BYTES, self.name, len(data))
+
+    def discard(self):
+        self._fp.close()
+        try:
+            os.remove(self.partial)
+        except OSError:
+            pass
+
+
+def listen(host="", port=DEFAULT_PORT):
+    """Opens a listening TCP socket (port 0 picks a free one)."""
+    listener = socket.create_server((host, port))
+    return listener
+
+
+def connect(host, port=DEFAULT_PORT, timeout=30):
+    sock = socket.create_connection((host, port), timeout=timeout)
+    sock.settimeout(None)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4 << 20)
+    return sock
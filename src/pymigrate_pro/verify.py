@@ -0,0 +1,248 @@
+import json
+import random
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from .archive import content_hash
+from .codec import DECOMPRESS_ERRORS
+from .events import BYTES, ERROR, FOUND, MEMBER
+from .manifest import INCREMENTAL, MANIFEST_NAME, BackupManifest, is_meta
+from .restore import BATCH_BYTES, BATCH_MEMBERS, LARGE_COPY_SIZE, open_member
+from .scanner import default_workers
+
+# Reasons a member is listed as corrupt.
+BAD_DATA = "bad data"  # CRC, size or decompression failure
+BAD_HASH = "hash mismatch"  # CRC fine, but not the content hashed at backup time
+UNREADABLE = "unreadable"
+
+
+class ArchiveVerifier:
+    """
+    Checks .pmig archives on a pool of worker threads.
+
+    The central directory is read once; members are then split, in archive
+    order, into runs of about BATCH_BYTES that each worker reads with its
+    own file handle and large sequential reads. Every member's CRC and size
+    are checked while it is decompressed, and where the manifest recorded a
+    content hash at backup time that is checked too, which also catches
+    damage a CRC collision would hide.
+
+    `sample` (a fraction between 0 and 1) spot-checks a random subset of
+    the members instead of all of them; metadata members are always read.
+    `seed` makes the sample reproducible.
+    """
+
+    def __init__(self, workers=None, sample=None, seed=None, events=None):
+        self.workers = max(1, workers or default_workers())
+        if sample is not None and not 0 < sample <= 1:
+            raise ValueError("sample must be a fraction between 0 and 1")
+        self.sample = sample
+        self.seed = seed
+        self.events = events
+
+    def verify(self, path):
+        """Checks one archive; returns its report (see verify_chain)."""
+        return self.verify_chain([path])["archives"][0]
+
+    def verify_chain(self, chain):
+        """
+        Checks the archives of a chain, oldest first, and returns a report
+        that json.dumps() can write:
+
+            {"ok", "archives": [{"archive", "members", "bytes", "checked",
+              "checked_bytes", "hashed", "sampled", "seconds", "error",
+              "corrupt": [{"name", "reason"}], "missing": [names]}]}
+
+        "error" is set if an archive could not be opened at all.
+
+        A name is missing if the newest manifest lists it but no archive of
+        the chain stores it, or if a dedup reference points at a member that
+        is not there. Without the bases of an incremental archive only its
+        references can be checked that way.
+        """
+        reports = []
+        provided = set()
+        manifest = None
+        for path in chain:
+            report, names, manifest = self._verify_one(path)
+            reports.append(report)
+            provided.update(names)
+        if manifest is not None and reports[-1]["error"] is None:
+            complete = len(chain) > 1 or manifest.kind != INCREMENTAL
+            if complete:
+                missing = sorted(
+                    name for name in manifest.entries if name not in provided
+                )
+                known = set(reports[-1]["missing"])
+                reports[-1]["missing"].extend(n for n in missing if n not in known)
+        ok = all(
+            r["error"] is None and not r["corrupt"] and not r["missing"]
+            for r in reports
+        )
+        return {"ok": ok, "archives": reports}
+
+    def _verify_one(self, path):
+        started = time.monotonic()
+        report = {
+            "archive": path,
+            "members": 0,
+            "bytes": 0,
+            "checked": 0,
+            "checked_bytes": 0,
+            "hashed": 0,
+            "sampled": self.sample is not None,
+            "seconds": 0.0,
+            "error": None,
+            "corrupt": [],
+            "missing": [],
+        }
+        try:
+            with zipfile.ZipFile(path, "r") as zipf:
+                infolist = zipf.infolist()
+                try:
+                    manifest = BackupManifest.read(zipf)
+                except (ValueError, KeyError, zipfile.BadZipFile, EOFError) as e:
+                    manifest = None
+                    report["corrupt"].append({"name": MANIFEST_NAME, "reason": str(e)})
+        except (OSError, zipfile.BadZipFile) as e:
+            report["error"] = str(e)
+            return report, set(), None
+
+        files = [i for i in infolist if not i.is_dir()]
+        names = {i.filename for i in files}
+        report["members"] = len(files)
+        report["bytes"] = sum(i.file_size for i in files)
+        digests = {}
+        if manifest is not None:
+            digests = {
+                name: known[2]
+                for name, known in manifest.entries.items()
+                if name in names and known[2]
+            }
+            for name, canonical in manifest.refs.items():
+                if canonical not in names:
+                    report["missing"].append(name)
+            names |= set(manifest.refs)
+
+        chosen = self._choose(files)
+        if self.events is not None:
+            self.events.emit(
+                FOUND, path, sum(i.file_size for i in chosen), files=len(chosen)
+            )
+        corrupt, hashed = self._check(path, chosen, digests)
+        report["corrupt"].extend(
+            {"name": name, "reason": reason} for name, reason in sorted(corrupt)
+        )
+        report["checked"] = len(chosen)
+        report["checked_bytes"] = sum(i.file_size for i in chosen)
+        report["hashed"] = hashed
+        report["seconds"] = round(time.monotonic() - started, 3)
+        return report, names, manifest
+
+    def _choose(self, files):
+        if self.sample is None:
+            return files
+        meta = [i for i in files if is_meta(i.filename)]
+        data = [i for i in files if not is_meta(i.filename)]
+        k = min(len(data), max(1, round(len(data) * self.sample)))
+        return meta + random.Random(self.seed).sample(data, k)
+
+    def _check(self, path, infos, digests):
+        """Reads `infos` in parallel; returns ([(name, reason)], hashed)."""
+        batches = []
+        batch, batch_bytes = [], 0
+        for info in sorted(infos, key=lambda i: i.header_offset):
+            batch.append(info)
+            batch_bytes += info.compress_size
+            if len(batch) >= BATCH_MEMBERS or batch_bytes >= BATCH_BYTES:
+                batches.append(batch)
+                batch, batch_bytes = [], 0
+        if batch:
+            batches.append(batch)
+
+        local = threading.local()
+        handles = []
+        handles_lock = threading.Lock()
+        events = self.events
+
+        def handle():
+            fp = getattr(local, "fp", None)
+            if fp is None:
+                fp = open(path, "rb", buffering=LARGE_COPY_SIZE)  # noqa: SIM115
+                local.fp = fp
+                with handles_lock:
+                    handles.append(fp)
+            return fp
+
+        def work(batch):
+            fp = handle()
+            corrupt = []
+            hashed = 0
+            for info in batch:
+                started = time.monotonic()
+                digest = digests.get(info.filename)
+                hasher = content_hash() if digest else None
+                reason = None
+                try:
+                    with open_member(fp, info) as src:
+                        while True:
+                            data = src.read(LARGE_COPY_SIZE)
+                            if not data:
+                                break
+                            if hasher is not None:
+                                hasher.update(data)
+                            if events is not None:
+                                events.emit(BYTES, info.filename, len(data))
+                except (
+                    zipfile.BadZipFile,
+                    EOFError,
+                    ValueError,
+                    *DECOMPRESS_ERRORS,
+                ) as e:
+                    reason = f"{BAD_DATA}: {e}"
+                except OSError as e:
+                    # bz2 reports a damaged stream as an OSError without errno.
+                    kind = BAD_DATA if e.errno is None else UNREADABLE
+                    reason = f"{kind}: {e}"
+                except NotImplementedError as e:
+                    reason = f"{UNREADABLE}: {e}"
+                else:
+                    if hasher is not None:
+                        hashed += 1
+                        if hasher.hexdigest() != digest:
+                            reason = BAD_HASH
+                if reason is not None:
+                    corrupt.append((info.filename, reason))
+                    if events is not None:
+                        events.emit(ERROR, info.filename, info.file_size, reason=reason)
+                    continue
+                if events is not None:
+                    events.emit(
+                        MEMBER,
+                        info.filename,
+                        info.file_size,
+                        seconds=time.monotonic() - started,
+                    )
+            return corrupt, hashed
+
+        corrupt = []
+        hashed = 0
+        try:
+            with ThreadPoolExecutor(self.workers) as pool:
+                futures = [pool.submit(work, b) for b in batches]
+                for fut in as_completed(futures):
+                    bad, n = fut.result()
+                    corrupt.extend(bad)
+                    hashed += n
+        finally:
+            for fp in handles:
+                fp.close()
+        return corrupt, hashed
+
+
+def write_report(report, path):
+    """Writes a verify report as JSON."""
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
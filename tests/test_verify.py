@@ -0,0 +1,58 @@
+import zipfile
+
+import pytest
+
+from pymigrate_pro.backend import ProfileBackend
+from pymigrate_pro.codec import available_codecs
+from pymigrate_pro.restore import data_offset
+from pymigrate_pro.verify import BAD_DATA, ArchiveVerifier
+
+CODECS = [c for c in available_codecs() if c != "stored"]
+
+
+def backup(tmp_path, codec):
+    docs = tmp_path / "users" / "alice" / "Documents"
+    docs.mkdir(parents=True)
+    for i in range(3):
+        (docs / f"notes{i}.txt").write_text(f"line {i}\n" * 20000)
+    out = tmp_path / "out"
+    out.mkdir()
+    backend = ProfileBackend()
+    backend.users_dir = str(tmp_path / "users")
+    ok, msg = backend.create_batch_backup(
+        {"alice": ["Documents"]}, str(out), {"codec": codec, "dedup": False}
+    )
+    assert ok, msg
+    (archive,) = out.glob("*.pmig")
+    return str(archive)
+
+
+def corrupt(archive, name):
+    """Overwrites the start of a member's compressed data."""
+    with zipfile.ZipFile(archive) as zipf:
+        info = zipf.getinfo(name)
+    with open(archive, "r+b") as f:
+        f.seek(data_offset(f, info))
+        f.write(b"\xff" * 16)
+
+
+@pytest.mark.parametrize("codec", CODECS)
+def test_damaged_member_is_reported(tmp_path, codec):
+    archive = backup(tmp_path, codec)
+    corrupt(archive, "alice/Documents/notes1.txt")
+
+    report = ArchiveVerifier().verify_chain([archive])
+
+    assert report["ok"] is False
+    (bad,) = report["archives"][0]["corrupt"]
+    assert bad["name"] == "alice/Documents/notes1.txt"
+    assert bad["reason"].startswith(BAD_DATA)
+
+
+def test_intact_archive_is_ok(tmp_path):
+    archive = backup(tmp_path, "deflate")
+
+    report = ArchiveVerifier().verify_chain([archive])
+
+    assert report["ok"] is True
+    assert report["archives"][0]["corrupt"] == []